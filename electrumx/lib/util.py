@@ -30,9 +30,14 @@
 from array import array
 import asyncio
 import inspect
+from hashlib import blake2b
 from ipaddress import ip_address
 import logging
+import math
+import mmap
+import os
 import sys
+import threading
 from collections.abc import Container, Mapping
 from struct import Struct
 
@@ -192,6 +197,68 @@ def increment_byte_string(bs):
         return None
 
 
+class BloomFilter:
+    '''A fixed-size Bloom filter over byte strings.
+
+    Membership tests can return false positives but never false
+    negatives.  Items cannot be removed; once more than capacity items
+    have been added the error rate degrades and the filter should be
+    rebuilt.'''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.nbits = max(8, math.ceil(-self.capacity * math.log(error_rate)
+                                      / (math.log(2) ** 2)))
+        self.nhashes = max(1, round(self.nbits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        nbits = self.nbits
+        return [(h1 + n * h2) % nbits for n in range(self.nhashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class ScalableBloomFilter:
+    '''A Bloom filter that grows instead of saturating.
+
+    Once its newest filter holds its capacity of items, new items go to an
+    added filter of twice the capacity and half the error rate, so the
+    error rate stays below twice that of the first filter.'''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+        self.error_rate = error_rate / 2
+
+    def add(self, item):
+        bloom = self.filters[-1]
+        if bloom.count >= bloom.capacity:
+            self.error_rate /= 2
+            bloom = BloomFilter(bloom.capacity * 2, self.error_rate)
+            self.filters.append(bloom)
+        bloom.add(item)
+
+    def __contains__(self, item):
+        return any(item in bloom for bloom in self.filters)
+
+    @property
+    def count(self):
+        return sum(bloom.count for bloom in self.filters)
+
+
 class LogicalFile:
     '''A logical binary file split across several separate files on disk.'''
 
@@ -240,6 +307,81 @@ class LogicalFile:
         return f
 
 
+class MappedLogicalFile(LogicalFile):
+    '''A LogicalFile whose reads are served from read-only memory maps.
+
+    Each underlying file is mapped on first use and remapped when a read
+    runs past the end of its current map, so the maps stay valid as
+    write() appends to the files.  Overwrites are seen through the map
+    directly.
+    '''
+
+    def __init__(self, prefix, digits, file_size):
+        super().__init__(prefix, digits, file_size)
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def _map(self, file_num, end):
+        '''Return a map of file number file_num, remapping it if it is
+        shorter than end bytes.  Return None if the file does not exist or
+        is empty.'''
+        file_map = self.maps.get(file_num)
+        if file_map is not None and len(file_map) >= end:
+            return file_map
+        with self.lock:
+            file_map = self.maps.get(file_num)
+            if file_map is not None and len(file_map) >= end:
+                return file_map
+            filename = self.filename_fmt.format(file_num)
+            try:
+                with open(filename, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return None
+                    file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None
+            # A replaced map is closed when the last view of it is released
+            self.maps[file_num] = file_map
+            return file_map
+
+    def view(self, start, size):
+        '''Return a memoryview of up to size bytes of the virtual file
+        starting at offset start.
+
+        The view is zero-copy unless it spans two underlying files.'''
+        file_num, offset = divmod(start, self.file_size)
+        if offset + size > self.file_size:
+            return memoryview(self.read(start, size))
+        file_map = self._map(file_num, offset + size)
+        if file_map is None:
+            return memoryview(b'')
+        return memoryview(file_map)[offset:offset + size]
+
+    def read(self, start, size=-1):
+        '''Read up to size bytes from the virtual file, starting at offset
+        start, and return them.
+
+        If size is -1 all bytes are read.'''
+        if size < 0:
+            return super().read(start, size)
+        parts = []
+        while size > 0:
+            file_num, offset = divmod(start, self.file_size)
+            part_size = min(size, self.file_size - offset)
+            file_map = self._map(file_num, offset + part_size)
+            if file_map is None:
+                break
+            part = file_map[offset:offset + part_size]
+            if not part:
+                break
+            parts.append(part)
+            start += len(part)
+            size -= len(part)
+            if len(part) < part_size:
+                break
+        return b''.join(parts)
+
+
 def open_file(filename, create=False):
     '''Open the file name.  Return its handle.'''
     try:
@@ -73,6 +73,9 @@ MINT_SUBNAME_COMMIT_PAYMENT_DELAY_BLOCKS = 15 # ~2.5 hours.
 # "atom" 
 ATOMICALS_ENVELOPE_MARKER_BYTES = '0461746f6d'
 
+# The start of an envelope in a reveal script: OP_IF followed by the marker
+ATOMICALS_ENVELOPE_START = bytes([OpCodes.OP_IF]) + bytes.fromhex(ATOMICALS_ENVELOPE_MARKER_BYTES)
+
 # Limit the smallest payment amount allowed for a subrealm
 SUBNAME_MIN_PAYMENT_DUST_LIMIT = 0 # It can be possible to do free
 
@@ -1158,47 +1161,34 @@ def is_op_return_dmitem_payment_marker_atomical_id(script):
     # Return the potential atomical id that the payment marker is associated with
     return script[start_index+5+2+1:start_index+5+2+1+36]
    
+# Check whether raw data such as a serialized block may hold an Atomicals envelope in a witness
+# Every witness script with an operation contains the envelope start as contiguous bytes
+def has_atomicals_envelope(raw):
+    return ATOMICALS_ENVELOPE_START in raw
+
 # Parses and detects valid Atomicals protocol operations in a witness script
 # Stops when it finds the first operation in the first input
 def parse_protocols_operations_from_witness_for_input(txinwitness):
-    '''Detect and parse all operations across the witness input arrays from a tx'''
+    '''Detect and parse all operations across the witness input arrays from a tx
+
+    Returns the operation, its payload and the payload decoded if it was
+    decoded here, which all operations but dmt and nft are.'''
     for script in txinwitness:
-        n = 0
-        script_entry_len = len(script)
-        if script_entry_len < 39 or script[0] != 0x20:
+        # The script must start with a 32 byte pubkey push
+        if len(script) < 39 or script[0] != 0x20:
             continue
-        found_operation_definition = False
-        while n < script_entry_len - 5:
-            op = script[n]
-            n += 1
-            # Match the pubkeyhash
-            if op == 0x20 and n + 32 <= script_entry_len:
-                n = n + 32
-                while n < script_entry_len - 5:
-                    op = script[n] 
-                    n += 1  
-                    # Get the next if statement
-                    if op == OpCodes.OP_IF:
-                        if ATOMICALS_ENVELOPE_MARKER_BYTES == script[n : n + 5].hex():
-                            found_operation_definition = True
-                            # Parse to ensure it is in the right format
-                            operation_type, payload = parse_operation_from_script(script, n + 5)
-                            if operation_type!='dmt' and operation_type!='nft':
-                                # print("--------------------------------------------parse_protocols_operations_from_witness_array")
-                                # print("--------------------------------------------script.hex:",script.hex())
-                                # print("--------------------------------------------operation_type:",operation_type)
-                                decoded_object = {}
-                                decoded_object = loads(payload) 
-                                # print("---------------------------------txinwitness decoded_object:",decoded_object)
-
-                            if operation_type != None:
-                                return operation_type, payload
-                            break
-                if found_operation_definition:
-                    break
-            else:
-                break
-    return None, None
+        # Find the first OP_IF followed by the marker after the pubkey
+        n = script.find(ATOMICALS_ENVELOPE_START, 33)
+        if n < 0:
+            continue
+        # Parse to ensure it is in the right format
+        operation_type, payload = parse_operation_from_script(script, n + len(ATOMICALS_ENVELOPE_START))
+        decoded_object = None
+        if operation_type != 'dmt' and operation_type != 'nft':
+            decoded_object = loads(payload)
+        if operation_type != None:
+            return operation_type, payload, decoded_object
+    return None, None, None
 
 # Parses and detects the witness script array and detects the Atomicals operations
 def parse_protocols_operations_from_witness_array(tx, tx_hash, allow_args_bytes):
@@ -1208,14 +1198,15 @@ def parse_protocols_operations_from_witness_array(tx, tx_hash, allow_args_bytes)
     txin_idx = 0
     for txinwitness in tx.witness:
         # All inputs are parsed but further upstream most operations will only function if placed in the 0'th input
-        op_name, payload = parse_protocols_operations_from_witness_for_input(txinwitness)
+        op_name, payload, decoded_object = parse_protocols_operations_from_witness_for_input(txinwitness)
         if not op_name:
             continue 
-        decoded_object = {}
         if payload: 
             # Ensure that the payload is cbor encoded dictionary or empty
             try:
-                decoded_object = loads(payload)                
+                # Reuse the payload if the scan decoded it already
+                if decoded_object is None:
+                    decoded_object = loads(payload)
                 if not isinstance(decoded_object, dict):
                     print(f'parse_protocols_operations_from_witness_array found {op_name} but decoded CBOR payload is not a dict for {tx}. Skipping tx input...')
                     continue
@@ -1236,7 +1227,6 @@ def parse_protocols_operations_from_witness_array(tx, tx_hash, allow_args_bytes)
             associated_txin = tx.inputs[txin_idx]
             prev_tx_hash = associated_txin.prev_hash
             prev_idx = associated_txin.prev_idx
-            print(f'tx_hash={tx_hash.hex()}, txin_idx={txin_idx}')
             return {
                 'op': op_name,
                 'payload': decoded_object,
@@ -1402,17 +1392,21 @@ def calculate_latest_state_from_mod_history(mod_history):
     mod_history.sort(key=lambda x: x['tx_num'], reverse=False)
     current_object_state = {}
     for element in mod_history:
-        has_action_prop = element['data'].get('$a')
-        action_to_perform = 0 # Set/update = 0
-        # We assume there is only the default $action (which can explicitly be indicated with 'set') and 'delete'
-        # If omitted we just assume 
-        if has_action_prop and isinstance(has_action_prop, int) and has_action_prop == 1: # delete = 1
-            apply_delete_state_mutation(current_object_state, element['data'], True)
-        else: 
-            apply_set_state_mutation(current_object_state, element['data'], True)
+        apply_state_mutation(current_object_state, element['data'])
     else: 
         return current_object_state
 
+# Apply the data of a mod to the state built from the mods before it
+def apply_state_mutation(current_object_state, data):
+    has_action_prop = data.get('$a')
+    # We assume there is only the default $action (which can explicitly be indicated with 'set') and 'delete'
+    # If omitted we just assume 
+    if has_action_prop and isinstance(has_action_prop, int) and has_action_prop == 1: # delete = 1
+        apply_delete_state_mutation(current_object_state, data, True)
+    else: 
+        apply_set_state_mutation(current_object_state, data, True)
+    return current_object_state
+
 def validate_rules_data(namespace_data):
     if not namespace_data or not isinstance(namespace_data, dict):
         return None 
@@ -10,7 +10,10 @@
 
 import asyncio
 import os
+import threading
 import time
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
 from typing import Sequence, Tuple, List, Callable, Optional, TYPE_CHECKING, Type
 
 from aiorpcx import run_in_thread, CancelledError
@@ -24,7 +27,9 @@ from electrumx.lib.util import (
 )
 import math
 from electrumx.lib.tx import Tx
-from electrumx.server.db import FlushData, COMP_TXID_LEN, DB
+from electrumx.server.db import (
+    FlushData, COMP_TXID_LEN, DB, AtomicalsUtxoCache, DataCache, NestedDataCache
+)
 from electrumx.server.history import TXNUM_LEN
 from electrumx.lib.util_atomicals import (
     is_within_acceptable_blocks_for_general_reveal,
@@ -54,12 +59,14 @@ from electrumx.lib.util_atomicals import (
     is_valid_regex,
     unpack_mint_info, 
     parse_protocols_operations_from_witness_array, 
+    has_atomicals_envelope,
     location_id_bytes_to_compact, 
     is_valid_subrealm_string_name, 
     is_valid_realm_string_name, 
     is_valid_ticker_string, 
     get_mint_info_op_factory,
     convert_db_mint_info_to_rpc_mint_info_format,
+    apply_state_mutation,
     calculate_latest_state_from_mod_history,
     validate_rules_data,
     AtomicalsValidationError,
@@ -93,6 +100,25 @@ ATOMICAL_ID_LEN = 36
 LOCATION_ID_LEN = 36
 TX_OUTPUT_IDX_LEN = 4
 
+
+def parse_block_operations(coin, raw_block, height, allow_args_bytes):
+    '''Return a map of tx index to the Atomicals operation found in the tx witness.
+
+    Witness scanning and payload decoding are pure CPU work, so this runs in
+    a worker process while the preceding blocks are applied to the chain state.
+    '''
+    # Most blocks have no envelope at all and need not be deserialized
+    if not has_atomicals_envelope(raw_block):
+        return {}
+    block = coin.block(raw_block, height)
+    operations_by_tx = {}
+    for tx_idx, (tx, tx_hash) in enumerate(block.transactions):
+        operations_found_at_inputs = parse_protocols_operations_from_witness_array(tx, tx_hash, allow_args_bytes)
+        if operations_found_at_inputs:
+            operations_by_tx[tx_idx] = operations_found_at_inputs
+    return operations_by_tx
+
+
 class Prefetcher:
     '''Prefetches blocks (in the forward direction only).'''
 
@@ -229,6 +255,10 @@ class BlockProcessor:
     Coordinate backing up in case of chain reorganisations.
     '''
 
+    # Bounds on the adaptive interval between cache size checks
+    MIN_CACHE_CHECK_SECS = 1
+    MAX_CACHE_CHECK_SECS = 30
+
     def __init__(self, env: 'Env', db: DB, daemon: Daemon, notifications: 'Notifications'):
         self.env = env
         self.db = db
@@ -246,6 +276,9 @@ class BlockProcessor:
 
         # Meta
         self.next_cache_check = 0
+        self.last_cache_check = (0, 0)  # (time, total cache bytes)
+        self.cache_growth_rate = 0      # Cache bytes per second while syncing
+        self.last_flush_stats = (0, 0)  # (cache bytes flushed, seconds taken)
         self.touched = set()
         self.reorg_count = 0
         self.height = -1
@@ -263,19 +296,30 @@ class BlockProcessor:
 
         # UTXO cache
         self.utxo_cache = {}
-        self.atomicals_utxo_cache = {}      # The cache of atomicals UTXOs
-        self.general_data_cache = {}        # General data cache for atomicals related actions
-        self.ticker_data_cache = {}         # Caches the tickers created
-        self.realm_data_cache = {}          # Caches the realms created
-        self.subrealm_data_cache = {}       # Caches the subrealms created
-        self.subrealmpay_data_cache = {}    # Caches the subrealmpays created
-        self.dmitem_data_cache = {}         # Caches the dmitems created
-        self.dmpay_data_cache = {}          # Caches the dmitems payments created
-        self.container_data_cache = {}      # Caches the containers created
-        self.distmint_data_cache = {}       # Caches the distributed mints created
-        self.state_data_cache = {}          # Caches the state updates
-        self.op_data_cache = {}             # Caches the tx op
+        self.atomicals_utxo_cache = AtomicalsUtxoCache()      # The cache of atomicals UTXOs
+        self.general_data_cache = DataCache()           # General data cache for atomicals related actions
+        self.ticker_data_cache = NestedDataCache()      # Caches the tickers created
+        self.realm_data_cache = NestedDataCache()       # Caches the realms created
+        self.subrealm_data_cache = NestedDataCache()    # Caches the subrealms created
+        self.subrealmpay_data_cache = NestedDataCache() # Caches the subrealmpays created
+        self.dmitem_data_cache = NestedDataCache()      # Caches the dmitems created
+        self.dmpay_data_cache = NestedDataCache()       # Caches the dmitems payments created
+        self.container_data_cache = NestedDataCache()   # Caches the containers created
+        self.distmint_data_cache = NestedDataCache()    # Caches the distributed mints created
+        self.state_data_cache = NestedDataCache()       # Caches the state updates
+        self.op_data_cache = DataCache()                # Caches the tx op
+        self.op_history_cache = NestedDataCache()       # Caches the history of each hashX by tx op
         self.db_deletes = []
+        # DB entries of the UTXOs spent by the blocks being advanced, read
+        # ahead in key order.  Maps tx_hash + tx_idx to (hdb_key, udb_key, value)
+        self.spent_utxo_prefetch = {}
+
+        # The FlushData frozen for a background flush until it commits, and
+        # its estimated memory size.  Blocks are processed meanwhile against
+        # fresh caches that read through to it.
+        self.flushing = None
+        self.flushing_size = 0
+        self.background_flush_task = None
 
         # If the lock is successfully acquired, in-memory chain state
         # is consistent with self.height
@@ -288,7 +332,20 @@ class BlockProcessor:
         self.atomicals_rpc_format_cache = pylru.lrucache(100000)
         self.atomicals_rpc_general_cache = pylru.lrucache(100000)
         self.atomicals_dft_mint_count_cache = pylru.lrucache(1000)        # tracks number of minted tokens per dft mint to make processing faster per blocks
-  
+        self.atomicals_rules_cache = pylru.lrucache(10000)                # compiled mint rules of a parent atomical by namespace and mod state version
+        # Guards the rules cache, used by both the block processing thread and the RPC handlers
+        self.atomicals_rules_cache_lock = threading.Lock()
+        # The RPC info caches keep the info of an atomical until a block touches it.  Bumped by
+        # each block and flush so that info read while either was in progress is not cached
+        self.atomicals_cache_epoch = 0
+        # The atomicals touched by blocks whose UTXO writes are not committed.  Their RPC info
+        # may have been cached from the DB since, so it is invalidated again at the commit
+        self.unflushed_touched_atomical_ids = set()
+
+        # Worker processes pre-parsing the witness operations of upcoming blocks
+        self.block_parse_workers = env.block_parse_workers
+        self.block_parse_executor = None
+
     async def run_in_thread_with_lock(self, func, *args):
         # Run in a thread to prevent blocking.  Shielded so that
         # cancellations from shutdown don't lose work - when the task
@@ -307,15 +364,28 @@ class BlockProcessor:
         if not raw_blocks:
             return
         first = self.height + 1
-        blocks = [self.coin.block(raw_block, first + n)
-                  for n, raw_block in enumerate(raw_blocks)]
+        # Hand the witness scanning to the workers first so it overlaps with
+        # deserialization here and with applying the earlier blocks
+        operations_futures = self.submit_block_operations(raw_blocks, first)
+        try:
+            await self._check_and_advance_blocks(raw_blocks, first, operations_futures)
+        finally:
+            # Stop the workers parsing blocks that were not advanced, as on a
+            # reorg or if advancing raised; finished futures ignore this
+            self.cancel_block_operations(operations_futures)
+
+    async def _check_and_advance_blocks(self, raw_blocks, first, operations_futures):
+        def deserialize_blocks():
+            return [self.coin.block(raw_block, first + n)
+                    for n, raw_block in enumerate(raw_blocks)]
+        blocks = await run_in_thread(deserialize_blocks)
         headers = [block.header for block in blocks]
         hprevs = [self.coin.header_prevhash(h) for h in headers]
         chain = [self.tip] + [self.coin.header_hash(h) for h in headers[:-1]]
 
         if hprevs == chain:
             start = time.monotonic()
-            await self.run_in_thread_with_lock(self.advance_blocks, blocks)
+            await self.run_in_thread_with_lock(self.advance_blocks, blocks, operations_futures)
             await self._maybe_flush()
             if not self.db.first_sync:
                 s = '' if len(blocks) == 1 else 's'
@@ -326,8 +396,10 @@ class BlockProcessor:
                 await self.notifications.on_block(self.touched, self.height)
             self.touched = set()
         elif hprevs[0] != chain[0]:
+            self.cancel_block_operations(operations_futures)
             await self.reorg_chain()
         else:
+            self.cancel_block_operations(operations_futures)
             # It is probably possible but extremely rare that what
             # bitcoind returns doesn't form a chain because it
             # reorg-ed the chain as it was processing the batched
@@ -362,6 +434,8 @@ class BlockProcessor:
             # harmless, but remove None.
             self.touched.discard(None)
             self.db.flush_backup(self.flush_data(), self.touched)
+            # Info may have been cached from the DB since the blocks were backed up
+            self.clear_atomicals_caches()
 
         _start, last, hashes = await self.reorg_hashes(count)
         # Reverse and convert to hex strings.
@@ -443,12 +517,25 @@ class BlockProcessor:
                          self.atomicals_undo_infos, self.atomicals_utxo_cache, self.general_data_cache, self.ticker_data_cache, 
                          self.realm_data_cache, self.subrealm_data_cache, self.subrealmpay_data_cache, self.dmitem_data_cache, 
                          self.dmpay_data_cache, self.container_data_cache, self.distmint_data_cache, self.state_data_cache,
-                         self.op_data_cache)
+                         self.op_data_cache, self.op_history_cache)
 
     async def flush(self, flush_utxos):
+        await self.wait_for_background_flush()
+
         def flush():
+            sizes = self.cache_sizes()
+            flushed = sizes['history'] + sizes['tx hashes']
+            if flush_utxos:
+                flushed = sum(sizes.values())
+            start = time.monotonic()
+            flushed_distmints = list(self.distmint_data_cache) if flush_utxos else []
             self.db.flush_dbs(self.flush_data(), flush_utxos,
                               self.estimate_txs_remaining)
+            self.forget_dft_mint_counts(flushed_distmints)
+            if flush_utxos:
+                self.invalidate_atomicals_rpc_info(self.unflushed_touched_atomical_ids)
+                self.unflushed_touched_atomical_ids = set()
+            self.last_flush_stats = (flushed, time.monotonic() - start)
         await self.run_in_thread_with_lock(flush)
 
     async def _maybe_flush(self):
@@ -459,35 +546,232 @@ class BlockProcessor:
         elif time.monotonic() > self.next_cache_check:
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
-            self.next_cache_check = time.monotonic() + 30
+                if flush_arg and self.flushes_in_background():
+                    await self.start_background_flush()
+                else:
+                    await self.flush(flush_arg)
+            self.next_cache_check = time.monotonic() + self.cache_check_interval()
+
+    # The caches of Atomicals data that read through to a frozen cache
+    LAYERED_CACHES = (
+        'general_data_cache', 'ticker_data_cache', 'realm_data_cache',
+        'subrealm_data_cache', 'subrealmpay_data_cache', 'dmitem_data_cache',
+        'dmpay_data_cache', 'container_data_cache', 'distmint_data_cache',
+        'state_data_cache', 'op_data_cache', 'op_history_cache',
+    )
+
+    def freeze_caches(self):
+        '''Return the flush data of the caches, replacing them with empty
+        caches that read through to them.  The lock must be taken.'''
+        sizes = self.cache_sizes()
+        flush_data = self.flush_data()
+        flush_data.history = self.db.history.freeze_unflushed()
+        self.flushing = flush_data
+        # The tx hashes are counted until written to the file system
+        self.flushing_size = sum(sizes.values()) - sizes['tx hashes']
+        self.headers = []
+        self.tx_hashes = []
+        self.undo_infos = []
+        self.atomicals_undo_infos = []
+        self.utxo_cache = {}
+        self.db_deletes = []
+        self.atomicals_utxo_cache = AtomicalsUtxoCache()
+        for name in self.LAYERED_CACHES:
+            frozen = getattr(self, name)
+            cache = frozen.__class__()
+            cache.frozen = frozen
+            setattr(self, name, cache)
+        return flush_data
+
+    def thaw_caches(self):
+        '''Stop reading through to the frozen caches once they are committed,
+        and return them.  The lock must be taken.'''
+        frozen = [self.flushing.adds, self.flushing.atomicals_adds]
+        for name in self.LAYERED_CACHES:
+            cache = getattr(self, name)
+            frozen.append(cache.frozen)
+            cache.frozen = None
+        self.flushing = None
+        self.flushing_size = 0
+        return frozen
+
+    async def start_background_flush(self):
+        '''Flush all the caches in the background while blocks are processed.
+
+        The file system data, history and UTXO batch are written without
+        the lock.  The batch is committed under it, between block batches,
+        so block processing sees each write either in the frozen caches
+        or in the DB but never in both.'''
+        await self.wait_for_background_flush()
+        async with self.state_lock:
+            flush_data = self.freeze_caches()
+            touched_atomical_ids = self.unflushed_touched_atomical_ids
+            self.unflushed_touched_atomical_ids = set()
+
+        async def background_flush():
+            start = time.monotonic()
+            flushed = self.flushing_size
+            commit = await run_in_thread(
+                self.db.prepare_flush, flush_data, True,
+                self.estimate_txs_remaining, True)
+
+            def commit_and_thaw():
+                commit()
+                self.forget_dft_mint_counts(self.flushing.distmint_adds)
+                self.invalidate_atomicals_rpc_info(touched_atomical_ids)
+                return self.thaw_caches()
+
+            frozen = await self.run_in_thread_with_lock(commit_and_thaw)
+            self.last_flush_stats = (flushed, time.monotonic() - start)
+
+            # Free the frozen caches off the event loop
+            def release():
+                for cache in frozen:
+                    cache.clear()
+            await run_in_thread(release)
+
+        self.background_flush_task = asyncio.ensure_future(background_flush())
+
+    async def wait_for_background_flush(self):
+        '''Wait for a background flush to commit, raising any error it had.'''
+        task, self.background_flush_task = self.background_flush_task, None
+        if task is not None:
+            await task
+
+    def cache_sizes(self):
+        '''The estimated memory in bytes of each cache of unflushed items.'''
+        # Good average estimates based on traversal of subobjects and
+        # requesting size from Python (see deep_getsizeof).  The Atomicals
+        # caches track their own size as entries are added and removed.
+        name_caches = (self.ticker_data_cache, self.realm_data_cache,
+                       self.subrealm_data_cache, self.subrealmpay_data_cache,
+                       self.dmitem_data_cache, self.dmpay_data_cache,
+                       self.container_data_cache)
+        return {
+            'utxos': len(self.utxo_cache) * 205,
+            'db deletes': len(self.db_deletes) * 57,
+            'atomicals utxos': self.atomicals_utxo_cache.memsize(),
+            'general data': self.general_data_cache.memsize(),
+            'names': sum(cache.memsize() for cache in name_caches),
+            'distmints': self.distmint_data_cache.memsize(),
+            'state': self.state_data_cache.memsize(),
+            'ops': self.op_data_cache.memsize() + self.op_history_cache.memsize(),
+            'history': self.db.history.unflushed_memsize(),
+            'flushing': self.flushing_size,
+            # Roughly ntxs * 32 + nblocks * 42
+            'tx hashes': ((self.tx_count - self.db.fs_tx_count) * 32
+                          + (self.height - self.db.fs_height) * 42),
+        }
 
     def check_cache_size(self):
         '''Flush a cache if it gets too big.'''
-        # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
         one_MB = 1000*1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
-        hist_cache_size = self.db.history.unflushed_memsize()
-        # Roughly ntxs * 32 + nblocks * 42
-        tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
-                        + (self.height - self.db.fs_height) * 42)
-        utxo_MB = (db_deletes_size + utxo_cache_size) // one_MB
-        hist_MB = (hist_cache_size + tx_hash_size) // one_MB
+        sizes = self.cache_sizes()
+        hist_size = sizes['history'] + sizes['tx hashes']
+        total_size = sum(sizes.values())
+        utxo_MB = (total_size - hist_size) // one_MB
+        hist_MB = hist_size // one_MB
 
         self.logger.info(f'our height: {self.height:,d} daemon: '
                          f'{self.daemon.cached_height():,d} '
                          f'UTXOs {utxo_MB:,d}MB hist {hist_MB:,d}MB')
 
+        # Track the growth rate to schedule the next check
+        now = time.monotonic()
+        last_time, last_size = self.last_cache_check
+        if last_time and total_size > last_size:
+            self.cache_growth_rate = (total_size - last_size) / (now - last_time)
+        self.last_cache_check = (now, total_size)
+
         # Flush history if it takes up over 20% of cache memory.
         # Flush UTXOs once they take up 80% of cache memory.
+        # Both include the growth projected while the caches are flushed.
+        flush_growth_MB = int(self.flush_growth(total_size)) // one_MB
         cache_MB = self.env.cache_MB
-        if utxo_MB + hist_MB >= cache_MB or hist_MB >= cache_MB // 5:
-            return utxo_MB >= cache_MB * 4 // 5
+        if utxo_MB + hist_MB + flush_growth_MB >= cache_MB or hist_MB >= cache_MB // 5:
+            return utxo_MB + flush_growth_MB >= cache_MB * 4 // 5
         return None
 
-    def advance_blocks(self, blocks):
+    def flushes_in_background(self):
+        # Chunked flushes rewrite their journal when committed, which
+        # would hold up the blocks processed meanwhile
+        return self.env.background_flush and not self.env.flush_batch_MB
+
+    def flush_growth(self, size):
+        '''Bytes the caches are projected to grow by while size bytes of them
+        are flushed.
+
+        A background flush keeps the caches it flushes in memory while
+        blocks are processed, so it must start early enough for the growth
+        at the measured rate, over the time the last flush's throughput
+        gives for size bytes, to fit the budget.'''
+        flushed, elapsed = self.last_flush_stats
+        if not self.flushes_in_background() or not flushed:
+            return 0
+        return self.cache_growth_rate * size * elapsed / flushed
+
+    def cache_check_interval(self):
+        '''Seconds until the cache size is next checked.
+
+        The caches must not outgrow the memory budget before the next
+        check, so check again once half the remaining headroom, less the
+        growth projected during a flush, is projected to be used at the
+        measured growth rate.  After a flush the growth since the last
+        check is unknown, so the last rate is kept.'''
+        _, size = self.last_cache_check
+        headroom = self.env.cache_MB * 1000 * 1000 - size - self.flush_growth(size)
+        if self.cache_growth_rate <= 0:
+            return self.MAX_CACHE_CHECK_SECS
+        interval = headroom / self.cache_growth_rate / 2
+        return min(max(interval, self.MIN_CACHE_CHECK_SECS), self.MAX_CACHE_CHECK_SECS)
+
+    def cache_info(self):
+        '''Cache memory use and flush statistics for getinfo.'''
+        one_MB = 1000*1000
+        sizes = self.cache_sizes()
+        flushed, elapsed = self.last_flush_stats
+        info = {name: f'{size / one_MB:,.1f}MB' for name, size in sizes.items()}
+        info.update({
+            'total': f'{sum(sizes.values()) / one_MB:,.1f}MB',
+            'budget': f'{self.env.cache_MB:,d}MB',
+            'growth': f'{self.cache_growth_rate / one_MB:,.2f}MB/s',
+            'next check': f'{max(self.next_cache_check - time.monotonic(), 0):.1f}s',
+            'last flush': f'{flushed / one_MB:,.1f}MB in {elapsed:.1f}s',
+            'flush rate': f'{flushed / one_MB / elapsed if elapsed else 0:,.1f}MB/s',
+        })
+        return info
+
+    def submit_block_operations(self, raw_blocks, first):
+        '''Queue the witness scan of each activated block on the worker pool.
+
+        Returns a list with one future (or None to parse inline) per block.
+        '''
+        if self.block_parse_workers <= 0:
+            return [None] * len(raw_blocks)
+        if self.block_parse_executor is None:
+            self.block_parse_executor = ProcessPoolExecutor(max_workers=self.block_parse_workers)
+        operations_futures = []
+        for n, raw_block in enumerate(raw_blocks):
+            height = first + n
+            if self.is_atomicals_activated(height):
+                operations_futures.append(self.block_parse_executor.submit(
+                    parse_block_operations, self.coin, raw_block, height,
+                    self.is_density_activated(height)))
+            else:
+                operations_futures.append(None)
+        return operations_futures
+
+    def cancel_block_operations(self, operations_futures):
+        for future in operations_futures:
+            if future:
+                future.cancel()
+
+    def shutdown_block_parse_executor(self):
+        if self.block_parse_executor is not None:
+            self.block_parse_executor.shutdown(wait=False, cancel_futures=True)
+            self.block_parse_executor = None
+
+    def advance_blocks(self, blocks, operations_futures=None):
         '''Synchronously advance the blocks.
 
         It is already verified they correctly connect onto our tip.
@@ -495,17 +779,34 @@ class BlockProcessor:
         min_height = self.db.min_undo_height(self.daemon.cached_height())
         height = self.height
         genesis_activation = self.coin.GENESIS_ACTIVATION
+        if operations_futures is None:
+            operations_futures = [None] * len(blocks)
+        if self.env.batch_utxo_lookups:
+            self.prefetch_spent_utxos(blocks)
 
-        for block in blocks:
+        for block, operations_future in zip(blocks, operations_futures):
             height += 1
             is_unspendable = (is_unspendable_genesis if height >= genesis_activation
                               else is_unspendable_legacy)
-            undo_info, atomicals_undo_info = self.advance_txs(block.transactions, is_unspendable, block.header, height)
+            if operations_future:
+                # Blocks until the workers finished this block; later ones keep parsing
+                try:
+                    operations_by_tx = operations_future.result()
+                except futures.CancelledError:
+                    # The caller was cancelled and cancelled the parsing; parse inline
+                    operations_by_tx = None
+            elif not has_atomicals_envelope(block.raw):
+                # No tx of the block has an operation, skip the witness scan of each tx
+                operations_by_tx = {}
+            else:
+                operations_by_tx = None
+            undo_info, atomicals_undo_info = self.advance_txs(block.transactions, is_unspendable, block.header, height, operations_by_tx)
             if height >= min_height:
                 self.undo_infos.append((undo_info, height))
                 self.atomicals_undo_infos.append((atomicals_undo_info, height))
                 self.db.write_raw_block(block.raw, height)
 
+        self.spent_utxo_prefetch = {}
         headers = [block.header for block in blocks]
         self.height = height
         self.headers += headers
@@ -796,23 +1097,14 @@ class BlockProcessor:
     # Mints are only stored if they are less than the max_mints amount
     def put_decentralized_mint_data(self, atomical_id, location_id, value): 
         self.logger.debug(f'put_decentralized_mint_data: atomical_id={atomical_id.hex()}, location_id={location_id.hex()}, value={value.hex()}')
-        if self.distmint_data_cache.get(atomical_id) == None: 
-            self.distmint_data_cache[atomical_id] = {}
-        self.distmint_data_cache[atomical_id][location_id] = value
+        self.distmint_data_cache.put(atomical_id, location_id, value)
 
     # Save atomicals UTXO to cache that will be flushed to db
     def put_atomicals_utxo(self, location_id, atomical_id, value): 
         self.logger.debug(f'put_atomicals_utxo: atomical_id={location_id_bytes_to_compact(atomical_id)}, location_id={location_id_bytes_to_compact(location_id)}, value={value.hex()}')
-        cache = self.atomicals_utxo_cache.get(location_id)
-        if cache is None:
-            cache = {}
-        # Use a tombstone to mark deleted because even if it's removed we must
-        # store the b'i' value
-        cache[atomical_id] = {
-            'deleted': False,
-            'value': value
-        }
-        self.atomicals_utxo_cache[location_id] = cache
+        # Spending sets a tombstone to mark it deleted because even if it's
+        # removed we must store the b'i' value
+        self.atomicals_utxo_cache.put(location_id, atomical_id, value)
 
     def get_distmints_by_atomical_id(self, atomical_id, limit, offset):
         def lookup_gi_entries(atomical_id):
@@ -832,7 +1124,7 @@ class BlockProcessor:
         return lookup_gi_entries(atomical_id)
 
     # Get the total number of distributed mints for an atomical id and check the cache and db
-    # This can be a heavy operation with many 10's of thousands in the db
+    # The db part is a single read of the b'gc' counter maintained on flush
     def get_distmints_count_by_atomical_id(self, height, atomical_id, use_block_db_cache):
         # Count the number of mints in the cache and add it to the number of mints in the db below
         cache_count = 0
@@ -841,12 +1133,13 @@ class BlockProcessor:
             cache_count = len(location_map_for_atomical)
         
         def lookup_db_count(atomical_id):
-            # Query all the gi key in the db for the atomical
-            prefix = b'gi' + atomical_id
-            count = 0
-            for atomical_gi_db_key, atomical_gi_db_value in self.db.utxo_db.iterator(prefix=prefix):
-                count += 1
-            return count 
+            # The b'gc' counter tracks the number of b'gi' keys in the db for the atomical
+            count = self.db.get_distmint_count(atomical_id)
+            if self.env.dft_mint_count_audit:
+                scanned_count = self.db.count_distmints_by_scan(atomical_id)
+                if scanned_count != count:
+                    raise IndexError(f'get_distmints_count_by_atomical_id - mint counter mismatch: atomical_id={location_id_bytes_to_compact(atomical_id)} counter={count} scanned={scanned_count}')
+            return count
 
         db_count = 0
         # If we use the block db cache then check the cache for the cached mints from the db
@@ -875,13 +1168,13 @@ class BlockProcessor:
         '''Spend the atomicals entry for UTXO and return atomicals[].'''
         idx_packed = pack_le_uint32(tx_idx)
         location_id = tx_hash + idx_packed
-        cache_map = self.atomicals_utxo_cache.get(location_id)
-        if cache_map:
-            self.logger.debug(f'spend_atomicals_utxo: cache_map. location_id={location_id_bytes_to_compact(location_id)} has Atomicals...')
+        atomicals_utxos = self.atomicals_utxo_cache.get(location_id)
+        if atomicals_utxos:
+            self.logger.debug(f'spend_atomicals_utxo: atomicals_utxo_cache. location_id={location_id_bytes_to_compact(location_id)} has Atomicals...')
             atomicals_data_list_cached = []
-            for key in cache_map.keys(): 
-                value_with_tombstone = cache_map[key]
-                value = value_with_tombstone['value']
+            for atomicals_utxo in atomicals_utxos:
+                key = atomicals_utxo.atomical_id
+                value = atomicals_utxo.value
                 atomicals_data_list_cached.append({
                     'atomical_id': key,
                     'location_id': location_id,
@@ -889,24 +1182,42 @@ class BlockProcessor:
                     'data_ex': expand_spend_utxo_data(value)
                 })
                 if live_run:
-                    value_with_tombstone['found_in_cache'] = True
-                    value_with_tombstone['deleted'] = True  # Flag it as deleted so the b'a' active location will not be written on flushed
-                self.logger.debug(f'spend_atomicals_utxo: cache_map. key={key}, location_id={location_id_bytes_to_compact(location_id)} atomical_id={location_id_bytes_to_compact(key)}, value={value}')
+                    atomicals_utxo.deleted = True  # Flag it as deleted so the b'a' active location will not be written on flushed
+                self.logger.debug(f'spend_atomicals_utxo: atomicals_utxo_cache. key={key}, location_id={location_id_bytes_to_compact(location_id)} atomical_id={location_id_bytes_to_compact(key)}, value={value}')
             if len(atomicals_data_list_cached) > 0:
                 return atomicals_data_list_cached
+        # Then the Atomicals being flushed in the background.  Their records
+        # are being written so are not changed; the next flush deletes the
+        # active b'a' entries instead
+        if self.flushing:
+            atomicals_utxos = self.flushing.atomicals_adds.get(location_id)
+            if atomicals_utxos:
+                atomicals_data_list_flushing = []
+                for atomicals_utxo in atomicals_utxos:
+                    atomical_id = atomicals_utxo.atomical_id
+                    value = atomicals_utxo.value
+                    atomicals_data_list_flushing.append({
+                        'atomical_id': atomical_id,
+                        'location_id': location_id,
+                        'data': value,
+                        'data_ex': expand_spend_utxo_data(value)
+                    })
+                    if live_run and not atomicals_utxo.deleted:
+                        self.delete_general_data(b'a' + atomical_id + location_id)
+                return atomicals_data_list_flushing
+        # Most spent outputs carry no Atomicals; skip the DB entirely when the
+        # filter says the location never had an active b'a' entry
+        atomicals_data_list = []
+        if not self.db.may_have_active_atomicals(location_id):
+            return atomicals_data_list
         # Search the locations of existing atomicals
         # Key:  b'i' + location(tx_hash + txout_idx) + atomical_id(mint_tx_hash + mint_txout_idx)
         # Value: hashX + scripthash + value
         prefix = b'i' + location_id
-        found_at_least_one = False
-        atomicals_data_list = []
         for atomical_i_db_key, atomical_i_db_value in self.db.utxo_db.iterator(prefix=prefix):
             # Get all of the atomicals for an address to be deleted
             atomical_id = atomical_i_db_key[1 + ATOMICAL_ID_LEN:]
-            prefix = b'a' + atomical_id + location_id
-            found_at_least_one = False
-            for atomical_a_db_key, atomical_a_db_value in self.db.utxo_db.iterator(prefix=prefix):
-                found_at_least_one = True
+            found_at_least_one = self.db.utxo_db.get(b'a' + atomical_id + location_id) is not None
             # For live_run == True we must throw an exception since the b'a' record should always be there when we are spending
             if live_run and found_at_least_one == False: 
                 raise IndexError(f'Did not find expected at least one entry for atomicals table for atomical: {location_id_bytes_to_compact(atomical_id)} at location {location_id_bytes_to_compact(location_id)}')
@@ -927,16 +1238,19 @@ class BlockProcessor:
 
     # Function to cache and eventually flush the mod, modpath, evt, and evtpath updates
     def put_state_data(self, db_key_prefix, db_key_suffix, db_value): 
-        if not self.state_data_cache.get(db_key_prefix):
-            self.state_data_cache[db_key_prefix] = {}
-        self.state_data_cache[db_key_prefix][db_key_suffix] = db_value
+        self.state_data_cache.put(db_key_prefix, db_key_suffix, db_value)
+        # A new mod changes the rules of the atomical
+        if db_key_prefix[:3] == b'mod':
+            with self.atomicals_rules_cache_lock:
+                if db_key_prefix[3:] in self.atomicals_rules_cache:
+                    del self.atomicals_rules_cache[db_key_prefix[3:]]
     
     # Function to cache and eventually flush the mod, modpath, evt, and evtpath updates
     def delete_state_data(self, db_key_prefix, db_key_suffix, expected_entry_value): 
         state_map = self.state_data_cache.get(db_key_prefix)
         cached_value = None
         if state_map:
-            cached_value = state_map.pop(db_key_suffix, None)
+            cached_value = self.state_data_cache.pop_entry(db_key_prefix, db_key_suffix)
             if cached_value != expected_entry_value:
                 raise IndexError(f'IndexError: delete_state_data cache data does not match expected value {expected_entry_value} {db_value}')
             # return  intentionally fall through to catch in db just in case
@@ -967,15 +1281,26 @@ class BlockProcessor:
             self.logger.debug(f'add the {op} op transaction detail for {hash_to_hex_str(tx_hash)}')
             self.op_data_cache[op_prefix_key] = pack_le_uint32(op_num)
 
+    # Function to cache and eventually flush the op history of a tx across the chain and of its hashXs
+    # It indexes the tx under its op, the last one put for the tx
+    def put_op_history(self, tx_num, hashXs):
+        tx_op = self.op_data_cache.get(b'op' + pack_le_uint64(tx_num))
+        if not tx_op:
+            return
+        # Op numbers fit in the low byte of the le_uint32
+        op = tx_op[:1]
+        be_tx_num = pack_be_uint64(tx_num)[-TXNUM_LEN:]
+        self.op_history_cache.put(b'v' + op, be_tx_num, b'')
+        for hashX in set(hashXs):
+            self.op_history_cache.put(b'x' + hashX + op, be_tx_num, b'')
+
     # Function to put the container, realm, and ticker names to the db.
     # This does not handle subrealms, because subrealms have a payment component and are handled slightly differently in another method
     def put_name_element_template(self, db_prefix_key, optional_subject_prefix, subject, tx_num, payload_value, name_data_cache): 
         self.logger.debug(f'put_name_element_template: db_prefix_key={db_prefix_key}, optional_subject_prefix={optional_subject_prefix}, subject={subject}, tx_num={tx_num}, payload_value={payload_value.hex()}')
         subject_enc = subject.encode()
         record_key = db_prefix_key + optional_subject_prefix + subject_enc + pack_le_uint32(len(subject_enc))
-        if not name_data_cache.get(record_key):
-            name_data_cache[record_key] = {}
-        name_data_cache[record_key][tx_num] = payload_value
+        name_data_cache.put(record_key, tx_num, payload_value)
 
     # Function to delete the container, realm, and ticker names from the db.
     # This does not handle subrealms, because subrealms have a payment component and are handled slightly differently in another method
@@ -992,7 +1317,7 @@ class BlockProcessor:
                 if cached_value != expected_entry_value:
                     raise IndexError(f'IndexError: delete_name_element_template cache name data does not match expected value {db_delete_prefix} {subject} {tx_num} {expected_entry_value} {cached_value}')
                 # remove from the cache
-                name_map.pop(tx_num)
+                name_data_cache.pop_entry(record_key, tx_num)
             # Intentionally fall through to catch it in the db as well just in case
         
         # Check the db whether or not it was in the cache as a safety measure (todo: Can be removed later as codebase proves robust)
@@ -1008,9 +1333,7 @@ class BlockProcessor:
     def put_pay_record(self, atomical_id, tx_num, payload_value, db_prefix, pay_data_cache): 
         self.logger.debug(f'put_pay_record: db_prefix={db_prefix} atomical_id={location_id_bytes_to_compact(atomical_id)}, tx_num={tx_num}, payload_value={payload_value.hex()}')
         record_key = db_prefix + atomical_id
-        if not pay_data_cache.get(record_key):
-            pay_data_cache[record_key] = {}
-        pay_data_cache[record_key][tx_num] = payload_value
+        pay_data_cache.put(record_key, tx_num, payload_value)
 
     def delete_pay_record(self, atomical_id, tx_num, expected_entry_value, db_prefix, pay_data_cache): 
         self.logger.debug(f'delete_pay_record: atomical_id={location_id_bytes_to_compact(atomical_id)}, tx_num={tx_num}, expected_entry_value={expected_entry_value.hex()}')
@@ -1024,7 +1347,7 @@ class BlockProcessor:
                 if cached_value != expected_entry_value:
                     raise IndexError(f'IndexError: delete_pay_record cache name data does not match expected value {atomical_id} {expected_entry_value} {cached_value}')
                 # remove from the cache
-                name_map.pop(tx_num)
+                pay_data_cache.pop_entry(record_key, tx_num)
             # Intentionally fall through to catch it in the db as well just in case
         
         # Check the db whether or not it was in the cache as a safety measure (todo: Can be removed later as codebase proves robust)
@@ -1041,7 +1364,7 @@ class BlockProcessor:
     def delete_decentralized_mint_data(self, atomical_id, location_id) -> bytes:
         cache_map = self.distmint_data_cache.get(atomical_id, None)
         if cache_map != None:
-            cache_map.pop(location_id, None)
+            self.distmint_data_cache.pop_entry(atomical_id, location_id)
             self.logger.info(f'delete_decentralized_mint_data: distmint_data_cache. location_id={location_id_bytes_to_compact(location_id)}, atomical_id={location_id_bytes_to_compact(atomical_id)}')
         gi_key = b'gi' + atomical_id + location_id
         gi_value = self.db.utxo_db.get(gi_key)
@@ -1890,10 +2213,11 @@ class BlockProcessor:
         # If we fell off to the end it means there are no pending candidates.
         return None, None, all_entries
 
-    async def get_effective_dmitems_paginated(self, parent_container_id, limit, offset, height):
+    # Returns the verified dmitems of a page of names and the cursor of the next page
+    async def get_effective_dmitems_paginated(self, parent_container_id, limit, offset, height, cursor=None):
         if limit > 100:
             limit = 100
-        dmitem_names = await self.db.get_dmitem_entries_paginated(parent_container_id, limit, offset)
+        dmitem_names, next_cursor = await self.db.get_dmitem_entries_paginated(parent_container_id, limit, offset, cursor)
         populated_entries = {}
         for dmitem_name in dmitem_names: 
             status, atomical_id, candidates = self.get_effective_dmitem(parent_container_id, dmitem_name, height)
@@ -1903,7 +2227,7 @@ class BlockProcessor:
                     'id': atomical_id,
                     '$id': location_id_bytes_to_compact(atomical_id)
                 }
-        return populated_entries
+        return populated_entries, next_cursor
 
     def get_effective_dmitem(self, parent_container_id, dmitem_name, height):
         current_height = height
@@ -2031,15 +2355,80 @@ class BlockProcessor:
                 atomical['mint_data']['fields'] = {}
         return atomical 
 
+    # The mint info fields of name requests, whose status depends on the height and on the other candidates
+    NAME_REQUEST_FIELDS = ('$request_realm', '$request_subrealm', '$request_container', '$request_dmitem', '$request_ticker')
+
+    # Get the RPC info cached at the key if it is still valid at the current height
+    def get_cached_rpc_info(self, cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        valid_height, atomical_result = entry
+        if valid_height is not None and valid_height != self.height:
+            return None
+        return atomical_result
+
+    # Cache the RPC info of an atomical read at the epoch until a block touches the atomical
+    # The info of name requests is only cached for the current height
+    def cache_rpc_info(self, cache, key, atomical_result, epoch):
+        if epoch != self.atomicals_cache_epoch:
+            return
+        mint_info = atomical_result['mint_info']
+        valid_height = None
+        if any(field in mint_info for field in self.NAME_REQUEST_FIELDS):
+            valid_height = self.height
+        cache[key] = (valid_height, atomical_result)
+
+    # Forget the cached RPC info of the atomicals touched by a block
+    def invalidate_atomicals_rpc_info(self, atomical_ids):
+        self.atomicals_cache_epoch += 1
+        format_cache = self.atomicals_rpc_format_cache
+        general_cache = self.atomicals_rpc_general_cache
+        for atomical_id in atomical_ids:
+            for cache, key in ((format_cache, atomical_id),
+                               (general_cache, b'dft_info' + atomical_id),
+                               (general_cache, b'ft_info' + atomical_id)):
+                if key in cache:
+                    del cache[key]
+
+    # Get the parent realm or container of a subrealm or dmitem, whose cached RPC info a mint invalidates
+    def get_name_parent_atomical_id(self, atomical_id):
+        mint_info = self.get_atomicals_id_mint_info(atomical_id, True)
+        if not mint_info:
+            return None
+        parent_id_compact = mint_info.get('$parent_realm') or mint_info.get('$parent_container')
+        if not parent_id_compact:
+            return None
+        return compact_to_location_id_bytes(parent_id_compact)
+
+    # Forget the cached db mint counts of the dft tickers whose mints were flushed
+    def forget_dft_mint_counts(self, atomical_ids):
+        mint_count_cache = self.atomicals_dft_mint_count_cache
+        for atomical_id in atomical_ids:
+            if atomical_id in mint_count_cache:
+                del mint_count_cache[atomical_id]
+
+    # Clear the atomicals caches, as when blocks are backed up
+    def clear_atomicals_caches(self):
+        self.atomicals_cache_epoch += 1
+        self.unflushed_touched_atomical_ids.clear()
+        self.atomicals_id_cache.clear()
+        self.atomicals_rpc_format_cache.clear()
+        self.atomicals_rpc_general_cache.clear()
+        self.atomicals_dft_mint_count_cache.clear()
+        with self.atomicals_rules_cache_lock:
+            self.atomicals_rules_cache.clear()
+
     async def get_base_mint_info_rpc_format_by_atomical_id(self, atomical_id):
-        atomical_result = self.atomicals_rpc_format_cache.get(atomical_id)
+        atomical_result = self.get_cached_rpc_info(self.atomicals_rpc_format_cache, atomical_id)
         if not atomical_result:
+            epoch = self.atomicals_cache_epoch
             atomical_result = await self.get_base_mint_info_by_atomical_id_async(atomical_id)
             if not atomical_result:
                 return None
             convert_db_mint_info_to_rpc_mint_info_format(self.coin.header_hash, atomical_result)
             self.populate_extended_field_summary_atomical_info(atomical_id, atomical_result)
-            self.atomicals_rpc_format_cache[atomical_id] = atomical_result
+            self.cache_rpc_info(self.atomicals_rpc_format_cache, atomical_id, atomical_result, epoch)
         return atomical_result
 
     # Get the atomical details base info CACHED wrapper
@@ -2047,13 +2436,14 @@ class BlockProcessor:
         if not atomical_id:
             return None
 
-        atomical_result = self.atomicals_rpc_format_cache.get(atomical_id)
+        epoch = self.atomicals_cache_epoch
+        atomical_result = self.get_cached_rpc_info(self.atomicals_rpc_format_cache, atomical_id)
         if not atomical_result:
             atomical_result = await self.get_base_mint_info_by_atomical_id_async(atomical_id)
             if not atomical_result:
                 return None 
             convert_db_mint_info_to_rpc_mint_info_format(self.coin.header_hash, atomical_result)
-            self.atomicals_rpc_format_cache[atomical_id] = atomical_result
+            self.cache_rpc_info(self.atomicals_rpc_format_cache, atomical_id, atomical_result, epoch)
 
         # format for the wire format
         if not atomical_result:
@@ -2063,12 +2453,13 @@ class BlockProcessor:
             return None 
 
         # Try to get the dft cached info
-        dft_results = self.atomicals_rpc_general_cache.get(b'dft_info' + atomical_id)
+        dft_results = self.get_cached_rpc_info(self.atomicals_rpc_general_cache, b'dft_info' + atomical_id)
         if not dft_results:
             atomical_result['dft_info'] = {
                 'mint_count': 0
             }
-            mint_count = self.get_distmints_count_by_atomical_id(self.height, atomical_id, True)
+            # Only block processing uses the db mint counts cached between flushes
+            mint_count = self.get_distmints_count_by_atomical_id(self.height, atomical_id, False)
             atomical_result['dft_info']['mint_count'] = mint_count
             if atomical_result.get('$mint_mode') == 'perpetual': 
                 self.logger.debug(f'atomical_result={atomical_result}')
@@ -2117,34 +2508,34 @@ class BlockProcessor:
 
             atomical_result['location_summary'] = {}
             self.populate_location_info_summary(atomical_id, atomical_result['location_summary'])
-            self.atomicals_rpc_general_cache[b'dft_info' + atomical_id] = atomical_result
+            self.cache_rpc_info(self.atomicals_rpc_general_cache, b'dft_info' + atomical_id, atomical_result, epoch)
             return atomical_result 
         return dft_results
        
     # Populate location information
+    # The db part is a single read of the b'y' summary maintained on flush
     def populate_location_info_summary(self, atomical_id, atomical_result):
-        unique_holders = {}
-        active_supply = 0
-        atomical_active_location_key_prefix = b'a' + atomical_id
-        for atomical_active_location_key, atomical_active_location_value in self.db.utxo_db.iterator(prefix=atomical_active_location_key_prefix):
-            location_value, = unpack_le_uint64(atomical_active_location_value[HASHX_LEN + SCRIPTHASH_LEN : HASHX_LEN + SCRIPTHASH_LEN + 8])
-            active_supply += location_value
-            scripthash = atomical_active_location_value[HASHX_LEN : HASHX_LEN + SCRIPTHASH_LEN]  
-            unique_holders[scripthash] = True
-        atomical_result['unique_holders'] = len(unique_holders)
+        active_supply, unique_holders = self.db.get_location_summary(atomical_id)
+        if self.env.active_supply_audit:
+            scanned = self.db.scan_location_summary(atomical_id)
+            if scanned != (active_supply, unique_holders):
+                self.logger.error(f'populate_location_info_summary - location summary mismatch: atomical_id={location_id_bytes_to_compact(atomical_id)} summary={(active_supply, unique_holders)} scanned={scanned}')
+                active_supply, unique_holders = scanned
+        atomical_result['unique_holders'] = unique_holders
         atomical_result['circulating_supply'] = active_supply
 
     # Get the atomical details base info CACHED wrapper
     async def get_ft_mint_info_rpc_format_by_atomical_id(self, atomical_id):
         if not atomical_id:
             return None
-        atomical_result = self.atomicals_rpc_format_cache.get(atomical_id)
+        epoch = self.atomicals_cache_epoch
+        atomical_result = self.get_cached_rpc_info(self.atomicals_rpc_format_cache, atomical_id)
         if not atomical_result:
             atomical_result = await self.get_base_mint_info_by_atomical_id_async(atomical_id)
             if not atomical_result:
                 return None 
             convert_db_mint_info_to_rpc_mint_info_format(self.coin.header_hash, atomical_result)
-            self.atomicals_rpc_format_cache[atomical_id] = atomical_result
+            self.cache_rpc_info(self.atomicals_rpc_format_cache, atomical_id, atomical_result, epoch)
 
         # format for the wire format
         if not atomical_result:
@@ -2152,13 +2543,13 @@ class BlockProcessor:
         if atomical_result['type'] != 'FT':
             return None 
 
-        ft_results = self.atomicals_rpc_general_cache.get(b'ft_info' + atomical_id)
+        ft_results = self.get_cached_rpc_info(self.atomicals_rpc_general_cache, b'ft_info' + atomical_id)
         if not ft_results:
             atomical_result['ft_info'] = {
             }
             atomical_result['location_summary'] = {}
             self.populate_location_info_summary(atomical_id, atomical_result['location_summary'])
-            self.atomicals_rpc_general_cache[b'ft_info' + atomical_id] = atomical_result
+            self.cache_rpc_info(self.atomicals_rpc_general_cache, b'ft_info' + atomical_id, atomical_result, epoch)
             return atomical_result
         return ft_results
 
@@ -2325,8 +2716,7 @@ class BlockProcessor:
         atomical['$container_dmint_status'] = status
         
     def make_container_dmint_status_by_atomical_id_at_height(self, atomical_id, height):
-        rule_mint_mod_history = self.get_mod_history(atomical_id, height)
-        latest_state = calculate_latest_state_from_mod_history(rule_mint_mod_history)
+        latest_state = self.get_mod_state(atomical_id, height)
         return self.get_container_dmint_status_for_atomical_id(atomical_id, latest_state)
 
     def get_container_dmint_status_for_atomical_id(self, atomical_id, latest_state):
@@ -2779,7 +3169,8 @@ class BlockProcessor:
             txs: Sequence[Tuple[Tx, bytes]],
             is_unspendable: Callable[[bytes], bool],
             header,
-            height
+            height,
+            operations_by_tx=None
     ) -> Sequence[bytes]:
         # index = 0
         # for tx, tx_hash in txs:
@@ -2789,10 +3180,9 @@ class BlockProcessor:
         #     index+=1
 
         self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
-        self.atomicals_rpc_format_cache.clear()
-        self.atomicals_rpc_general_cache.clear()
-        self.atomicals_id_cache.clear()
-        self.atomicals_dft_mint_count_cache.clear()
+        self.atomicals_cache_epoch += 1
+        # The atomicals spent, minted or changed by the block whose cached RPC info is invalidated
+        touched_atomical_ids = set()
         # Track the Atomicals hash for the block
         # First we concatenate the previous block height hash to chain them together
         # The purpose of this is to create a unique hash fingerprint to make it easy to determine if indexers (such as this one) or other implementations
@@ -2833,7 +3223,7 @@ class BlockProcessor:
         # Speed up distmint processing by caching the ticker mint request info
         distmint_ticker_cache = {}
         dft_count = 0
-        for tx, tx_hash in txs:
+        for tx_idx, (tx, tx_hash) in enumerate(txs):
             has_at_least_one_valid_atomicals_operation = False
             hashXs = []
             append_hashX = hashXs.append
@@ -2856,6 +3246,7 @@ class BlockProcessor:
                         atomicals_spent_at_inputs[txin_index] = atomicals_transferred_list
                         for atomical_spent in atomicals_transferred_list:
                             atomical_id = atomical_spent['atomical_id']
+                            touched_atomical_ids.add(atomical_id)
                             self.logger.debug(f'atomicals_transferred_list - tx_hash={hash_to_hex_str(tx_hash)}, txin_index={txin_index}, txin_hash={hash_to_hex_str(txin.prev_hash)}, txin_previdx={txin.prev_idx}, atomical_id_spent={location_id_bytes_to_compact(atomical_id)}')
                     # Get the undo format for the spent atomicals
                     reformatted_for_undo_entries = []
@@ -2884,7 +3275,11 @@ class BlockProcessor:
                 put_general_data(b'tx' + tx_hash, to_le_uint64(tx_num) + to_le_uint32(height))
                 # Detect all protocol operations in the transaction witness inputs
                 # Only parse witness information for Atomicals if activated
-                atomicals_operations_found_at_inputs = parse_protocols_operations_from_witness_array(tx, tx_hash, self.is_density_activated(height))
+                # The worker pool may already have parsed it ahead of time
+                if operations_by_tx is not None:
+                    atomicals_operations_found_at_inputs = operations_by_tx.get(tx_idx)
+                else:
+                    atomicals_operations_found_at_inputs = parse_protocols_operations_from_witness_array(tx, tx_hash, self.is_density_activated(height))
                 if atomicals_operations_found_at_inputs:
                     # TODO
                     # Log information to help troubleshoot
@@ -2910,6 +3305,7 @@ class BlockProcessor:
                 
                 atomical_id_of_distmint = self.create_or_delete_decentralized_mint_output(atomicals_operations_found_at_inputs, tx_num, tx_hash, tx, height, distmint_ticker_cache, False)
                 if atomical_id_of_distmint:
+                    touched_atomical_ids.add(atomical_id_of_distmint)
                     dft_count += 1
                     already_found_valid_operation = True                    
                     atomical_ids_which_have_valid_dft_mints[atomical_id_of_distmint] = True
@@ -2924,6 +3320,10 @@ class BlockProcessor:
                 if not already_found_valid_operation:
                     created_atomical_id = self.create_or_delete_atomical(atomicals_operations_found_at_inputs, atomicals_spent_at_inputs, header, height, tx_num, atomical_num, tx, tx_hash, False)
                     if created_atomical_id:
+                        touched_atomical_ids.add(created_atomical_id)
+                        parent_atomical_id = self.get_name_parent_atomical_id(created_atomical_id)
+                        if parent_atomical_id:
+                            touched_atomical_ids.add(parent_atomical_id)
                         already_found_valid_operation = True
                         has_at_least_one_valid_atomicals_operation = True
                         atomical_num += 1
@@ -2974,6 +3374,8 @@ class BlockProcessor:
                     assert(_tx == tx)
                     assert(_tx_hash == tx_hash)
                     put_general_data(b'rtx' + tx_hash, raw_tx)
+
+                self.put_op_history(tx_num, hashXs)
                     
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -2984,6 +3386,8 @@ class BlockProcessor:
         # We track all the mints of a dft for their atomical ids and then perform one final lookup going straight to db as well
         # Then we ensure the max mints cannot be exceeded just in case
         self.validate_no_dft_inflation(atomical_ids_which_have_valid_dft_mints, height)
+        self.invalidate_atomicals_rpc_info(touched_atomical_ids)
+        self.unflushed_touched_atomical_ids.update(touched_atomical_ids)
 
         self.db.history.add_unflushed(hashXs_by_tx, self.tx_count)
         self.tx_count = tx_num
@@ -3125,7 +3529,7 @@ class BlockProcessor:
         if cache_mod_prefix_map:
             self.logger.debug(f'get_mod_history: cache_mod_prefix_map={cache_mod_prefix_map}')
             for state_key_suffix, state_value in cache_mod_prefix_map.items():
-                # Key: prefix_key + atomical_id + path_padded + tx_numb + tx_hash + out_idx + height
+                # Key: prefix_key + atomical_id + tx_numb + tx_hash + out_idx
                 # Unpack the tx number
                 atomical_id_key = state_key_prefix + state_key_suffix
                 tx_numb = atomical_id_key[PREFIX_BYTE_LEN + ATOMICAL_ID_LEN : PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN] 
@@ -3134,6 +3538,8 @@ class BlockProcessor:
                 tx_hash = atomical_id_key[PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN]
                 out_idx_packed = atomical_id_key[ PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN + 4]
                 out_idx, = unpack_le_uint32(out_idx_packed)
+                # The key has no height: this reads the out index, so cached mods are
+                # in effect never skipped.  Mint validation depends on that
                 height_le = atomical_id_key[-4:]
                 height, = unpack_le_uint32(height_le)
                 # Skip too high heights
@@ -3156,20 +3562,94 @@ class BlockProcessor:
         cache_mod_history.sort(key=lambda x: x['tx_num'], reverse=True)
         return cache_mod_history
 
+    # Get the cached mods of an atomical that get_mod_history returns for max_height, in tx order
+    def get_cached_mods(self, atomical_id, max_height):
+        cache_mod_prefix_map = self.state_data_cache.get(b'mod' + atomical_id)
+        cache_mods = []
+        if cache_mod_prefix_map:
+            for state_key_suffix, state_value in cache_mod_prefix_map.items():
+                # Suffix: tx_numb + tx_hash + out_idx, read as a height like get_mod_history does
+                height, = unpack_le_uint32(state_key_suffix[-4:])
+                if height > max_height:
+                    break
+                tx_num, = unpack_le_uint64(state_key_suffix[:TXNUM_LEN] + bytes(8 - TXNUM_LEN))
+                cache_mods.append((tx_num, state_value))
+            cache_mods.sort()
+        return cache_mods
+
+    def get_mod_state(self, atomical_id, height):
+        '''Return the state of an atomical folded from the mods get_mod_history
+        returns for height, combining the mod states of the db with the cached
+        mods.'''
+        if self.db.has_mods_after(atomical_id, height):
+            return calculate_latest_state_from_mod_history(self.get_mod_history(atomical_id, height))
+        state = self.db.get_mod_state(atomical_id)
+        for _tx_num, state_value in self.get_cached_mods(atomical_id, height):
+            apply_state_mutation(state, loads(state_value))
+        return state
+
+    def get_mod_state_version(self, atomical_id, height):
+        '''Return the tx_num of the last mod of an atomical folded by
+        get_mod_state for height, or None if there is none.'''
+        cache_mods = self.get_cached_mods(atomical_id, height)
+        if cache_mods:
+            return cache_mods[-1][0]
+        return self.db.get_mod_state_version(atomical_id)
+
+    # Validate the rules of the namespace in a state and compile their patterns
+    def compile_rules(self, latest_state, RULE_DATA_NAMESPACE):
+        regex_price_point_list = validate_rules_data(latest_state.get(RULE_DATA_NAMESPACE, None))
+        compiled_rules = None
+        if regex_price_point_list:
+            compiled_rules = []
+            for regex_price_point in regex_price_point_list:
+                try:
+                    valid_pattern = re.compile(rf"{regex_price_point['p']}")
+                except Exception as e:
+                    self.logger.debug(f'get_compiled_rules_by_height: exception compiling pattern e={e}')
+                    valid_pattern = None
+                compiled_rules.append((regex_price_point, valid_pattern))
+        return compiled_rules
+
+    # Get the validated rules of the namespace with their compiled patterns
+    # Cached by the mod state version, so the rules are only validated and compiled again after a mod
+    def get_compiled_rules_by_height(self, atomical_id, height, RULE_DATA_NAMESPACE):
+        # With flushed mods after height the state folds mods depending on the db key order
+        if self.db.has_mods_after(atomical_id, height):
+            return self.compile_rules(self.get_mod_state(atomical_id, height), RULE_DATA_NAMESPACE)
+        epoch = self.atomicals_cache_epoch
+        key = (RULE_DATA_NAMESPACE, self.get_mod_state_version(atomical_id, height))
+        with self.atomicals_rules_cache_lock:
+            versions = self.atomicals_rules_cache.get(atomical_id)
+            if versions is not None and key in versions:
+                return versions[key]
+        compiled_rules = self.compile_rules(self.get_mod_state(atomical_id, height), RULE_DATA_NAMESPACE)
+        with self.atomicals_rules_cache_lock:
+            # Rules read while a block was processed or backed up are not cached
+            if epoch == self.atomicals_cache_epoch:
+                versions = self.atomicals_rules_cache.get(atomical_id)
+                if versions is None:
+                    versions = self.atomicals_rules_cache[atomical_id] = {}
+                versions[key] = compiled_rules
+        return compiled_rules
+
+    # Get the validated rules of the namespace in the state of an atomical at a height
+    def get_rules_by_height(self, atomical_id, height, RULE_DATA_NAMESPACE):
+        compiled_rules = self.get_compiled_rules_by_height(atomical_id, height, RULE_DATA_NAMESPACE)
+        if compiled_rules is None:
+            return None
+        return [copy.deepcopy(regex_price_point) for regex_price_point, _ in compiled_rules]
+
     def get_applicable_rule_by_height(self, parent_atomical_id, proposed_subnameid, height, RULE_DATA_NAMESPACE):
         # Log an item with a prefix
         def print_applicable_rule_log(item):
             self.logger.debug(f'get_applicable_rule_by_height: {item}. parent_atomical_id={parent_atomical_id.hex()}, proposed_subnameid={proposed_subnameid}, height={height}')   
-        # Note: we must query the modpath history with the cache in case we have not yet flushed to disk
-        # db_key = b'modpath' + atomical_id + mod_path_padded + tx_numb + output_idx_le + height_packed 
-        rule_mint_mod_history = self.get_mod_history(parent_atomical_id, height)
-        print_applicable_rule_log(f'get_applicable_rule_by_height: rule_mint_mod_history {rule_mint_mod_history}')
-        latest_state = calculate_latest_state_from_mod_history(rule_mint_mod_history)
-        regex_price_point_list = validate_rules_data(latest_state.get(RULE_DATA_NAMESPACE, None))
-        if not regex_price_point_list:
+        # Note: the rules combine the cached mods in case we have not yet flushed to disk
+        compiled_rules = self.get_compiled_rules_by_height(parent_atomical_id, height, RULE_DATA_NAMESPACE)
+        if not compiled_rules:
             return None, None
         # match the specific regex
-        for regex_price_point in regex_price_point_list:
+        for regex_price_point, valid_pattern in compiled_rules:
             print_applicable_rule_log(f'get_applicable_rule_by_height: processing rule item regex_price_point={regex_price_point}')
             regex_pattern = regex_price_point.get('p', None)
             if not regex_pattern:
@@ -3180,17 +3660,19 @@ class BlockProcessor:
                 print_applicable_rule_log(f'get_applicable_rule_by_height: invalid regex with parens')
                 return None
 
+            if not valid_pattern:
+                print_applicable_rule_log(f'get_applicable_rule_by_height: pattern did not compile')
+                continue
+
             try:
-                # Compile the regular expression
-                valid_pattern = re.compile(rf"{regex_pattern}")
                 # Match the pattern to the proposed subrealm_name
                 if not valid_pattern.match(proposed_subnameid):
                     print_applicable_rule_log(f'get_applicable_rule_by_height: invalid pattern match')
                     continue
                 print_applicable_rule_log(f'get_applicable_rule_by_height: successfully matched pattern and price regex_pattern={regex_pattern}')
                 return {
-                    'matched_rule': regex_price_point
-                }, latest_state
+                    'matched_rule': copy.deepcopy(regex_price_point)
+                }, self.get_mod_state(parent_atomical_id, height)
             except Exception as e: 
                 print_applicable_rule_log(f'get_applicable_rule_by_height: exception matching pattern e={e}. Continuing...')
                 # If it failed, then try the next matches if any
@@ -3221,10 +3703,7 @@ class BlockProcessor:
      
         # Clear the cache just in case there are old values cached for a mint that are stale
         # In particular for $realm and $ticker values if something changed on reorg
-        self.atomicals_id_cache.clear()
-        self.atomicals_rpc_format_cache.clear()
-        self.atomicals_rpc_general_cache.clear()
-        self.atomicals_dft_mint_count_cache.clear()
+        self.clear_atomicals_caches()
 
         # Delete the Atomicals hash for the current height as we are rolling back
         self.delete_general_data(b'tt' + pack_le_uint32(self.height))
@@ -3331,15 +3810,23 @@ class BlockProcessor:
             if atomical_id_deleted:
                 atomical_num -= 1
                 atomicals_minted += 1
+                # Touch the histories the tx was added to so they are backed up
+                touched.add(double_sha256(atomical_id_deleted))
             
             # Rollback any subrealm payments
-            self.create_or_delete_subname_payment_output_if_valid(tx_hash, tx, tx_num, self.height, operations_found_at_inputs, atomicals_spent_at_inputs, b'spay', self.subrealmpay_data_cache, self.get_expected_subrealm_payment_info, True)
+            payment_tx_hash = self.create_or_delete_subname_payment_output_if_valid(tx_hash, tx, tx_num, self.height, operations_found_at_inputs, atomicals_spent_at_inputs, b'spay', self.subrealmpay_data_cache, self.get_expected_subrealm_payment_info, True)
+            if payment_tx_hash:
+                touched.add(double_sha256(payment_tx_hash))
 
             # Rollback any dmint payments
-            self.create_or_delete_subname_payment_output_if_valid(tx_hash, tx, tx_num, self.height, operations_found_at_inputs, atomicals_spent_at_inputs, b'dmpay', self.dmpay_data_cache, self.get_expected_dmitem_payment_info, True)
+            payment_tx_hash = self.create_or_delete_subname_payment_output_if_valid(tx_hash, tx, tx_num, self.height, operations_found_at_inputs, atomicals_spent_at_inputs, b'dmpay', self.dmpay_data_cache, self.get_expected_dmitem_payment_info, True)
+            if payment_tx_hash:
+                touched.add(double_sha256(payment_tx_hash))
 
             # If there were any distributed mint creation, then delete
-            self.create_or_delete_decentralized_mint_output(operations_found_at_inputs, tx_num, tx_hash, tx, self.height, {}, True)
+            atomical_id_of_distmint = self.create_or_delete_decentralized_mint_output(operations_found_at_inputs, tx_num, tx_hash, tx, self.height, {}, True)
+            if atomical_id_of_distmint:
+                touched.add(double_sha256(atomical_id_of_distmint))
 
             # Check if there were any regular 'dat' files definitions to delete
             self.create_or_delete_data_location(tx_hash, operations_found_at_inputs, True)
@@ -3437,6 +3924,26 @@ class BlockProcessor:
     collision rate is low (<0.1%).
     '''
 
+    def prefetch_spent_utxos(self, blocks):
+        '''Read the DB entries of all UTXOs the blocks spend in one sorted pass.
+
+        Outputs in the UTXO cache or created within the blocks are skipped.
+        '''
+        utxo_cache = self.utxo_cache
+        flushing_adds = self.flushing.adds if self.flushing else {}
+        block_tx_hashes = {tx_hash for block in blocks
+                           for _tx, tx_hash in block.transactions}
+        prevouts = []
+        for block in blocks:
+            for tx, _tx_hash in block.transactions:
+                for txin in tx.inputs:
+                    if txin.is_generation() or txin.prev_hash in block_tx_hashes:
+                        continue
+                    prevout = txin.prev_hash + pack_le_uint32(txin.prev_idx)
+                    if prevout not in utxo_cache and prevout not in flushing_adds:
+                        prevouts.append(prevout)
+        self.spent_utxo_prefetch = self.db.read_utxo_entries(prevouts)
+
     def spend_utxo(self, tx_hash: bytes, tx_idx: int) -> bytes:
         '''Spend a UTXO and return (hashX + tx_num + value_sats).
 
@@ -3450,6 +3957,26 @@ class BlockProcessor:
         if cache_value:
             return cache_value
 
+        # Then the UTXOs being flushed in the background, which will be in
+        # the DB before the next flush deletes them
+        if self.flushing:
+            flushing_value = self.flushing.adds.get(tx_hash + idx_packed)
+            if flushing_value:
+                hashX = flushing_value[:HASHX_LEN]
+                suffix = idx_packed + flushing_value[HASHX_LEN:HASHX_LEN + TXNUM_LEN]
+                self.delete_general_data(b'h' + tx_hash[:COMP_TXID_LEN] + suffix)
+                self.delete_general_data(b'u' + hashX + suffix)
+                return flushing_value
+
+        # Then the entries read ahead for the block
+        prefetched = self.spent_utxo_prefetch.pop(tx_hash + idx_packed, None)
+        if prefetched:
+            hdb_key, udb_key, utxo_value_packed = prefetched
+            # Remove both entries for this UTXO
+            self.delete_general_data(hdb_key)
+            self.delete_general_data(udb_key)
+            return udb_key[1:1 + HASHX_LEN] + hdb_key[-TXNUM_LEN:] + utxo_value_packed
+
         # Spend it from the DB.
         txnum_padding = bytes(8-TXNUM_LEN)
 
@@ -3542,6 +4069,8 @@ class BlockProcessor:
         except CancelledError:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.flush(True)
+        finally:
+            self.shutdown_block_parse_executor()
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
@@ -104,12 +104,21 @@ class Controller(ServerBase):
             # Set notifications up to implement the MemPoolAPI
             def get_db_height():
                 return db.db_height
+
+            def get_atomicals_at_location(tx_hash, tx_idx):
+                return bp.spend_atomicals_utxo(tx_hash, tx_idx, False)
+
+            def get_atomical_mint_info(atomical_id):
+                return bp.get_atomicals_id_mint_info(atomical_id, True)
             notifications.height = daemon.height
             notifications.db_height = get_db_height
             notifications.cached_height = daemon.cached_height
             notifications.mempool_hashes = daemon.mempool_hashes
             notifications.raw_transactions = daemon.getrawtransactions
             notifications.lookup_utxos = db.lookup_utxos
+            notifications.atomicals_at_location = get_atomicals_at_location
+            notifications.atomical_mint_info = get_atomical_mint_info
+            notifications.run_with_atomicals_state = bp.run_in_thread_with_lock
             MemPoolAPI.register(Notifications)
             mempool = MemPool(
                 env.coin, notifications,
@@ -129,6 +138,7 @@ class Controller(ServerBase):
             async def wait_for_catchup():
                 await caught_up_event.wait()
                 await group.spawn(db.populate_header_merkle_cache())
+                await group.spawn(db.compact_history())
                 await group.spawn(mempool.keep_synchronized(mempool_event))
 
             async with OldTaskGroup() as group:
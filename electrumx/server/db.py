@@ -10,11 +10,16 @@
 
 from array import array
 import ast
+import heapq
 import os
+import struct
 import time
 from bisect import bisect_right
+from collections import defaultdict
+from contextlib import ExitStack
 from dataclasses import dataclass
 from glob import glob
+from itertools import islice
 from typing import Dict, List, Sequence, Tuple, Optional, TYPE_CHECKING
 
 import attr
@@ -24,12 +29,12 @@ import electrumx.lib.util as util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN, double_sha256
 from electrumx.lib.merkle import Merkle, MerkleCache
 from electrumx.lib.util import (
-    formatted_time, pack_be_uint16, pack_be_uint32, pack_le_uint64, pack_be_uint64, pack_le_uint32,
+    formatted_time, pack_byte, pack_be_uint16, pack_be_uint32, pack_le_uint64, pack_be_uint64, pack_le_uint32,
     unpack_le_uint32, unpack_be_uint32, unpack_le_uint64, unpack_be_uint64, unpack_le_uint16_from, unpack_le_uint32_from
 )
-from electrumx.lib.util_atomicals import auto_encode_bytes_elements, pad_bytes64, get_tx_hash_index_from_location_id, location_id_bytes_to_compact, calculate_latest_state_from_mod_history
-from electrumx.server.storage import db_class, Storage
-from electrumx.server.history import History, TXNUM_LEN
+from electrumx.lib.util_atomicals import auto_encode_bytes_elements, pad_bytes64, get_tx_hash_index_from_location_id, location_id_bytes_to_compact, apply_state_mutation, calculate_latest_state_from_mod_history
+from electrumx.server.storage import db_class, Storage, ChunkedWriteBatch, FlushJournal
+from electrumx.server.history import History, TXNUM_LEN, FLUSHID_LEN
 from electrumx.lib.script import SCRIPTHASH_LEN
 from cbor2 import dumps, loads, CBORDecodeError
 
@@ -50,6 +55,251 @@ class UTXO:
     height: int      # block height
     value: int       # in satoshis
 
+@dataclass
+class AtomicalsUtxo:
+    '''An Atomical at a location in the unflushed Atomicals UTXO cache.
+
+    deleted is a tombstone for an Atomical spent before the flush: its
+    b'i' entry is still written but not its active b'a' entry.'''
+    __slots__ = 'atomical_id', 'value', 'deleted'
+    atomical_id: bytes
+    value: bytes     # hashX + scripthash + value_sats + exponent + tx_num
+    deleted: bool
+
+
+class AtomicalsUtxoCache(dict):
+    '''Maps location_id to the list of AtomicalsUtxo at that location.
+
+    A list of slotted records is far smaller than a dict per location plus
+    a dict per Atomical, and the record count allows sizing the cache.'''
+
+    # Average sizes in bytes measured with tracemalloc, including the
+    # location key, atomical_id and value bytes objects
+    LOCATION_SIZE = 210
+    UTXO_SIZE = 216
+
+    def __init__(self):
+        super().__init__()
+        self.utxo_count = 0
+
+    def put(self, location_id, atomical_id, value):
+        atomicals_utxos = self.get(location_id)
+        if atomicals_utxos is None:
+            atomicals_utxos = self[location_id] = []
+        for atomicals_utxo in atomicals_utxos:
+            if atomicals_utxo.atomical_id == atomical_id:
+                atomicals_utxo.value = value
+                atomicals_utxo.deleted = False
+                return
+        atomicals_utxos.append(AtomicalsUtxo(atomical_id, value, False))
+        self.utxo_count += 1
+
+    def clear(self):
+        super().clear()
+        self.utxo_count = 0
+
+    def memsize(self):
+        return len(self) * self.LOCATION_SIZE + self.utxo_count * self.UTXO_SIZE
+
+
+def _payload_size(item):
+    '''The bytes held by a cached key or value beyond the object overhead.'''
+    return len(item) if isinstance(item, (bytes, bytearray)) else 0
+
+
+class DataCache(dict):
+    '''A key -> value cache of unflushed DB writes that keeps a running
+    estimate of its memory use as entries are set and removed.
+
+    While a background flush is in progress, get() falls back to the
+    frozen cache being flushed.'''
+
+    # Bytes per entry measured with tracemalloc, excluding the key and
+    # value payloads: the dict slot and two bytes object headers
+    ENTRY_SIZE = 118
+
+    def __init__(self):
+        super().__init__()
+        self.nbytes = 0
+        self.frozen = None
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        if self.frozen is not None:
+            return self.frozen.get(key, default)
+        return default
+
+    def _entry_size(self, key, value):
+        return self.ENTRY_SIZE + _payload_size(key) + _payload_size(value)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.nbytes -= self._entry_size(key, self[key])
+        super().__setitem__(key, value)
+        self.nbytes += self._entry_size(key, value)
+
+    def __delitem__(self, key):
+        value = self[key]
+        super().__delitem__(key)
+        self.nbytes -= self._entry_size(key, value)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self.nbytes -= self._entry_size(key, value)
+        return value
+
+    def clear(self):
+        super().clear()
+        self.nbytes = 0
+
+    def memsize(self):
+        return self.nbytes
+
+
+class NestedDataCache(dict):
+    '''A key -> {subkey: value} cache of unflushed DB writes, such as the
+    name and state caches, that keeps a running estimate of its memory use.
+
+    Entries must be added with put() and removed with pop_entry().  While a
+    background flush is in progress, get() merges in the entries of the
+    frozen cache being flushed.'''
+
+    # Bytes measured with tracemalloc, excluding payloads.  A key costs its
+    # outer dict slot, bytes object and inner dict; an entry its inner slot
+    # and object headers.
+    KEY_SIZE = 256
+    ENTRY_SIZE = 118
+
+    def __init__(self):
+        super().__init__()
+        self.nbytes = 0
+        self.frozen = None
+
+    def get(self, key, default=None):
+        entries = super().get(key)
+        if self.frozen is not None:
+            frozen_entries = self.frozen.get(key)
+            if frozen_entries:
+                entries = {**frozen_entries, **(entries or {})}
+        return default if entries is None else entries
+
+    def _entry_size(self, subkey, value):
+        return self.ENTRY_SIZE + _payload_size(subkey) + _payload_size(value)
+
+    def put(self, key, subkey, value):
+        # Only the live layer is written, get() merges in the frozen one
+        entries = super().get(key)
+        if entries is None:
+            entries = self[key] = {}
+            self.nbytes += self.KEY_SIZE + _payload_size(key)
+        old = entries.get(subkey)
+        if old is not None:
+            self.nbytes -= self._entry_size(subkey, old)
+        entries[subkey] = value
+        self.nbytes += self._entry_size(subkey, value)
+
+    def pop_entry(self, key, subkey):
+        '''Remove and return the value at key, subkey, or None.'''
+        entries = super().get(key)
+        if not entries:
+            return None
+        value = entries.pop(subkey, None)
+        if value is not None:
+            self.nbytes -= self._entry_size(subkey, value)
+        return value
+
+    def clear(self):
+        super().clear()
+        self.nbytes = 0
+
+    def memsize(self):
+        return self.nbytes
+
+
+class RawBlockStore:
+    '''The raw blocks of the reorg window in one ring-buffer data file.
+
+    The block at height N is indexed in slot N % slots of a file of
+    fixed-size (height, offset, size) records.  A block is written after
+    the previous one, or at the start of the data file once it no longer
+    fits, and never over a block of the window, so an interrupted write
+    leaves every indexed block intact.'''
+
+    ENTRY = struct.Struct('<IQI')
+
+    def __init__(self, path, slots):
+        self.data_path = path
+        self.index_path = path + '_index'
+        self.slots = max(slots, 1)
+        self.data_fd = None
+        self.index_fd = None
+        self.entries = None
+        self.data_size = 0
+
+    def open(self):
+        if self.entries is not None:
+            return
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self.data_fd = os.open(self.data_path, flags)
+        self.index_fd = os.open(self.index_path, flags)
+        index_size = self.slots * self.ENTRY.size
+        index = os.pread(self.index_fd, index_size + 1, 0)
+        if len(index) != index_size:
+            # New, or sized for another reorg limit; start empty
+            os.ftruncate(self.index_fd, 0)
+            os.ftruncate(self.index_fd, index_size)
+            os.ftruncate(self.data_fd, 0)
+            index = bytes(index_size)
+        self.entries = [self.ENTRY.unpack_from(index, slot * self.ENTRY.size)
+                        for slot in range(self.slots)]
+        self.data_size = os.fstat(self.data_fd).st_size
+
+    def close(self):
+        if self.entries is not None:
+            os.close(self.data_fd)
+            os.close(self.index_fd)
+            self.entries = None
+
+    def _write_offset(self, height, size):
+        live = [(offset, offset + entry_size)
+                for entry_height, offset, entry_size in self.entries
+                if entry_size and height - self.slots < entry_height < height]
+
+        def is_free(start):
+            return all(end <= start or start + size <= begin for begin, end in live)
+
+        prev_height, prev_offset, prev_size = self.entries[(height - 1) % self.slots]
+        cursor = prev_offset + prev_size if prev_height == height - 1 else 0
+        if cursor + size <= self.data_size and is_free(cursor):
+            return cursor
+        if is_free(0):
+            return 0
+        # The window holds more than the file; grow it
+        return max(end for _begin, end in live)
+
+    def write(self, height, block):
+        self.open()
+        offset = self._write_offset(height, len(block))
+        os.pwrite(self.data_fd, block, offset)
+        slot = height % self.slots
+        entry = (height, offset, len(block))
+        os.pwrite(self.index_fd, self.ENTRY.pack(*entry), slot * self.ENTRY.size)
+        self.entries[slot] = entry
+        self.data_size = max(self.data_size, offset + len(block))
+
+    def read(self, height):
+        '''Return the raw block at height.  Raises FileNotFoundError if it
+        is not stored.'''
+        self.open()
+        entry_height, offset, size = self.entries[height % self.slots]
+        if entry_height != height or not size:
+            raise FileNotFoundError(f'block {height:,d} is not stored')
+        return os.pread(self.data_fd, size, offset)
+
+
 @attr.s(slots=True)
 
 class FlushData:
@@ -71,8 +321,8 @@ class FlushData:
     atomicals_undo_infos = attr.ib()    # type: List[Tuple[Sequence[bytes], int]]
     # atomicals_adds is used to track atomicals locations and unspent utxos with the b'i' and b'a' indexes
     # It uses a field 'deleted' to indicate whether to write the b'a' (active unspent utxo) or not - because it may have been spent before the cache flushed
-    # Maps location_id to atomical_ids and the value/deleted entry
-    atomicals_adds = attr.ib()          # type: Dict[bytes, Dict[bytes, { value: bytes, deleted: Boolean}] ] 
+    # Maps location_id to the AtomicalsUtxo records at the location
+    atomicals_adds = attr.ib()          # type: AtomicalsUtxoCache
     # general_adds is a general purpose storage for key-value, used for the majority of atomicals data
     general_adds = attr.ib()            # type: List[Tuple[Sequence[bytes], Sequence[bytes]]]
     # realm_adds map realm names to tx_num ints, which then map onto an atomical_id
@@ -100,6 +350,11 @@ class FlushData:
     state_adds = attr.ib()           # type: Dict[bytes, Dict[bytes, bytes]
     # op_adds is for record tx operation of one tx
     op_adds = attr.ib()   # type: Dict[bytes, Dict[bytes]
+    # op_history_adds maps b'x' + hashX + op, and b'v' + op, to the be_tx_nums of the txs with the op in the history
+    # of the hashX, or across the chain
+    op_history_adds = attr.ib()         # type: Dict[bytes, Dict[bytes, bytes]]
+    # history is the unflushed history frozen for a background flush, or None to flush the live history
+    history = attr.ib(default=None)     # type: Optional[Dict[bytes, bytearray]]
     
 COMP_TXID_LEN = 4
 
@@ -112,6 +367,12 @@ class DB:
 
     DB_VERSIONS = (6, 7, 8)
 
+    # Bytes of derived index entries written per batch while building it
+    INDEX_BUILD_BATCH_SIZE = 64 * 1000 * 1000
+
+    # Mods of an atomical between two b'z' entries holding its whole state
+    MOD_STATE_CHECKPOINT = 64
+
     utxo_db: Optional['Storage']
 
     class DBError(Exception):
@@ -212,6 +473,10 @@ class DB:
         # Value: satoshis at the output 
         # "maps generated atomical mint and location to a value"
         # ---
+        # Key: b'gc' + atomical_id
+        # Value: le_uint64 count of the b'gi' entries of the atomical
+        # "maps a distributed mint ticker to its number of mints"
+        # ---
         # Key: b'dat' + location_id
         # Value: bytes of files data stored at location. Ideally cbor encoded blob
         # "maps a location to files data"
@@ -231,6 +496,38 @@ class DB:
         # Key: b'op' + txnum
         # Value: op in txnum
         # "save the op by txnum"
+        # ---
+        # Key: b'x' + hashX + op + be_tx_num
+        # Value: empty
+        # "maps the history of a hashX to the op of each tx, in tx order"
+        # ---
+        # Key: b'v' + op + be_tx_num
+        # Value: empty
+        # "maps the op of each tx with an op across the chain, in tx order"
+        # ---
+        # Key: b'w' + b'x' + hashX + op, or b'w' + b'v' + op
+        # Value: le_uint64 count of the b'x' or b'v' entries with the prefix
+        # "maps an op history prefix to the number of its txs"
+        # ---
+        # Key: b'k' + hashX + atomical_id
+        # Value: le_uint64 sum of the values of the b'a' entries of the atomical paying to hashX
+        # "maps a hashX to its balance of each atomical it holds"
+        # ---
+        # Key: b'j' + atomical_id + scripthash
+        # Value: le_uint64 sum of the values of the b'a' entries of the atomical paying to the script + pk_script
+        # "maps an atomical and output script to the holding of the script"
+        # ---
+        # Key: b'q' + atomical_id + be_uint64 holding + scripthash
+        # Value: empty
+        # "orders the holders of an atomical by holding, the largest last"
+        # ---
+        # Key: b'y' + atomical_id
+        # Value: le_uint64 sum of the values of the b'a' entries of the atomical + le_uint64 count of its b'j' entries
+        # "maps an atomical to its circulating supply and number of holders"
+        # ---
+        # Key: b'z' + atomical_id + be_tx_num + out_idx
+        # Value: b'\x00' + the data of the b'mod' entry, or b'\x01' + cbor of the state after the mod
+        # "orders the mods of an atomical by tx, with the state folded every MOD_STATE_CHECKPOINT mods"
         #
         #
         #
@@ -281,21 +578,35 @@ class DB:
         self.db_version = -1
         self.logger.info(f'using {self.env.db_engine} for DB backend')
 
+        # Derived indexes which have been built from the primary tables.  A new
+        # DB maintains them all from the start; an existing DB builds the
+        # missing ones once on opening.
+        self.built_indexes = set()
+
+        # True from the commit of a chunked flush until its journal is applied
+        self.partial_flush = False
+
+        # In-memory filter of the locations with an active b'a' entry, so
+        # spending outputs that carry no Atomicals needs no DB seeks
+        self.atomicals_location_filter = None
+
         # Header merkle cache
         self.merkle = Merkle()
         self.header_mc = MerkleCache(self.merkle, self.fs_block_hashes)
 
         # on-disk: raw block headers in chain order
-        self.headers_file = util.LogicalFile('meta/headers', 2, 16000000)
+        self.headers_file = util.MappedLogicalFile('meta/headers', 2, 16000000)
         # on-disk: cumulative number of txs at the end of height N
-        self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
+        self.tx_counts_file = util.MappedLogicalFile('meta/txcounts', 2, 2000000)
         # on-disk: cumulative number of atomicals counts at the end of height N
         self.atomical_counts_file = util.LogicalFile('meta/atomicalscounts', 2, 2000000)
         # on-disk: 32 byte txids in chain order, allows (tx_num -> txid) map
-        self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
+        self.hashes_file = util.MappedLogicalFile('meta/hashes', 4, 16000000)
         if not self.coin.STATIC_BLOCK_HEADERS:
             self.headers_offsets_file = util.LogicalFile(
                 'meta/headers_offsets', 2, 16000000)
+        # on-disk: raw blocks of the reorg window, for backing up without the daemon
+        self.raw_blocks = RawBlockStore('meta/blocks', self.env.reorg_limit)
 
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
@@ -346,7 +657,7 @@ class DB:
         # Then history DB
         self.utxo_flush_count = self.history.open_db(self.db_class, for_sync,
                                                      self.utxo_flush_count,
-                                                     compacting)
+                                                     self.db_tx_count)
         self.clear_excess_undo_info()
 
         self.clear_excess_atomicals_undo_info()
@@ -357,6 +668,13 @@ class DB:
         # Read Atomicals counts (requires meta directory)
         await self._read_atomical_counts()
 
+        if not compacting:
+            await run_in_thread(self.build_missing_indexes)
+
+        if (self.env.atomicals_location_filter and not compacting
+                and self.atomicals_location_filter is None):
+            await run_in_thread(self.build_atomicals_location_filter)
+
     async def open_for_compacting(self):
         await self._open_dbs(True, True)
 
@@ -393,6 +711,25 @@ class DB:
     async def header_branch_and_root(self, length, height):
         return await self.header_mc.branch_and_root(length, height)
 
+    # History compaction
+
+    async def compact_history(self):
+        '''Compact the history DB whenever a compaction is in progress, a
+        step at a time between flushes.  Pauses after each step for as
+        long as it took.  The next UTXO flush finishes the compaction.'''
+        history = self.history
+        limit = 8 * 1000 * 1000
+        while True:
+            threshold = self.env.history_compaction_flushes
+            if threshold and history.flush_count >= threshold:
+                await run_in_thread(history.start_compaction)
+            if history.comp_cursor in (-1, 65536):
+                await sleep(10)
+                continue
+            start = time.monotonic()
+            await run_in_thread(history.compaction_step, limit)
+            await sleep(time.monotonic() - start)
+
     # Flushing
     def assert_flushed(self, flush_data):
         '''Asserts state is fully flushed.'''
@@ -423,9 +760,19 @@ class DB:
     def flush_dbs(self, flush_data, flush_utxos, estimate_txs_remaining):
         '''Flush out cached state.  History is always flushed; UTXOs are
         flushed if flush_utxos.'''
-        if flush_data.height == self.db_height:
+        commit = self.prepare_flush(flush_data, flush_utxos, estimate_txs_remaining)
+        commit()
+
+    def prepare_flush(self, flush_data, flush_utxos, estimate_txs_remaining,
+                      background=False):
+        '''Flush the file system data and history, and write the UTXO DB
+        changes to a batch.  Return a function committing the batch.
+
+        A background flush keeps the caches of flush_data readable until
+        its batch is committed, as blocks are processed meanwhile.'''
+        if flush_data.height == self.db_height and not background:
             self.assert_flushed(flush_data)
-            return
+            return lambda: None
 
         start_time = time.time()
         prior_flush = self.last_flush
@@ -436,34 +783,59 @@ class DB:
         self.flush_fs(flush_data)
 
         # Then history
-        self.flush_history()
-
-        # Flush state last as it reads the wall time.
-        with self.utxo_db.write_batch() as batch:
-            if flush_utxos:
+        self.flush_history(flush_data.history)
+
+        # During sync the UTXO writes can be staged in a journal in bounded
+        # batches.  Committing the state with partial_flush set completes the
+        # flush; the journal is then applied, again on open if interrupted.
+        chunked = (flush_utxos and not background and self.utxo_db.for_sync
+                   and self.env.flush_batch_MB > 0)
+        if chunked:
+            journal = FlushJournal(self.utxo_db, self.env.flush_batch_MB * 1000 * 1000)
+            with journal.writer() as batch:
                 self.flush_utxo_db(batch, flush_data)
+            self.logger.info(f'staged UTXO flush in {batch.batch_count:,d} batches')
+            self.partial_flush = True
+
+        with ExitStack() as stack:
+            batch = stack.enter_context(self.utxo_db.write_batch())
+            if flush_utxos and not chunked:
+                self.flush_utxo_db(batch, flush_data, keep_caches=background)
+            # Only commit the batch if it was written without error
+            commit_stack = stack.pop_all()
+
+        def commit():
+            if background and flush_utxos:
+                self.advance_db_state(flush_data)
+            # Flush state last as it reads the wall time.
             self.flush_state(batch)
-
-        # Update and put the wall time again - otherwise we drop the
-        # time it took to commit the batch
-        self.flush_state(self.utxo_db)
-
-        elapsed = self.last_flush - start_time
-        self.logger.info(f'flush #{self.history.flush_count:,d} took '
-                         f'{elapsed:.1f}s.  Height {flush_data.height:,d} '
-                         f'txs: {flush_data.tx_count:,d} ({tx_delta:+,d}) '
-                         f'Atomical txs: {flush_data.atomical_count:,d} ({atomical_delta:+,d})')
-
-        # Catch-up stats
-        if self.utxo_db.for_sync:
-            flush_interval = self.last_flush - prior_flush
-            tx_per_sec_gen = int(flush_data.tx_count / self.wall_time)
-            tx_per_sec_last = 1 + int(tx_delta / flush_interval)
-            eta = estimate_txs_remaining() / tx_per_sec_last
-            self.logger.info(f'tx/sec since genesis: {tx_per_sec_gen:,d}, '
-                             f'since last flush: {tx_per_sec_last:,d}')
-            self.logger.info(f'sync time: {formatted_time(self.wall_time)}  '
-                             f'ETA: {formatted_time(eta)}')
+            commit_stack.close()
+            if chunked:
+                journal.apply()
+                self.partial_flush = False
+
+            # Update and put the wall time again - otherwise we drop the
+            # time it took to commit the batch
+            self.flush_state(self.utxo_db)
+
+            elapsed = self.last_flush - start_time
+            self.logger.info(f'flush #{self.history.flush_count:,d} took '
+                             f'{elapsed:.1f}s.  Height {flush_data.height:,d} '
+                             f'txs: {flush_data.tx_count:,d} ({tx_delta:+,d}) '
+                             f'Atomical txs: {flush_data.atomical_count:,d} ({atomical_delta:+,d})')
+
+            # Catch-up stats
+            if self.utxo_db.for_sync:
+                flush_interval = self.last_flush - prior_flush
+                tx_per_sec_gen = int(flush_data.tx_count / self.wall_time)
+                tx_per_sec_last = 1 + int(tx_delta / flush_interval)
+                eta = estimate_txs_remaining() / tx_per_sec_last
+                self.logger.info(f'tx/sec since genesis: {tx_per_sec_gen:,d}, '
+                                 f'since last flush: {tx_per_sec_last:,d}')
+                self.logger.info(f'sync time: {formatted_time(self.wall_time)}  '
+                                 f'ETA: {formatted_time(eta)}')
+
+        return commit
 
     def flush_fs(self, flush_data):
         '''Write headers, tx counts and block tx hashes to the filesystem.
@@ -476,9 +848,10 @@ class DB:
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        # Blocks may have been processed beyond the height of a background flush
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if self.tx_counts else 0)
+        assert len(self.tx_counts) >= flush_data.height + 1
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
@@ -493,12 +866,13 @@ class DB:
         flush_data.headers.clear()
 
         offset = height_start * self.tx_counts.itemsize
+        height_end = flush_data.height + 1
         self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+                                  self.tx_counts[height_start:height_end].tobytes())
 
         atomical_offset = height_start * self.atomical_counts.itemsize
         self.atomical_counts_file.write(atomical_offset,
-                                  self.atomical_counts[height_start:].tobytes())
+                                  self.atomical_counts[height_start:height_end].tobytes())
 
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
@@ -511,24 +885,49 @@ class DB:
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, unflushed=None):
+        self.history.flush(unflushed)
+
+    def flush_utxo_db(self, batch, flush_data: FlushData, keep_caches=False):
+        '''Flush the cached DB writes and UTXO set to the batch.
 
-    def flush_utxo_db(self, batch, flush_data: FlushData):
-        '''Flush the cached DB writes and UTXO set to the batch.'''
+        If keep_caches the caches that blocks are processed against are not
+        cleared, as the batch of a background flush is committed later.'''
         # Care is needed because the writes generated by flushing the
         # UTXO state may have keys in common with our write cache or
         # may be in the DB already.
+        def flushed(cache):
+            if not keep_caches:
+                cache.clear()
+
         start_time = time.monotonic()
         add_count = len(flush_data.adds)
 
-        atomical_add_count = 0
-        for location_key, atomical_map in flush_data.atomicals_adds.items():
-            for atomical_id, value_with_tombstone in atomical_map.items():
-                atomical_add_count = atomical_add_count + 1
+        atomical_add_count = flush_data.atomicals_adds.utxo_count
 
         spend_count = len(flush_data.deletes) // 2
 
+        # The balance indexes follow the active b'a' locations
+        active_changes = self.active_location_changes(flush_data)
+        self.flush_atomicals_balances(batch, active_changes)
+        self.flush_atomicals_holders(batch, flush_data, active_changes)
+
+        # The mod state log follows the b'mod' entries added and removed
+        self.flush_mod_states(batch, flush_data)
+
+        # The per-ticker mint counters follow the b'gi' entries added and removed
+        distmint_count_deltas = defaultdict(int)
+        for key in set(flush_data.deletes):
+            if key[:2] == b'gi' and len(key) == 2 + ATOMICAL_ID_LEN + ATOMICAL_ID_LEN:
+                distmint_count_deltas[key[2:2 + ATOMICAL_ID_LEN]] -= 1
+        for atomical_id_key, location_map in flush_data.distmint_adds.items():
+            distmint_count_deltas[atomical_id_key] += len(location_map)
+        for atomical_id_key, delta in distmint_count_deltas.items():
+            if delta:
+                count = self.get_distmint_count(atomical_id_key) + delta
+                assert count >= 0
+                batch.put(b'gc' + atomical_id_key, pack_le_uint64(count))
+
         # Spends
         batch_delete = batch.delete
 
@@ -541,14 +940,14 @@ class DB:
         batch_put = batch.put
         for key, v in flush_data.general_adds.items():
             batch_put(key, v)
-        flush_data.general_adds.clear()
+        flushed(flush_data.general_adds)
 
         # ticker data adds
         batch_put = batch.put
         for key, v in flush_data.ticker_adds.items():
             for tx_num, atomical_id in v.items():
                 batch_put(key + pack_le_uint64(tx_num), atomical_id)
-        flush_data.ticker_adds.clear()
+        flushed(flush_data.ticker_adds)
 
         # realm data adds
         # Realms are grouped by realm name and distinguished by commit_tx_num
@@ -557,7 +956,7 @@ class DB:
         for key, v in flush_data.realm_adds.items():
             for tx_num, atomical_id in v.items():
                 batch_put(key + pack_le_uint64(tx_num), atomical_id)
-        flush_data.realm_adds.clear()
+        flushed(flush_data.realm_adds)
 
         # container data adds
         # Containers are grouped by container name and distinguished by commit_tx_num
@@ -566,7 +965,7 @@ class DB:
         for key, v in flush_data.container_adds.items():
             for tx_num, atomical_id in v.items():
                 batch_put(key + pack_le_uint64(tx_num), atomical_id)
-        flush_data.container_adds.clear()
+        flushed(flush_data.container_adds)
 
         # subrealm data adds
         # Subrealms are grouped by parent realm id and subrealm name and distinguished by commit_tx_num
@@ -575,14 +974,14 @@ class DB:
         for key, v in flush_data.subrealm_adds.items():
             for tx_num, atomical_id in v.items():
                 batch_put(key + pack_le_uint64(tx_num), atomical_id)
-        flush_data.subrealm_adds.clear()
+        flushed(flush_data.subrealm_adds)
 
         # subrealm pay data adds
         batch_put = batch.put
         for key, v in flush_data.subrealmpay_adds.items():
             for tx_num, pay_outpoint in v.items():
                 batch_put(key + pack_le_uint64(tx_num), pay_outpoint)
-        flush_data.subrealmpay_adds.clear()
+        flushed(flush_data.subrealmpay_adds)
 
         # dmitem data adds
         # dmitems are grouped by parent container id and dmitem name and distinguished by commit_tx_num
@@ -591,14 +990,14 @@ class DB:
         for key, v in flush_data.dmitem_adds.items():
             for tx_num, atomical_id in v.items():
                 batch_put(key + pack_le_uint64(tx_num), atomical_id)
-        flush_data.dmitem_adds.clear()
+        flushed(flush_data.dmitem_adds)
 
         # dmitem pay data adds
         batch_put = batch.put
         for key, v in flush_data.dmpay_adds.items():
             for tx_num, pay_outpoint in v.items():
                 batch_put(key + pack_le_uint64(tx_num), pay_outpoint)
-        flush_data.dmpay_adds.clear()
+        flushed(flush_data.dmpay_adds)
 
         # New UTXOs
         batch_put = batch.put
@@ -611,14 +1010,19 @@ class DB:
             suffix = txout_idx + tx_num
             batch_put(b'h' + key[:COMP_TXID_LEN] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value_sats)
-        flush_data.adds.clear()
+        flushed(flush_data.adds)
         
+        # The filter only ever grows, by adding filters rather than rebuilding
+        # on the flush path; it is built afresh on the next open
+        location_filter = self.atomicals_location_filter
+
         # New atomicals location UTXOs
         # Tracks the atomicals that passed through each location and maintains active unspent utxos
         batch_put = batch.put
-        for location_key, atomical_map in flush_data.atomicals_adds.items():
-            for atomical_id, value_with_tombstone in atomical_map.items():
-                value = value_with_tombstone['value']
+        for location_key, atomicals_utxos in flush_data.atomicals_adds.items():
+            for atomicals_utxo in atomicals_utxos:
+                atomical_id = atomicals_utxo.atomical_id
+                value = atomicals_utxo.value
                 hashX = value[:HASHX_LEN]
                 scripthash = value[HASHX_LEN : HASHX_LEN + SCRIPTHASH_LEN]
                 value_sats = value[HASHX_LEN + SCRIPTHASH_LEN : HASHX_LEN + SCRIPTHASH_LEN + 8]
@@ -626,9 +1030,11 @@ class DB:
                 tx_numb = value[-TXNUM_LEN:]  
                 batch_put(b'i' + location_key + atomical_id, hashX + scripthash + value_sats + exponent + tx_numb) 
                 # Add the active b'a' atomicals location if it was not deleted
-                if not value_with_tombstone.get('deleted', False):
+                if not atomicals_utxo.deleted:
                     batch_put(b'a' + atomical_id + location_key, hashX + scripthash + value_sats + exponent + tx_numb) 
-        flush_data.atomicals_adds.clear()
+                    if location_filter is not None:
+                        location_filter.add(location_key)
+        flushed(flush_data.atomicals_adds)
  
         # Distributed mint data adds
         # Grouped by the atomical and locations. Maintains the global location of all initial mints of distributed ft tokens
@@ -637,7 +1043,7 @@ class DB:
             for location_id, value in location_map.items():
                 # the value is the format of: scripthash + value_sats
                 batch_put(b'gi' + atomical_id_key + location_id, value)
-        flush_data.distmint_adds.clear()
+        flushed(flush_data.distmint_adds)
 
         # State data adds
         # Grouped by prefix and atomical id 
@@ -645,13 +1051,22 @@ class DB:
         for state_id_prefix_key, state_id_suffix_map in flush_data.state_adds.items():
             for state_id_suffix_key, value in state_id_suffix_map.items():
                 batch_put(state_id_prefix_key + state_id_suffix_key, value)
-        flush_data.state_adds.clear()
+        flushed(flush_data.state_adds)
 
         # General op adds
         batch_put = batch.put
         for key, v in flush_data.op_adds.items():
             batch_put(key, v)
-        flush_data.op_adds.clear()
+        flushed(flush_data.op_adds)
+
+        # Op history adds, and the counters of each prefix
+        batch_put = batch.put
+        for key, tx_nums in flush_data.op_history_adds.items():
+            for tx_num in tx_nums:
+                batch_put(key + tx_num, b'')
+            count = self.get_op_history_count(key) + len(tx_nums)
+            batch_put(b'w' + key, pack_le_uint64(count))
+        flushed(flush_data.op_history_adds)
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
@@ -671,12 +1086,506 @@ class DB:
                              f'{spend_count:,d} spends in '
                              f'{elapsed:.1f}s, committing...')
 
+        if not keep_caches:
+            self.advance_db_state(flush_data)
+
+    def advance_db_state(self, flush_data):
+        '''Advance the DB state to that of flushed UTXOs.  A background flush
+        does so only as its batch commits, as the DB state is read meanwhile.
+
+        A history compaction complete in-memory is finished first, so the
+        UTXO state records the flush count it resets.'''
+        self.history.finish_compaction()
         self.utxo_flush_count = self.history.flush_count
         self.db_height = flush_data.height
         self.db_tx_count = flush_data.tx_count
         self.db_atomical_count = flush_data.atomical_count
         self.db_tip = flush_data.tip
 
+    def build_atomicals_location_filter(self):
+        '''Build the filter of locations holding unspent Atomicals from the b'a' table.'''
+        start = time.monotonic()
+        prefix = b'a'
+        count = sum(1 for _key in self.utxo_db.iterator(prefix=prefix))
+        # Sized for the current locations with room to grow before it adds filters
+        location_filter = util.ScalableBloomFilter(max(count * 2, 1_000_000))
+        for key, _value in self.utxo_db.iterator(prefix=prefix):
+            location_filter.add(key[1 + ATOMICAL_ID_LEN:])
+        self.atomicals_location_filter = location_filter
+        elapsed = time.monotonic() - start
+        self.logger.info(f'built active Atomicals location filter for {count:,d} '
+                         f'locations in {elapsed:.1f}s')
+
+    def may_have_active_atomicals(self, location_id):
+        '''Return False only if there is definitely no b'a' entry for the location.'''
+        location_filter = self.atomicals_location_filter
+        return location_filter is None or location_id in location_filter
+
+    def active_location_changes(self, flush_data):
+        '''Return (atomical_id, location, value, sign) tuples for the b'a'
+        entries a flush removes, with sign -1, and adds, with sign 1.'''
+        a_key_len = 1 + ATOMICAL_ID_LEN + ATOMICAL_ID_LEN
+        a_deletes = sorted(key for key in set(flush_data.deletes)
+                           if len(key) == a_key_len and key[:1] == b'a')
+        changes = []
+        for key, value in zip(a_deletes, self.utxo_db.multi_get(a_deletes)):
+            if value:
+                changes.append((key[1:1 + ATOMICAL_ID_LEN], key[1 + ATOMICAL_ID_LEN:], value, -1))
+        for location, atomicals_utxos in flush_data.atomicals_adds.items():
+            for atomicals_utxo in atomicals_utxos:
+                if not atomicals_utxo.deleted:
+                    changes.append((atomicals_utxo.atomical_id, location, atomicals_utxo.value, 1))
+        return changes
+
+    def flush_atomicals_balances(self, batch, active_changes):
+        deltas = defaultdict(int)
+        for atomical_id, _location, value, sign in active_changes:
+            value_sats, = unpack_le_uint64(value[HASHX_LEN + SCRIPTHASH_LEN: HASHX_LEN + SCRIPTHASH_LEN + 8])
+            deltas[b'k' + value[:HASHX_LEN] + atomical_id] += sign * value_sats
+        keys = sorted(key for key, delta in deltas.items() if delta)
+        for key, balance in zip(keys, self.utxo_db.multi_get(keys)):
+            balance = unpack_le_uint64(balance)[0] if balance else 0
+            balance += deltas[key]
+            assert balance >= 0
+            if balance:
+                batch.put(key, pack_le_uint64(balance))
+            else:
+                batch.delete(key)
+
+    def flush_atomicals_holders(self, batch, flush_data, active_changes):
+        '''Update the b'j' holdings and b'q' ranking of the holders of each
+        atomical, and the b'y' supply summary of the atomical.'''
+        deltas = defaultdict(int)
+        # atomical_id -> [supply delta, holder count delta]
+        summary_deltas = defaultdict(lambda: [0, 0])
+        locations = {}
+        for atomical_id, location, value, sign in active_changes:
+            value_sats, = unpack_le_uint64(value[HASHX_LEN + SCRIPTHASH_LEN: HASHX_LEN + SCRIPTHASH_LEN + 8])
+            key = b'j' + atomical_id + value[HASHX_LEN: HASHX_LEN + SCRIPTHASH_LEN]
+            deltas[key] += sign * value_sats
+            if sign > 0:
+                locations.setdefault(key, location)
+        keys = sorted(key for key, delta in deltas.items() if delta)
+        for key, holder in zip(keys, self.utxo_db.multi_get(keys)):
+            if holder:
+                holding, = unpack_le_uint64(holder[:8])
+                script = holder[8:]
+            else:
+                # A new holder; the output script of the location it received at
+                po_key = b'po' + locations[key]
+                holding = 0
+                script = flush_data.general_adds.get(po_key) or self.utxo_db.get(po_key) or b''
+            rank_prefix = b'q' + key[1:1 + ATOMICAL_ID_LEN]
+            scripthash = key[1 + ATOMICAL_ID_LEN:]
+            if holding:
+                batch.delete(rank_prefix + pack_be_uint64(holding) + scripthash)
+            summary_delta = summary_deltas[key[1:1 + ATOMICAL_ID_LEN]]
+            summary_delta[0] += deltas[key]
+            summary_delta[1] -= bool(holding)
+            holding += deltas[key]
+            assert holding >= 0
+            summary_delta[1] += bool(holding)
+            if holding:
+                batch.put(key, pack_le_uint64(holding) + script)
+                batch.put(rank_prefix + pack_be_uint64(holding) + scripthash, b'')
+            else:
+                batch.delete(key)
+
+        for atomical_id, (supply_delta, holders_delta) in summary_deltas.items():
+            supply, holders = self.get_location_summary(atomical_id)
+            supply += supply_delta
+            holders += holders_delta
+            assert supply >= 0 and holders >= 0
+            if holders:
+                batch.put(b'y' + atomical_id, pack_le_uint64(supply) + pack_le_uint64(holders))
+            else:
+                batch.delete(b'y' + atomical_id)
+
+    def get_location_summary(self, atomical_id):
+        '''Return the (circulating supply, number of holders) of an atomical
+        as of the last flush.'''
+        value = self.utxo_db.get(b'y' + atomical_id)
+        if not value:
+            return 0, 0
+        return unpack_le_uint64(value[:8])[0], unpack_le_uint64(value[8:])[0]
+
+    def scan_location_summary(self, atomical_id):
+        '''Return the location summary of an atomical the slow way.
+
+        Used to audit the b'y' summaries.'''
+        holdings = defaultdict(int)
+        for _db_key, db_value in self.utxo_db.iterator(prefix=b'a' + atomical_id):
+            value_sats, = unpack_le_uint64(db_value[HASHX_LEN + SCRIPTHASH_LEN: HASHX_LEN + SCRIPTHASH_LEN + 8])
+            holdings[db_value[HASHX_LEN: HASHX_LEN + SCRIPTHASH_LEN]] += value_sats
+        return sum(holdings.values()), sum(1 for holding in holdings.values() if holding)
+
+    def build_atomicals_supply_index(self, batch):
+        summaries = defaultdict(lambda: [0, 0])
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'j'):
+            summary = summaries[db_key[1:1 + ATOMICAL_ID_LEN]]
+            summary[0] += unpack_le_uint64(db_value[:8])[0]
+            summary[1] += 1
+        for atomical_id, (supply, holders) in summaries.items():
+            batch.put(b'y' + atomical_id, pack_le_uint64(supply) + pack_le_uint64(holders))
+        self.logger.info(f'summarized the supply of {len(summaries):,d} Atomicals')
+
+    @staticmethod
+    def mod_state_key(mod_key):
+        '''Return the b'z' key of the b'mod' + atomical_id + tx_numb + tx_hash
+        + out_idx key of a mod.'''
+        atomical_id = mod_key[3:3 + ATOMICAL_ID_LEN]
+        tx_numb = mod_key[3 + ATOMICAL_ID_LEN: 3 + ATOMICAL_ID_LEN + TXNUM_LEN]
+        return b'z' + atomical_id + tx_numb[::-1] + mod_key[-4:]
+
+    def read_mod_state(self, entries):
+        '''Fold the b'z' (key, value) entries of an atomical, newest first, back
+        to the last full state.  Return the state and the number of mods since
+        that full state.'''
+        mods = []
+        state = {}
+        for _db_key, db_value in entries:
+            if db_value[:1] == b'\x01':
+                state = loads(db_value[1:])
+                break
+            mods.append(db_value[1:])
+        for data in reversed(mods):
+            apply_state_mutation(state, loads(data))
+        return state, len(mods)
+
+    def put_mod_states(self, batch, mods, state, since_full):
+        '''Put the b'z' entries of the (b'z' key, data) mods of an atomical, in
+        tx order, on top of state.'''
+        for key, data in mods:
+            apply_state_mutation(state, loads(data))
+            since_full += 1
+            if since_full >= self.MOD_STATE_CHECKPOINT:
+                batch.put(key, b'\x01' + dumps(state))
+                since_full = 0
+            else:
+                batch.put(key, b'\x00' + data)
+
+    def flush_mod_states(self, batch, flush_data):
+        mod_key_len = 3 + ATOMICAL_ID_LEN + TXNUM_LEN + 32 + 4
+        removed = set(self.mod_state_key(key) for key in flush_data.deletes
+                      if len(key) == mod_key_len and key[:3] == b'mod')
+        for key in sorted(removed):
+            batch.delete(key)
+        for prefix, suffix_map in flush_data.state_adds.items():
+            if prefix[:3] != b'mod':
+                continue
+            mods = sorted((self.mod_state_key(prefix + suffix), data)
+                          for suffix, data in suffix_map.items())
+            written = set(key for key, _ in mods)
+            entries = ((db_key, db_value) for db_key, db_value in self.utxo_db.iterator(
+                prefix=b'z' + prefix[3:], reverse=True)
+                if db_key not in removed and db_key not in written)
+            state, since_full = self.read_mod_state(entries)
+            self.put_mod_states(batch, mods, state, since_full)
+
+    def get_mod_state(self, atomical_id, max_height=None):
+        '''Return the state of an atomical folded from its flushed mods.
+
+        With flushed mods after max_height the state is folded from
+        get_mod_history, which leaves out mods the way mint validation
+        always has.'''
+        if max_height is not None and self.has_mods_after(atomical_id, max_height):
+            return calculate_latest_state_from_mod_history(self.get_mod_history(atomical_id, max_height))
+        state, _ = self.read_mod_state(self.utxo_db.iterator(prefix=b'z' + atomical_id, reverse=True))
+        return state
+
+    def get_mod_state_version(self, atomical_id):
+        '''Return the tx_num of the last flushed mod of an atomical, or None if
+        it has none.'''
+        prefix = b'z' + atomical_id
+        for db_key, _db_value in self.utxo_db.iterator(prefix=prefix, reverse=True):
+            tx_numb = db_key[len(prefix): len(prefix) + TXNUM_LEN]
+            return unpack_be_uint64(bytes(8 - TXNUM_LEN) + tx_numb)[0]
+        return None
+
+    def has_mods_after(self, atomical_id, height):
+        '''Return whether an atomical has flushed mods of txs after height.'''
+        if height >= len(self.tx_counts):
+            return False
+        version = self.get_mod_state_version(atomical_id)
+        return version is not None and version >= self.tx_counts[height]
+
+    def build_mod_state_index(self, batch):
+        mod_key_len = 3 + ATOMICAL_ID_LEN + TXNUM_LEN + 32 + 4
+        count = 0
+        mods = []
+
+        def put_mods():
+            mods.sort()
+            self.put_mod_states(batch, mods, {}, 0)
+            mods.clear()
+
+        # Keys of one atomical are contiguous but not in tx order
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'mod'):
+            if len(db_key) != mod_key_len:
+                continue
+            key = self.mod_state_key(db_key)
+            if mods and mods[0][0][:1 + ATOMICAL_ID_LEN] != key[:1 + ATOMICAL_ID_LEN]:
+                put_mods()
+            mods.append((key, db_value))
+            count += 1
+        put_mods()
+        self.logger.info(f'indexed the state of {count:,d} mods')
+
+    def get_atomical_holders(self, atomical_id, limit=None, offset=0):
+        '''Return a list of {'holding', 'script'} dicts for the holders of an
+        atomical, the largest holding first, skipping the first offset.'''
+        prefix = b'q' + atomical_id
+        ranked = self.utxo_db.iterator(prefix=prefix, reverse=True)
+        stop = None if limit is None else offset + limit
+        keys = [b'j' + atomical_id + db_key[len(prefix) + 8:]
+                for db_key, _ in islice(ranked, offset, stop)]
+        holders = []
+        for holder in self.utxo_db.multi_get(keys):
+            holding, = unpack_le_uint64(holder[:8])
+            holders.append({
+                "holding": holding,
+                "script": holder[8:].hex(),
+            })
+        return holders
+
+    def build_atomicals_holder_index(self, batch):
+        holdings = defaultdict(int)
+        locations = {}
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'a'):
+            key = db_key[1:1 + ATOMICAL_ID_LEN] + db_value[HASHX_LEN: HASHX_LEN + SCRIPTHASH_LEN]
+            value_sats, = unpack_le_uint64(db_value[HASHX_LEN + SCRIPTHASH_LEN: HASHX_LEN + SCRIPTHASH_LEN + 8])
+            holdings[key] += value_sats
+            locations.setdefault(key, db_key[1 + ATOMICAL_ID_LEN:])
+        for key, holding in holdings.items():
+            if holding:
+                script = self.utxo_db.get(b'po' + locations[key]) or b''
+                batch.put(b'j' + key, pack_le_uint64(holding) + script)
+                batch.put(b'q' + key[:ATOMICAL_ID_LEN] + pack_be_uint64(holding) + key[ATOMICAL_ID_LEN:], b'')
+        self.logger.info(f'indexed {len(holdings):,d} Atomicals holders')
+
+    def get_atomicals_balances(self, hashX):
+        '''Return a list of (atomical_id, value) pairs, one for each atomical
+        hashX holds, value being the sum of the values of its locations.'''
+        prefix = b'k' + hashX
+        return [(db_key[len(prefix):], unpack_le_uint64(db_value)[0])
+                for db_key, db_value in self.utxo_db.iterator(prefix=prefix)]
+
+    def build_atomicals_balance_index(self, batch):
+        balances = defaultdict(int)
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'a'):
+            atomical_id = db_key[1:1 + ATOMICAL_ID_LEN]
+            value_sats, = unpack_le_uint64(db_value[HASHX_LEN + SCRIPTHASH_LEN: HASHX_LEN + SCRIPTHASH_LEN + 8])
+            balances[db_value[:HASHX_LEN] + atomical_id] += value_sats
+        for key, balance in balances.items():
+            if balance:
+                batch.put(b'k' + key, pack_le_uint64(balance))
+        self.logger.info(f'indexed {len(balances):,d} Atomicals balances')
+
+    def get_distmint_count(self, atomical_id):
+        '''Return the number of flushed distributed mints of an atomical.'''
+        value = self.utxo_db.get(b'gc' + atomical_id)
+        if not value:
+            return 0
+        count, = unpack_le_uint64(value)
+        return count
+
+    def count_distmints_by_scan(self, atomical_id):
+        '''Count the flushed distributed mints of an atomical the slow way.
+
+        Used to audit the b'gc' counters.'''
+        return sum(1 for _key in self.utxo_db.iterator(prefix=b'gi' + atomical_id))
+
+    def build_distmint_count_index(self, batch):
+        counts = defaultdict(int)
+        for db_key, _db_value in self.utxo_db.iterator(prefix=b'gi'):
+            counts[db_key[2:2 + ATOMICAL_ID_LEN]] += 1
+        for atomical_id, count in counts.items():
+            batch.put(b'gc' + atomical_id, pack_le_uint64(count))
+        self.logger.info(f'counted distributed mints of {len(counts):,d} tickers')
+
+    def get_op_history_count(self, prefix):
+        '''Return the number of flushed txs under an op history prefix, such as
+        b'x' + hashX + op.'''
+        value = self.utxo_db.get(b'w' + prefix)
+        if not value:
+            return 0
+        count, = unpack_le_uint64(value)
+        return count
+
+    def get_op_history(self, hashX, op, limit, offset=0, reverse=True):
+        '''Return a page of the txs with the op in the history of a hashX, and
+        their total.
+
+        The txs are seeked in the b'x' index rather than filtered out of the
+        full history.  Each is a dict of its tx_num and op, newest first if
+        reverse.'''
+        prefix = b'x' + hashX + pack_byte(op)
+        key_len = len(prefix) + TXNUM_LEN
+        txnum_padding = bytes(8 - TXNUM_LEN)
+        history = []
+        if limit > 0:
+            for key, _value in self.utxo_db.iterator(prefix=prefix, reverse=reverse):
+                # Skip the keys of longer hashXs that have the prefix
+                if len(key) != key_len:
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                tx_num, = unpack_be_uint64(txnum_padding + key[-TXNUM_LEN:])
+                history.append({'tx_num': tx_num, 'op': op})
+                if len(history) >= limit:
+                    break
+        return history, self.get_op_history_count(prefix)
+
+    def get_atomicals_activity(self, limit, op=None, cursor=None, offset=0, reverse=True):
+        '''Return a page of the txs with an op across the chain, the cursor of
+        the next page, and their total.
+
+        The txs are those with the op, or with any op if it is None.  A page
+        skips offset txs, after the tx of the cursor if given.  Each tx is a
+        dict of its tx_num and op, newest first if reverse.  A cursor is the
+        be_tx_num of the last tx of a page, and is None after the last
+        page.'''
+        if op is None:
+            ops = [count_key[2:] for count_key, _value in self.utxo_db.iterator(prefix=b'wv')]
+        else:
+            ops = [pack_byte(op)]
+
+        def op_txs(op):
+            prefix = b'v' + op
+            if cursor is None:
+                keys = self.utxo_db.iterator(prefix=prefix, reverse=reverse)
+            else:
+                keys = self.utxo_db.iterator_from(prefix, prefix + cursor, reverse)
+            for key, _value in keys:
+                yield key[2:], op[0]
+
+        txnum_padding = bytes(8 - TXNUM_LEN)
+        history = []
+        next_cursor = None
+        if limit > 0:
+            # Each tx has a single op, so the txs of each op merge in tx order
+            for tx_numb, tx_op in heapq.merge(*(op_txs(op) for op in ops), reverse=reverse):
+                if tx_numb == cursor:
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                if len(history) == limit:
+                    next_cursor = pack_be_uint64(history[-1]['tx_num'])[-TXNUM_LEN:]
+                    break
+                tx_num, = unpack_be_uint64(txnum_padding + tx_numb)
+                history.append({'tx_num': tx_num, 'op': tx_op})
+        total = sum(self.get_op_history_count(b'v' + op) for op in ops)
+        return history, next_cursor, total
+
+    def backup_counted_op_history(self, batch, prefix, tx_count):
+        '''Remove the entries of the txs from tx_count on under each counted
+        op history prefix that is prefix followed by an op.  Return the
+        number removed.'''
+        first_removed = pack_be_uint64(tx_count)[-TXNUM_LEN:]
+        count_prefix = b'w' + prefix
+        removed_count = 0
+        for count_key, count_value in self.utxo_db.iterator(prefix=count_prefix):
+            # Skip the counters of longer hashXs that have the prefix
+            if len(count_key) != len(count_prefix) + 1:
+                continue
+            entry_prefix = count_key[1:]
+            key_len = len(entry_prefix) + TXNUM_LEN
+            removed = 0
+            for key, _value in self.utxo_db.iterator(prefix=entry_prefix, reverse=True):
+                if len(key) != key_len:
+                    continue
+                if key[-TXNUM_LEN:] < first_removed:
+                    break
+                batch.delete(key)
+                removed += 1
+            if removed:
+                count, = unpack_le_uint64(count_value)
+                if count > removed:
+                    batch.put(count_key, pack_le_uint64(count - removed))
+                else:
+                    batch.delete(count_key)
+                removed_count += removed
+        return removed_count
+
+    def backup_op_history(self, batch, hashXs, tx_count):
+        '''Remove the op history of the txs from tx_count on, both across the
+        chain and of the hashXs.'''
+        removed_count = self.backup_counted_op_history(batch, b'v', tx_count)
+        for hashX in sorted(hashXs):
+            self.backup_counted_op_history(batch, b'x' + hashX, tx_count)
+        self.logger.info(f'backing up removed the op history of {removed_count:,d} txs')
+
+    def read_tx_ops(self):
+        '''Return a map of the tx_num of each flushed tx with an op to its op
+        byte.'''
+        tx_ops = {}
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'op'):
+            if len(db_key) == 10:
+                tx_num, = unpack_le_uint64(db_key[2:])
+                tx_ops[tx_num] = db_value[:1]
+        return tx_ops
+
+    def build_op_history_index(self, batch):
+        tx_ops = self.read_tx_ops()
+        counts = defaultdict(int)
+        txnum_padding = bytes(8 - TXNUM_LEN)
+        for db_key, hist in self.history.db.iterator():
+            # Skip the history state
+            if db_key == b'state\0\0':
+                continue
+            hashX = db_key[:-FLUSHID_LEN]
+            for tx_numb in util.chunks(hist, TXNUM_LEN):
+                tx_num, = unpack_le_uint64(tx_numb + txnum_padding)
+                op = tx_ops.get(tx_num)
+                if op:
+                    prefix = b'x' + hashX + op
+                    batch.put(prefix + pack_be_uint64(tx_num)[-TXNUM_LEN:], b'')
+                    counts[prefix] += 1
+        for prefix, count in counts.items():
+            batch.put(b'w' + prefix, pack_le_uint64(count))
+        self.logger.info(f'indexed the op history of {len(tx_ops):,d} txs')
+
+    def build_atomicals_activity_index(self, batch):
+        counts = defaultdict(int)
+        for tx_num, op in self.read_tx_ops().items():
+            prefix = b'v' + op
+            batch.put(prefix + pack_be_uint64(tx_num)[-TXNUM_LEN:], b'')
+            counts[prefix] += 1
+        for prefix, count in counts.items():
+            batch.put(b'w' + prefix, pack_le_uint64(count))
+        self.logger.info(f'indexed the activity of {sum(counts.values()):,d} txs')
+
+    def derived_index_builders(self):
+        '''Map the name of each derived index to the function building it.'''
+        return {
+            'distmint_count': self.build_distmint_count_index,
+            'op_history': self.build_op_history_index,
+            'atomicals_activity': self.build_atomicals_activity_index,
+            'atomicals_balances': self.build_atomicals_balance_index,
+            'atomicals_holders': self.build_atomicals_holder_index,
+            # Built from the b'j' holdings so must follow them
+            'atomicals_supply': self.build_atomicals_supply_index,
+            'mod_state': self.build_mod_state_index,
+        }
+
+    def build_missing_indexes(self):
+        '''Build the derived indexes an existing DB does not have yet.'''
+        for name, build_index in self.derived_index_builders().items():
+            if name in self.built_indexes:
+                continue
+            self.logger.info(f'building {name} index; this can take some time...')
+            start = time.monotonic()
+            # Builders only put entries so a build interrupted by a crash
+            # can start over; its writes need not be committed at once
+            with ChunkedWriteBatch(self.utxo_db, self.INDEX_BUILD_BATCH_SIZE) as batch:
+                build_index(batch)
+            self.built_indexes.add(name)
+            with self.utxo_db.write_batch() as batch:
+                self.write_utxo_state(batch)
+            self.logger.info(f'built {name} index in {time.monotonic() - start:.1f}s')
+
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
         now = time.time()
@@ -701,6 +1610,7 @@ class DB:
         # Do not need to do anything with atomical_count for history.backup
         self.history.backup(touched, flush_data.tx_count)
         with self.utxo_db.write_batch() as batch:
+            self.backup_op_history(batch, touched, flush_data.tx_count)
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
@@ -783,6 +1693,22 @@ class DB:
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
+    def fs_tx_hashes(self, tx_nums):
+        '''Return a list of (tx_hash, tx_height) pairs, one for each of the
+        given tx numbers, as fs_tx_hash would.'''
+        tx_counts = self.tx_counts
+        db_height = self.db_height
+        view = self.hashes_file.view
+        result = []
+        append = result.append
+        for tx_num in tx_nums:
+            tx_height = bisect_right(tx_counts, tx_num)
+            if tx_height > db_height:
+                append((None, tx_height))
+            else:
+                append((bytes(view(tx_num * 32, 32)), tx_height))
+        return result
+
     def fs_tx_hashes_at_blockheight(self, block_height):
         '''Return a list of tx_hashes at given block height,
         in the same order as in the block.
@@ -795,9 +1721,9 @@ class DB:
         else:
             first_tx_num = 0
         num_txs_in_block = self.tx_counts[block_height] - first_tx_num
-        tx_hashes = self.hashes_file.read(first_tx_num * 32, num_txs_in_block * 32)
+        tx_hashes = self.hashes_file.view(first_tx_num * 32, num_txs_in_block * 32)
         assert num_txs_in_block == len(tx_hashes) // 32
-        return [tx_hashes[idx * 32: (idx+1) * 32] for idx in range(num_txs_in_block)]
+        return [bytes(tx_hashes[idx * 32: (idx+1) * 32]) for idx in range(num_txs_in_block)]
 
     async def tx_hashes_at_blockheight(self, block_height):
         return await run_in_thread(self.fs_tx_hashes_at_blockheight, block_height)
@@ -825,8 +1751,7 @@ class DB:
         '''
         def read_history():
             tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
+            return self.fs_tx_hashes(tx_nums)
 
         while True:
             history = await run_in_thread(read_history)
@@ -873,27 +1798,19 @@ class DB:
             batch_put(self.atomicals_undo_key(height), b''.join(atomicals_undo_info))
 
     def raw_block_prefix(self):
+        '''The prefix of the block files of the one-file-per-block store
+        the raw block ring replaced.'''
         return 'meta/block'
 
-    def raw_block_path(self, height):
-        return f'{self.raw_block_prefix()}{height:d}'
-
     def read_raw_block(self, height):
         '''Returns a raw block read from disk.  Raises FileNotFoundError
         if the block isn't on-disk.'''
-        with util.open_file(self.raw_block_path(height)) as f:
-            return f.read(-1)
+        return self.raw_blocks.read(height)
 
     def write_raw_block(self, block, height):
-        '''Write a raw block to disk.'''
-        with util.open_truncate(self.raw_block_path(height)) as f:
-            f.write(block)
-        # Delete old blocks to prevent them accumulating
-        try:
-            del_height = self.min_undo_height(height) - 1
-            os.remove(self.raw_block_path(del_height))
-        except FileNotFoundError:
-            pass
+        '''Write a raw block to disk.  It takes the place of the block that
+        fell out of the reorg window.'''
+        self.raw_blocks.write(height, block)
 
     def clear_excess_undo_info(self):
         '''Clear excess undo info.  Only most recent N are kept.'''
@@ -912,11 +1829,10 @@ class DB:
                     batch.delete(key)
             self.logger.info(f'deleted {len(keys):,d} stale undo entries')
 
-        # delete old block files
+        # delete the block files of the old store
         prefix = self.raw_block_prefix()
         paths = [path for path in glob(f'{prefix}[0-9]*')
-                 if len(path) > len(prefix)
-                 and int(path[len(prefix):]) < min_height]
+                 if path[len(prefix):].isdigit()]
         if paths:
             for path in paths:
                 try:
@@ -942,19 +1858,6 @@ class DB:
                     batch.delete(key)
             self.logger.info(f'deleted {len(keys):,d} stale atomicals undo entries')
 
-        # delete old block files
-        prefix = self.raw_block_prefix()
-        paths = [path for path in glob(f'{prefix}[0-9]*')
-                 if len(path) > len(prefix)
-                 and int(path[len(prefix):]) < min_height]
-        if paths:
-            for path in paths:
-                try:
-                    os.remove(path)
-                except FileNotFoundError:
-                    pass
-            self.logger.info(f'deleted {len(paths):,d} stale atomicals block files')
-
     # -- UTXO database
 
     def read_utxo_state(self):
@@ -968,6 +1871,7 @@ class DB:
             self.utxo_flush_count = 0
             self.wall_time = 0
             self.first_sync = True
+            self.built_indexes = set(self.derived_index_builders())
         else:
             state = ast.literal_eval(state.decode())
             if not isinstance(state, dict):
@@ -992,6 +1896,9 @@ class DB:
             self.utxo_flush_count = state['utxo_flush_count']
             self.wall_time = state['wall_time']
             self.first_sync = state['first_sync']
+            self.built_indexes = set(state.get('built_indexes', ()))
+            self.partial_flush = state.get('partial_flush', False)
+        self.finish_flush_journal()
 
         # These are our state as we move ahead of DB state
         self.fs_height = self.db_height
@@ -1105,6 +2012,21 @@ class DB:
             self.write_utxo_state(batch)
         self.logger.info('DB 2 of 3 upgraded successfully')
 
+    def finish_flush_journal(self):
+        '''Apply the journal of a chunked flush whose state was committed
+        before it was interrupted, or discard one that was not.'''
+        journal = FlushJournal(self.utxo_db, self.INDEX_BUILD_BATCH_SIZE)
+        if self.partial_flush:
+            count = journal.apply()
+            self.partial_flush = False
+            with self.utxo_db.write_batch() as batch:
+                self.write_utxo_state(batch)
+            self.logger.info(f'applied {count:,d} writes of an interrupted UTXO flush')
+        else:
+            count = journal.discard()
+            if count:
+                self.logger.info(f'discarded {count:,d} writes of an interrupted UTXO flush')
+
     def write_utxo_state(self, batch):
         '''Write (UTXO) state to the batch.'''
         state = {
@@ -1117,6 +2039,8 @@ class DB:
             'wall_time': self.wall_time,
             'first_sync': self.first_sync,
             'db_version': self.db_version,
+            'built_indexes': sorted(self.built_indexes),
+            'partial_flush': self.partial_flush,
         }
         batch.put(b'state', repr(state).encode())
 
@@ -1128,8 +2052,7 @@ class DB:
     async def all_utxos(self, hashX):
         '''Return all UTXOs for an address sorted in no particular order.'''
         def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
+            entries = []
             txnum_padding = bytes(8-TXNUM_LEN)
             # Key: b'u' + address_hashX + txout_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
@@ -1138,9 +2061,11 @@ class DB:
                 txout_idx, = unpack_le_uint32(db_key[-TXNUM_LEN-4:-TXNUM_LEN])
                 tx_num, = unpack_le_uint64(db_key[-TXNUM_LEN:] + txnum_padding)
                 value, = unpack_le_uint64(db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, txout_idx, tx_hash, height, value))
-            return utxos
+                entries.append((tx_num, txout_idx, value))
+            tx_hashes = self.fs_tx_hashes(tx_num for tx_num, _, _ in entries)
+            return [UTXO(tx_num, txout_idx, tx_hash, height, value)
+                    for (tx_num, txout_idx, value), (tx_hash, height)
+                    in zip(entries, tx_hashes)]
 
         while True:
             utxos = await run_in_thread(read_utxos)
@@ -1150,55 +2075,73 @@ class DB:
                                 f'found (reorg?), retrying...')
             await sleep(0.25)
  
+    def read_utxo_entries(self, prevouts, always_check_tx_hash=False):
+        '''Find the DB entries of UTXOs given as tx_hash + pack_le_uint32(tx_idx).
+
+        Return a map from each prevout found to a (hdb_key, udb_key,
+        utxo_value_packed) triple.  The b'h' and b'u' tables are read in key
+        order, which turns what would be random seeks into a mostly
+        sequential sweep.  A compressed tx hash matching several txs is
+        resolved by reading the full tx hash; if always_check_tx_hash it is
+        read even for a single match.
+        '''
+        txnum_padding = bytes(8-TXNUM_LEN)
+
+        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+        # Value: hashX
+        prevouts = sorted(set(prevouts))
+        h_prefixes = [b'h' + prevout[:COMP_TXID_LEN] + prevout[-4:] for prevout in prevouts]
+        u_reads = []
+        unchecked = []
+        # One forward sweep of the b'h' table reads the candidates of every prevout
+        for prevout, candidates in zip(prevouts, self.utxo_db.multi_prefix_items(h_prefixes)):
+            for hdb_key, hashX in candidates:
+                u_read = (b'u' + hashX + hdb_key[-4-TXNUM_LEN:], hdb_key, prevout)
+                if always_check_tx_hash or len(candidates) > 1:
+                    unchecked.append(u_read)
+                else:
+                    u_reads.append(u_read)
+
+        if unchecked:
+            tx_nums = [unpack_le_uint64(hdb_key[-TXNUM_LEN:] + txnum_padding)[0]
+                       for _udb_key, hdb_key, _prevout in unchecked]
+            for u_read, (tx_hash, _height) in zip(unchecked, self.fs_tx_hashes(tx_nums)):
+                if tx_hash == u_read[2][:32]:
+                    u_reads.append(u_read)
+
+        # Key: b'u' + address_hashX + tx_idx + tx_num
+        # Value: the UTXO value as a 64-bit unsigned integer
+        u_reads.sort()
+        values = self.utxo_db.multi_get([udb_key for udb_key, _, _ in u_reads])
+        entries = {}
+        for (udb_key, hdb_key, prevout), utxo_value_packed in zip(u_reads, values):
+            if utxo_value_packed and prevout not in entries:
+                entries[prevout] = (hdb_key, udb_key, utxo_value_packed)
+        return entries
+
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
         value) pair or None if not found.
 
         Used by the mempool code.
         '''
-        def lookup_hashXs():
-            '''Return (hashX, suffix) pairs, or None if not found,
-            for each prevout.
-            '''
-            def lookup_hashX(tx_hash, tx_idx):
-                idx_packed = pack_le_uint32(tx_idx)
-                txnum_padding = bytes(8-TXNUM_LEN)
-
-                # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-                # Value: hashX
-                prefix = b'h' + tx_hash[:COMP_TXID_LEN] + idx_packed
-
-                # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
-                    tx_num_packed = db_key[-TXNUM_LEN:]
-                    tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
-                    hash, _height = self.fs_tx_hash(tx_num)
-                    if hash == tx_hash:
-                        return hashX, idx_packed + tx_num_packed
-                return None, None
-            return [lookup_hashX(*prevout) for prevout in prevouts]
-
-        def lookup_utxos(hashX_pairs):
-            def lookup_utxo(hashX, suffix):
-                if not hashX:
-                    # This can happen when the daemon is a block ahead
-                    # of us and has mempool txs spending outputs from
-                    # that new block
-                    return None
-                # Key: b'u' + address_hashX + tx_idx + tx_num
-                # Value: the UTXO value as a 64-bit unsigned integer
-                key = b'u' + hashX + suffix
-                db_value = self.utxo_db.get(key)
-                if not db_value:
-                    # This can happen if the DB was updated between
-                    # getting the hashXs and getting the UTXOs
-                    return None
-                value, = unpack_le_uint64(db_value)
-                return hashX, value
-            return [lookup_utxo(*hashX_pair) for hashX_pair in hashX_pairs]
+        def lookup_utxos():
+            keys = [tx_hash + pack_le_uint32(tx_idx) for tx_hash, tx_idx in prevouts]
+            # Not found can happen when the daemon is a block ahead of us
+            # and has mempool txs spending outputs from that new block
+            entries = self.read_utxo_entries(keys, always_check_tx_hash=True)
+            result = []
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    result.append(None)
+                else:
+                    _hdb_key, udb_key, utxo_value_packed = entry
+                    value, = unpack_le_uint64(utxo_value_packed)
+                    result.append((udb_key[1:1 + HASHX_LEN], value))
+            return result
 
-        hashX_pairs = await run_in_thread(lookup_hashXs)
-        return await run_in_thread(lookup_utxos, hashX_pairs)
+        return await run_in_thread(lookup_utxos)
 
     # Get the raw mint information for an atomical
     def get_atomical_mint_info_dump(self, atomical_id):
@@ -1374,14 +2317,8 @@ class DB:
         return txs_list
 
     def get_active_supply(self, atomical_id):
-        active_supply = 0
-        atomical_active_location_key_prefix = b'a' + atomical_id
-        for atomical_active_location_key, atomical_active_location_value in self.utxo_db.iterator(prefix=atomical_active_location_key_prefix):
-            if atomical_active_location_value:
-                location = atomical_active_location_key[1 + ATOMICAL_ID_LEN : 1 + ATOMICAL_ID_LEN + ATOMICAL_ID_LEN]
-                location_value, = unpack_le_uint64(atomical_active_location_value[HASHX_LEN + SCRIPTHASH_LEN : HASHX_LEN + SCRIPTHASH_LEN + 8])
-                active_supply += location_value
-        return active_supply   
+        supply, _holders = self.get_location_summary(atomical_id)
+        return supply
 
     # Get the atomical details with location information added
     # In the case of NFTs, there will only be every 1 maximum active location
@@ -1433,37 +2370,11 @@ class DB:
         return await run_in_thread(query_location)
     
     # Get the atomical holder info details added.
-    async def populate_extended_atomical_holder_info(self, atomical_id, atomical):
-        def query_holders():
-            holder_dict = {}
-            holders = []
-            atomical_active_location_key_prefix = b'a' + atomical_id
-            # set for get holders
-            for atomical_active_location_key, atomical_active_location_value in self.utxo_db.iterator(prefix=atomical_active_location_key_prefix):
-                if atomical_active_location_value:
-                    location = atomical_active_location_key[1 + ATOMICAL_ID_LEN : 1 + ATOMICAL_ID_LEN + ATOMICAL_ID_LEN]
-                    atomical_output_script_key = b'po' + location
-                    atomical_output_script_value = self.utxo_db.get(atomical_output_script_key)
-                    location_script = atomical_output_script_value
-                    location_value, = unpack_le_uint64(atomical_active_location_value[HASHX_LEN + SCRIPTHASH_LEN : HASHX_LEN + SCRIPTHASH_LEN + 8])
-                    
-                    script = location_script.hex()
-                    if holder_dict.get(script, None):
-                        holder_dict[script] += location_value
-                    else:
-                        holder_dict[script] = location_value
-
-            for script, holding in holder_dict.items():
-                holders.append({
-                    "holding": holding,
-                    "script": script,
-                })
-
-            # Sort by holding count
-            holders.sort(key=lambda x: x['holding'], reverse=True)
-            atomical['holders'] = holders
-            return atomical
-        return await run_in_thread(query_holders)
+    async def populate_extended_atomical_holder_info(self, atomical_id, atomical, limit=None, offset=0):
+        '''Set the holders of an atomical, the largest holding first, read a
+        page at a time from the b'q' holder ranking.'''
+        atomical['holders'] = await run_in_thread(self.get_atomical_holders, atomical_id, limit, offset)
+        return atomical
 
     def dump(self):
         i_prefix = b'i'
@@ -1646,47 +2557,41 @@ class DB:
             })
         return entries
 
-    # Gets the paginated values of the db_prefix_key
-    async def get_dmitem_entries_paginated(self, parent_container_id, limit, offset):
-        entries = []
-        entries_deduped = {}
-        current_counter = 0
-        db_prefix = b'codmt'
-        db_prefix_len_with_parent = len(db_prefix) + 36
+    # Gets the paginated names of the dmitems of a container in name order, skipping offset names after the cursor name if given
+    # Also returns the cursor of the next page, which is the last name of the page, or None after the last page
+    async def get_dmitem_entries_paginated(self, parent_container_id, limit, offset, cursor=None):
+        if limit <= 0:
+            limit = 1
         db_search_prefix = b'codmt' + parent_container_id
-        for db_key, db_value in self.utxo_db.iterator(prefix=db_search_prefix):
-            if current_counter < offset:
-                current_counter += 1
+        if cursor is None:
+            keys = self.utxo_db.iterator(prefix=db_search_prefix)
+        else:
+            # The candidates of a name only differ in the tx_num, seek past all of them
+            cursor_enc = cursor.encode()
+            start = db_search_prefix + cursor_enc + pack_le_uint32(len(cursor_enc)) + b'\xff' * 8
+            keys = self.utxo_db.iterator_from(db_search_prefix, start)
+        entries = []
+        next_cursor = None
+        last_name_key = None
+        for db_key, _db_value in keys:
+            # Key: b'codmt' + parent_container_id + name + name_len (4 bytes) + tx_num (8 bytes)
+            name_key = db_key[len(db_search_prefix):-8]
+            if name_key == last_name_key:
+                continue
+            last_name_key = name_key
+            if offset > 0:
+                offset -= 1
                 continue
-            if current_counter > offset + limit:
+            if len(entries) == limit:
+                next_cursor = entries[-1]
                 break
-            # Use 4 bytes because of store name len as 4 bytes
-            name_len, = unpack_le_uint32_from(db_key[-10:-6])
-            dmitem_name = db_key[len(db_prefix)]
-            if entries_deduped.get(dmitem_name):
-                continue 
-            dmitem_name_str = db_key[db_prefix_len_with_parent : db_prefix_len_with_parent + name_len].decode()
-            entries_deduped[dmitem_name_str] = {
-                'dmitem_name': dmitem_name_str,
-                'db_key': db_key,
-                'db_value': db_value,
-                'counter': current_counter
-            }
-            current_counter += 1
-
-        entries_intermediate = []
-        for entry_key, entry_value in entries_deduped.items():
-            entries_intermediate.append({
-                'dmitem_name': entry_value['dmitem_name'],
-                'counter': entry_value['counter']
-            })
-        entries_intermediate.sort(key=lambda x: x['counter'])
-        for item in entries_intermediate:
-            entries.append(item['dmitem_name'])
-        return entries
+            entries.append(name_key[:-4].decode())
+        return entries, next_cursor
 
     # Perform a search (usually through session rpc) to query for names. 
-    def get_name_entries_template_limited(self, db_prefix, parent_prefix, subject_encoded, Reverse=False, Limit=100, Offset=0):
+    # A page skips Offset entries, after the entry of the Cursor if given. A cursor is the key of the last entry of a page after
+    # the prefix and parent, and the cursor of the next page is returned with the entries, or None after the last page.
+    def get_name_entries_template_limited(self, db_prefix, parent_prefix, subject_encoded, Reverse=False, Limit=100, Offset=0, Cursor=None):
         if Limit <= 0:
             Limit = 1
         if Limit > 1000:
@@ -1704,38 +2609,48 @@ class DB:
         if subject_encoded:
             db_key_prefix_with_subject = db_key_prefix + subject_encoded
 
-        entries = []
-        limit_count = 0
-        start_count = 0
         reverse_bool = False
         if Reverse:
             reverse_bool = True 
         else:
             reverse_bool = False
-        for db_key, db_value in self.utxo_db.iterator(prefix=db_key_prefix_with_subject, reverse=reverse_bool):
+        if Cursor is None:
+            keys = self.utxo_db.iterator(prefix=db_key_prefix_with_subject, reverse=reverse_bool)
+        elif (db_key_prefix + Cursor).startswith(db_key_prefix_with_subject):
+            keys = self.utxo_db.iterator_from(db_key_prefix_with_subject, db_key_prefix + Cursor, reverse_bool)
+        else:
+            # The cursor is not of this search
+            return [], None
+
+        entries = []
+        next_cursor = None
+        start_count = 0
+        db_key_prefix_len = len(db_key_prefix)
+        for db_key, db_value in keys:
+            if Cursor is not None and db_key == db_key_prefix + Cursor:
+                continue
             if start_count < Offset: 
                 start_count += 1
                 continue 
+            if len(entries) == Limit:
+                next_cursor = last_key[db_key_prefix_len:]
+                break
             tx_numb = db_key[-8:]
             tx_num, = unpack_le_uint64(tx_numb)
             # Use 4 bytes because of store name len as 4 bytes
-            name_len, = unpack_le_uint32_from(db_key[-10:-6])
-            db_key_prefix_len = len(db_key_prefix)
+            name_len, = unpack_le_uint32_from(db_key[-12:-8])
             entries.append({
                 'name': db_key[db_key_prefix_len : db_key_prefix_len + name_len].decode(), # Extract the name portion
                 'name_hex': db_key[db_key_prefix_len : db_key_prefix_len + name_len].hex(),  
                 'atomical_id': db_value,
                 'tx_num': tx_num
             })
-            limit_count += 1
-            if limit_count == Limit:
-                break
-        return entries
+            last_key = db_key
+        return entries, next_cursor
  
     # Populate the latest state of an atomical for a path
     def populate_extended_mod_state_latest_atomical_info(self, atomical_id, atomical, height):
-        mod_history = self.get_mod_history(atomical_id, height)
-        latest_state = calculate_latest_state_from_mod_history(mod_history)
+        latest_state = self.get_mod_state(atomical_id, height)
         latest_state_auto_encoded = auto_encode_bytes_elements(latest_state)
         atomical['state'] = {
             'latest': latest_state_auto_encoded
@@ -1743,45 +2658,53 @@ class DB:
         return atomical
  
     # Populate the mod state history for an atomical
-    def get_mod_history(self, atomical_id, max_height):
-        return self.get_mod_or_event_history(atomical_id, max_height, b'mod')
+    def get_mod_history(self, atomical_id, max_height, limit=None, offset=0):
+        return self.get_mod_or_event_history(atomical_id, max_height, b'mod', limit, offset)
 
     # Populate the evt state history for an atomical
-    def get_evt_history(self, atomical_id, max_height):
-        return self.get_mod_or_event_history(atomical_id, max_height, b'evt')
+    def get_evt_history(self, atomical_id, max_height, limit=None, offset=0):
+        return self.get_mod_or_event_history(atomical_id, max_height, b'evt', limit, offset)
 
-    # Populate mod or event history for an atomical
-    def get_mod_or_event_history(self, atomical_id, max_height, prefix_key):
+    # Populate mod or event history for an atomical, newest first, skipping the first offset entries
+    def get_mod_or_event_history(self, atomical_id, max_height, prefix_key, limit=None, offset=0):
         PREFIX_BYTE_LEN = 3
         prefix = prefix_key + atomical_id
-        history = []
+        max_tx_num = self.tx_counts[max_height] - 1 if max_height < len(self.tx_counts) else None
+        entries = []
         for db_key, db_value in self.utxo_db.iterator(prefix=prefix, reverse=True):
-            # Key: b'mod' + atomical_id + tx_hash + out_idx
-            tx_hash = db_key[ PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN]
-            tx_num, tx_height = self.get_tx_num_height_from_tx_hash(tx_hash)
-            # Requested limits on history
-            if tx_height > max_height:
+            # Key: b'mod' + atomical_id + tx_numb + tx_hash + out_idx
+            tx_numb = db_key[PREFIX_BYTE_LEN + ATOMICAL_ID_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN]
+            tx_num, = unpack_le_uint64(tx_numb + bytes(8 - TXNUM_LEN))
+            # Requested limits on history.  The keys hold the tx number little
+            # endian, so are not in tx order, and the history stops at the first
+            # later entry.  Mint validation depends on which entries that keeps
+            if max_tx_num is not None and tx_num > max_tx_num:
                 break
-            out_idx_packed = db_key[ PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN + 4]
+            entries.append((tx_num, db_key, db_value))
+        # Sort by descending tx_num
+        entries.sort(reverse=True)
+        stop = None if limit is None else offset + limit
+        history = []
+        for tx_num, db_key, db_value in islice(entries, offset, stop):
+            tx_hash = db_key[PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN]
+            out_idx_packed = db_key[PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN: PREFIX_BYTE_LEN + ATOMICAL_ID_LEN + TXNUM_LEN + TX_HASH_LEN + 4]
             out_idx, = unpack_le_uint32(out_idx_packed)
             entry = {
                 'tx_num': tx_num, 
-                'height': tx_height, 
+                'height': bisect_right(self.tx_counts, tx_num), 
                 'txid': hash_to_hex_str(tx_hash), 
                 'index': out_idx,
                 'data': loads(db_value)
             }
             history.append(entry)
-        # Sort by descending tx_num
-        history.sort(key=lambda x: x['tx_num'], reverse=True)
         return history
  
     # Populate the mod(ify) state information for an Atomical.
     # There could be potentially many updates for an Atomical and this should be called to enumerate the entire state history
     # From the state history, clients can reconstruct the "latest state" of an Atomical dynamic data fields
-    def populate_extended_mod_state_history_atomical_info(self, atomical_id, atomical, max_height):
+    def populate_extended_mod_state_history_atomical_info(self, atomical_id, atomical, max_height, limit=None, offset=0):
         atomical['state'] = {
-            'history': self.get_mod_history(atomical_id, max_height)
+            'history': self.get_mod_history(atomical_id, max_height, limit, offset)
         }
         return atomical
 
@@ -1790,9 +2713,9 @@ class DB:
     # From the event history, clients can play back all of the events emitted for an Atomical.
     # This is very similar to the "mod" operation, but the semantics are different and follow an emit/event like pattern
     # ...whereas the "mod" operation is intended to modify stable state.
-    def populate_extended_events_atomical_info(self, atomical_id, atomical, max_height):
+    def populate_extended_events_atomical_info(self, atomical_id, atomical, max_height, limit=None, offset=0):
         atomical['events'] = {
-            'history': self.get_evt_history(atomical_id, max_height)
+            'history': self.get_evt_history(atomical_id, max_height, limit, offset)
         }
         return atomical
     
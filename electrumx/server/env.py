@@ -76,6 +76,14 @@ class Env(EnvBase):
         self.blacklist_url = self.default('BLACKLIST_URL', self.coin.BLACKLIST_URL)
         self.cache_MB = self.integer('CACHE_MB', 1200)
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
+        self.block_parse_workers = self.integer('BLOCK_PARSE_WORKERS', 0)
+        self.atomicals_location_filter = self.boolean('ATOMICALS_LOCATION_FILTER', True)
+        self.dft_mint_count_audit = self.boolean('DFT_MINT_COUNT_AUDIT', False)
+        self.active_supply_audit = self.boolean('ACTIVE_SUPPLY_AUDIT', False)
+        self.batch_utxo_lookups = self.boolean('BATCH_UTXO_LOOKUPS', True)
+        self.flush_batch_MB = self.integer('FLUSH_BATCH_MB', 0)
+        self.background_flush = self.boolean('BACKGROUND_FLUSH', False)
+        self.history_compaction_flushes = self.integer('HISTORY_COMPACTION_FLUSHES', 0)
         self.daemon_poll_interval_blocks_msec = self.integer('DAEMON_POLL_INTERVAL_BLOCKS', 5000)
         self.daemon_poll_interval_mempool_msec = self.integer('DAEMON_POLL_INTERVAL_MEMPOOL', 5000)
 
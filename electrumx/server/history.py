@@ -10,6 +10,7 @@
 
 import ast
 import bisect
+import threading
 import time
 from array import array
 from collections import defaultdict
@@ -45,6 +46,9 @@ class History:
         self.comp_cursor = -1
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
+        # Taken by flushes, backups and compaction steps, which run in
+        # different threads when the history is compacted online
+        self.lock = threading.Lock()
 
         # Key: address_hashX + flush_id
         # Value: sorted "list" of tx_nums in history of hashX
@@ -55,15 +59,13 @@ class History:
             db_class: Type['Storage'],
             for_sync: bool,
             utxo_flush_count: int,
-            compacting: bool,
+            utxo_tx_count: int,
     ):
         self.db = db_class('hist', for_sync)
         self.read_state()
-        self.clear_excess(utxo_flush_count)
-        # An incomplete compaction needs to be cancelled otherwise
-        # restarting it will corrupt the history
-        if not compacting:
-            self._cancel_compaction()
+        # An incomplete compaction is kept; flushes write around its
+        # cursor so it can be resumed
+        self.clear_excess(utxo_flush_count, utxo_tx_count)
         return self.flush_count
 
     def close_db(self):
@@ -99,27 +101,45 @@ class History:
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info(f'flush count: {self.flush_count:,d}')
 
-    def clear_excess(self, utxo_flush_count):
-        # < might happen at end of compaction as both DBs cannot be
-        # updated atomically
-        if self.flush_count <= utxo_flush_count:
+    def clear_excess(self, utxo_flush_count, utxo_tx_count):
+        if self.flush_count == utxo_flush_count:
             return
 
         self.logger.info('DB shut down uncleanly.  Scanning for '
                          'excess history flushes...')
 
         keys = []
-        for key, _hist in self.db.iterator(prefix=b''):
-            flush_id, = unpack_be_uint16_from(key[-FLUSHID_LEN:])
-            if flush_id > utxo_flush_count:
-                keys.append(key)
-
-        self.logger.info(f'deleting {len(keys):,d} history entries')
-
-        self.flush_count = utxo_flush_count
+        puts = {}
+        if self.comp_cursor == -1 and self.flush_count > utxo_flush_count:
+            for key, _hist in self.db.iterator(prefix=b''):
+                flush_id, = unpack_be_uint16_from(key[-FLUSHID_LEN:])
+                if flush_id > utxo_flush_count:
+                    keys.append(key)
+        else:
+            # Flushes during a compaction write the hashXs it has passed
+            # under comp_flush_count, and it may have merged their rows
+            # since, so find the excess by tx number instead.  So too if
+            # a compaction finished but the UTXO DB did not record the
+            # flush count it was reset to, as the two cannot be updated
+            # atomically.  The Atomicals rows have longer hashXs
+            for key, hist in self.db.iterator(prefix=b''):
+                if key == b'state\0\0':
+                    continue
+                idx = bisect.bisect_left(self._tx_nums(hist), utxo_tx_count)
+                if idx == 0:
+                    keys.append(key)
+                elif idx < len(hist) // TXNUM_LEN:
+                    puts[key] = hist[:TXNUM_LEN * idx]
+
+        self.logger.info(f'deleting {len(keys):,d} and truncating '
+                         f'{len(puts):,d} history entries')
+
+        self.flush_count = min(self.flush_count, utxo_flush_count)
         with self.db.write_batch() as batch:
             for key in keys:
                 batch.delete(key)
+            for key, value in puts.items():
+                batch.put(key, value)
             self.write_state(batch)
 
         self.logger.info('deleted excess history entries')
@@ -154,21 +174,49 @@ class History:
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def freeze_unflushed(self):
+        '''Detach and return the unflushed history for a background flush.'''
+        unflushed = self.unflushed
+        self.unflushed = defaultdict(bytearray)
+        self.unflushed_count = 0
+        return unflushed
+
+    def flush(self, unflushed=None):
+        '''Flush the unflushed history, or that returned by freeze_unflushed().'''
+        with self.lock:
+            self._flush(unflushed)
+
+    def _flush(self, unflushed):
         start_time = time.monotonic()
         self.flush_count += 1
         flush_id = pack_be_uint16(self.flush_count)
-        unflushed = self.unflushed
+        if unflushed is None:
+            unflushed = self.unflushed
+            self.unflushed_count = 0
+
+        # The hashXs a compaction has passed must sort after their
+        # compacted rows; see the compaction comments below
+        comp_prefix = b''
+        if self.comp_cursor != -1:
+            self.comp_flush_count += 1
+            comp_flush_id = pack_be_uint16(self.comp_flush_count)
+            if self.comp_cursor < 65536:
+                comp_prefix = pack_be_uint16(self.comp_cursor)
+            else:
+                # Sorts after every hashX
+                comp_prefix = b'\xff' * (HASHX_LEN + 1)
 
         with self.db.write_batch() as batch:
             for hashX in sorted(unflushed):
-                key = hashX + flush_id
+                if hashX < comp_prefix:
+                    key = hashX + comp_flush_id
+                else:
+                    key = hashX + flush_id
                 batch.put(key, bytes(unflushed[hashX]))
             self.write_state(batch)
 
         count = len(unflushed)
         unflushed.clear()
-        self.unflushed_count = 0
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -176,6 +224,10 @@ class History:
                              f'for {count:,d} addrs')
 
     def backup(self, hashXs, tx_count):
+        with self.lock:
+            self._backup(hashXs, tx_count)
+
+    def _backup(self, hashXs, tx_count):
         # Not certain this is needed, but it doesn't hurt
         self.flush_count += 1
         nremoves = 0
@@ -208,6 +260,15 @@ class History:
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
+    @staticmethod
+    def _tx_nums(hist):
+        '''Return the tx numbers of a history row as an array.'''
+        txnum_padding = bytes(8-TXNUM_LEN)
+        return array(
+            'Q',
+            b''.join(item + txnum_padding for item in util.chunks(hist, TXNUM_LEN))
+        )
+
     def get_txnums(self, hashX, limit=1000):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
@@ -241,17 +302,57 @@ class History:
     #     are used, so a parallel history flush must first increment this
     #
     # When compaction is complete and the final flush takes place,
-    # flush_count is reset to comp_flush_count, and comp_flush_count to -1
+    # flush_count is reset to comp_flush_count, and comp_flush_count to -1.
+    # The final flush is that of the UTXO DB, which records the reset
+    # flush count right after; see finish_compaction()
+    #
+    # A server compacts online a step at a time, each under the lock
+    # so flushes only happen between steps.
+
+    def start_compaction(self):
+        '''Start a compaction if one is not in progress.'''
+        with self.lock:
+            if self.comp_cursor == -1:
+                self.comp_cursor = 0
+                self.comp_flush_count = max(self.comp_flush_count, 1)
+
+    def compaction_step(self, limit):
+        '''Compact history until about limit bytes have been written.
+        Return the bytes written.'''
+        with self.lock:
+            if self.comp_cursor in (-1, 65536):
+                return 0
+            return self._compact_history(limit)
+
+    def finish_compaction(self):
+        '''Reset the flush count if a compaction is complete in-memory.
+        Return True if it was.
+
+        Called when the UTXO DB is flushed, which then records the reset
+        flush count.  Until it does, clear_excess() cannot trust the
+        flush IDs.'''
+        with self.lock:
+            if self.comp_cursor != 65536:
+                return False
+            self.flush_count = self.comp_flush_count
+            self.comp_cursor = -1
+            self.comp_flush_count = -1
+            with self.db.write_batch() as batch:
+                self.write_state(batch)
+        self.logger.info(f'history compaction complete; flush count '
+                         f'is now {self.flush_count:,d}')
+        return True
+
+    def compaction_progress(self):
+        '''Return the fraction of a compaction in progress done, or None.'''
+        if self.comp_cursor == -1:
+            return None
+        return self.comp_cursor / 65536
 
     def _flush_compaction(self, cursor, write_items, keys_to_delete):
         '''Flush a single compaction pass as a batch.'''
         # Update compaction state
-        if cursor == 65536:
-            self.flush_count = self.comp_flush_count
-            self.comp_cursor = -1
-            self.comp_flush_count = -1
-        else:
-            self.comp_cursor = cursor
+        self.comp_cursor = cursor
 
         # History DB.  Flush compacted history and updated state
         with self.db.write_batch() as batch:
@@ -354,12 +455,6 @@ class History:
         )
         return write_size
 
-    def _cancel_compaction(self):
-        if self.comp_cursor != -1:
-            self.logger.warning('cancelling in-progress history compaction')
-            self.comp_flush_count = -1
-            self.comp_cursor = -1
-
     #
     # DB upgrade
     #
@@ -15,8 +15,9 @@ from electrumx.lib.atomicals_blueprint_builder import AtomicalsTransferBlueprint
 from electrumx.lib.hash import HASHX_LEN, double_sha256, hash_to_hex_str, hex_str_to_hash, sha256
 import electrumx.lib.util as util
 from electrumx.lib.script2addr import get_address_from_output_script
-from electrumx.lib.util_atomicals import DFT_MINT_MAX_MAX_COUNT_DENSITY, DMINT_PATH, MINT_SUBNAME_RULES_BECOME_EFFECTIVE_IN_BLOCKS, SUBREALM_MINT_PATH, AtomicalsValidationError, auto_encode_bytes_elements, calculate_latest_state_from_mod_history, compact_to_location_id_bytes, format_name_type_candidates_to_rpc, format_name_type_candidates_to_rpc_for_subname, is_compact_atomical_id, location_id_bytes_to_compact, parse_protocols_operations_from_witness_array, validate_merkle_proof_dmint, validate_rules_data
+from electrumx.lib.util_atomicals import DFT_MINT_MAX_MAX_COUNT_DENSITY, DMINT_PATH, MINT_SUBNAME_RULES_BECOME_EFFECTIVE_IN_BLOCKS, SUBREALM_MINT_PATH, AtomicalsValidationError, auto_encode_bytes_elements, compact_to_location_id_bytes, format_name_type_candidates_to_rpc, format_name_type_candidates_to_rpc_for_subname, is_compact_atomical_id, location_id_bytes_to_compact, parse_protocols_operations_from_witness_array, validate_merkle_proof_dmint
 from electrumx.server.daemon import DaemonError
+from electrumx.server.history import TXNUM_LEN
 
 
 BAD_REQUEST = 1
@@ -490,12 +491,18 @@ class HttpHandler(object):
         return atomical_in_mempool
     
     # Perform a search for tickers, containers, realms, subrealms 
-    def atomicals_search_name_template(self, db_prefix, name_type_str, parent_prefix=None, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False):
+    # Pages are seeked by offset, or by the cursor returned with the previous page
+    def atomicals_search_name_template(self, db_prefix, name_type_str, parent_prefix=None, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False, Cursor=None):
         search_prefix = b''
         if prefix:
             search_prefix = prefix.encode()
+        if Cursor is not None:
+            try:
+                Cursor = bytes.fromhex(Cursor)
+            except (TypeError, ValueError):
+                raise RPCError(BAD_REQUEST, f'invalid cursor')
 
-        db_entries = self.db.get_name_entries_template_limited(db_prefix, parent_prefix, search_prefix, Reverse, Limit, Offset)
+        db_entries, next_cursor = self.db.get_name_entries_template_limited(db_prefix, parent_prefix, search_prefix, Reverse, Limit, Offset, Cursor)
         formatted_results = []
         for item in db_entries:
             if name_type_str == "ticker":
@@ -518,7 +525,7 @@ class HttpHandler(object):
                 formatted_results.append(obj)
             elif not is_verified_only:
                 formatted_results.append(obj)
-        return {'result': formatted_results}
+        return {'result': formatted_results, 'cursor': next_cursor.hex() if next_cursor else None}
     
     def auto_populate_container_dmint_items_fields(self, items):
         if not items or not isinstance(items, dict):
@@ -533,7 +540,7 @@ class HttpHandler(object):
         search_prefix = b''
         if prefix:
             search_prefix = prefix.encode()
-        db_entries = self.db.get_name_entries_template_limited(db_prefix, None, search_prefix, Reverse, Limit, Offset)
+        db_entries, _ = self.db.get_name_entries_template_limited(db_prefix, None, search_prefix, Reverse, Limit, Offset)
         formatted_results = []
         for item in db_entries:
             atomical_id = location_id_bytes_to_compact(item['atomical_id'])
@@ -583,125 +590,86 @@ class HttpHandler(object):
         return returned_utxos
     
     async def hashX_ft_balances_atomicals(self, hashX):
-        utxos = await self.db.all_utxos(hashX)
-        utxos = sorted(utxos)
-        # Comment out the utxos for now and add it in later
-        # utxos.extend(await self.mempool.unordered_UTXOs(hashX))
-        spends = [] # await self.mempool.potential_spends(hashX)
-        returned_utxos = []
-        atomicals_id_map = {}
-        for utxo in utxos:
-            if (utxo.tx_hash, utxo.tx_pos) in spends:
-                continue
-            atomicals = self.db.get_atomicals_by_utxo(utxo, True)
-            atomicals_basic_infos = []
-            for atomical_id in atomicals: 
-                # This call is efficient in that it's cached underneath
-                # For now we only show the atomical id because it can always be fetched separately and it will be more efficient
-                atomical_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id) 
-                atomical_id_compact = location_id_bytes_to_compact(atomical_id)
-                atomicals_id_map[atomical_id_compact] = atomical_basic_info
-                atomicals_basic_infos.append(atomical_id_compact)
-            if len(atomicals) > 0:
-                returned_utxos.append({'txid': hash_to_hex_str(utxo.tx_hash),
-                'index': utxo.tx_pos,
-                'vout': utxo.tx_pos,
-                'height': utxo.height,
-                'value': utxo.value,
-                'atomicals': atomicals_basic_infos})
+        # One entry for each atomical held, read from the balances index
+        balances = await aiorpcx.run_in_thread(self.db.get_atomicals_balances, hashX)
         # Aggregate balances
         return_struct = {
             'balances': {}
         }
-        for returned_utxo in returned_utxos: 
-            for atomical_id_entry_compact in returned_utxo['atomicals']:
-                atomical_id_basic_info = atomicals_id_map[atomical_id_entry_compact]
-                atomical_id_compact = atomical_id_basic_info['atomical_id']
-                assert(atomical_id_compact == atomical_id_entry_compact)
-                if atomical_id_basic_info.get('type') == 'FT':
-                    if return_struct['balances'].get(atomical_id_compact) == None:
-                        return_struct['balances'][atomical_id_compact] = {}
-                        return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
-                        return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
-                        return_struct['balances'][atomical_id_compact]['confirmed'] = 0
-                    if returned_utxo['height'] > 0:
-                        return_struct['balances'][atomical_id_compact]['confirmed'] += returned_utxo['value']
+        for atomical_id, value in balances:
+            # This call is efficient in that it's cached underneath
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if atomical_id_basic_info.get('type') == 'FT':
+                if return_struct['balances'].get(atomical_id_compact) == None:
+                    return_struct['balances'][atomical_id_compact] = {}
+                    return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                    return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
+                    return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+                    return_struct['balances'][atomical_id_compact]['unconfirmed'] = 0
+                return_struct['balances'][atomical_id_compact]['confirmed'] += value
+        # Add the transfers pending in the mempool
+        for atomical_id, delta in (await self.mempool.atomicals_balance_delta(hashX)).items():
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            if not atomical_id_basic_info or atomical_id_basic_info.get('type') != 'FT':
+                continue
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if return_struct['balances'].get(atomical_id_compact) == None:
+                return_struct['balances'][atomical_id_compact] = {}
+                return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
+                return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+            return_struct['balances'][atomical_id_compact]['unconfirmed'] = delta
         return return_struct
 
     async def hashX_nft_balances_atomicals(self, hashX):
         Verbose = False
-        utxos = await self.db.all_utxos(hashX)
-        utxos = sorted(utxos)
-        # Comment out the utxos for now and add it in later
-        # utxos.extend(await self.mempool.unordered_UTXOs(hashX))
-        spends = [] # await self.mempool.potential_spends(hashX)
-        returned_utxos = []
-        atomicals_id_map = {}
-        for utxo in utxos:
-            if (utxo.tx_hash, utxo.tx_pos) in spends:
-                continue
-            atomicals = self.db.get_atomicals_by_utxo(utxo, True)
-            atomicals_basic_infos = []
-            for atomical_id in atomicals: 
-                # This call is efficient in that it's cached underneath
-                # For now we only show the atomical id because it can always be fetched separately and it will be more efficient
-                atomical_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id) 
-                atomical_id_compact = location_id_bytes_to_compact(atomical_id)
-                atomicals_id_map[atomical_id_compact] = atomical_basic_info
-                atomicals_basic_infos.append(atomical_id_compact)
-            if len(atomicals) > 0:
-                returned_utxos.append({'txid': hash_to_hex_str(utxo.tx_hash),
-                'index': utxo.tx_pos,
-                'vout': utxo.tx_pos,
-                'height': utxo.height,
-                'value': utxo.value,
-                'atomicals': atomicals_basic_infos})
+        # One entry for each atomical held, read from the balances index
+        balances = await aiorpcx.run_in_thread(self.db.get_atomicals_balances, hashX)
         # Aggregate balances
         return_struct = {
             'balances': {}
         }
-        for returned_utxo in returned_utxos: 
-            for atomical_id_entry_compact in returned_utxo['atomicals']:
-                atomical_id_basic_info = atomicals_id_map[atomical_id_entry_compact]
-                atomical_id_compact = atomical_id_basic_info['atomical_id']
-                assert(atomical_id_compact == atomical_id_entry_compact)
-                if atomical_id_basic_info.get('type') == 'NFT':
-                    if return_struct['balances'].get(atomical_id_compact) == None:
-                        return_struct['balances'][atomical_id_compact] = {}
-                        return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
-                        return_struct['balances'][atomical_id_compact]['confirmed'] = 0
-                    if atomical_id_basic_info.get('subtype'):
-                        return_struct['balances'][atomical_id_compact]['subtype'] = atomical_id_basic_info.get('subtype')
-                    if atomical_id_basic_info.get('$request_container'):
-                        return_struct['balances'][atomical_id_compact]['request_container'] = atomical_id_basic_info.get('$request_container')
-                    if atomical_id_basic_info.get('$container'):
-                        return_struct['balances'][atomical_id_compact]['container'] = atomical_id_basic_info.get('$container')
-                    if atomical_id_basic_info.get('$dmitem'):
-                        return_struct['balances'][atomical_id_compact]['dmitem'] = atomical_id_basic_info.get('$dmitem')
-                    if atomical_id_basic_info.get('$request_dmitem'):
-                        return_struct['balances'][atomical_id_compact]['request_dmitem'] = atomical_id_basic_info.get('$request_dmitem')
-                    if atomical_id_basic_info.get('$realm'):
-                        return_struct['balances'][atomical_id_compact]['realm'] = atomical_id_basic_info.get('$realm')
-                    if atomical_id_basic_info.get('$request_realm'):
-                        return_struct['balances'][atomical_id_compact]['request_realm'] = atomical_id_basic_info.get('$request_realm')
-                    if atomical_id_basic_info.get('$subrealm'):
-                        return_struct['balances'][atomical_id_compact]['subrealm'] = atomical_id_basic_info.get('$subrealm')
-                    if atomical_id_basic_info.get('$request_subrealm'):
-                        return_struct['balances'][atomical_id_compact]['request_subrealm'] = atomical_id_basic_info.get('$request_subrealm')
-                    if atomical_id_basic_info.get('$full_realm_name'):
-                        return_struct['balances'][atomical_id_compact]['full_realm_name'] = atomical_id_basic_info.get('$full_realm_name')
-                    if atomical_id_basic_info.get('$parent_container'):
-                        return_struct['balances'][atomical_id_compact]['parent_container'] = atomical_id_basic_info.get('$parent_container')
-                    if atomical_id_basic_info.get('$parent_realm'):
-                        return_struct['balances'][atomical_id_compact]['parent_realm'] = atomical_id_basic_info.get('$parent_realm')
-                    if atomical_id_basic_info.get('$parent_container_name'):
-                        return_struct['balances'][atomical_id_compact]['parent_container_name'] = atomical_id_basic_info.get('$parent_container_name')
-                    if atomical_id_basic_info.get('$bitwork'):
-                        return_struct['balances'][atomical_id_compact]['bitwork'] = atomical_id_basic_info.get('$bitwork')
-                    if atomical_id_basic_info.get('$parents'):
-                        return_struct['balances'][atomical_id_compact]['parents'] = atomical_id_basic_info.get('$parents')
-                    if returned_utxo['height'] > 0:
-                        return_struct['balances'][atomical_id_compact]['confirmed'] += returned_utxo['value']
+        for atomical_id, value in balances:
+            # This call is efficient in that it's cached underneath
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if atomical_id_basic_info.get('type') == 'NFT':
+                if return_struct['balances'].get(atomical_id_compact) == None:
+                    return_struct['balances'][atomical_id_compact] = {}
+                    return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                    return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+                if atomical_id_basic_info.get('subtype'):
+                    return_struct['balances'][atomical_id_compact]['subtype'] = atomical_id_basic_info.get('subtype')
+                if atomical_id_basic_info.get('$request_container'):
+                    return_struct['balances'][atomical_id_compact]['request_container'] = atomical_id_basic_info.get('$request_container')
+                if atomical_id_basic_info.get('$container'):
+                    return_struct['balances'][atomical_id_compact]['container'] = atomical_id_basic_info.get('$container')
+                if atomical_id_basic_info.get('$dmitem'):
+                    return_struct['balances'][atomical_id_compact]['dmitem'] = atomical_id_basic_info.get('$dmitem')
+                if atomical_id_basic_info.get('$request_dmitem'):
+                    return_struct['balances'][atomical_id_compact]['request_dmitem'] = atomical_id_basic_info.get('$request_dmitem')
+                if atomical_id_basic_info.get('$realm'):
+                    return_struct['balances'][atomical_id_compact]['realm'] = atomical_id_basic_info.get('$realm')
+                if atomical_id_basic_info.get('$request_realm'):
+                    return_struct['balances'][atomical_id_compact]['request_realm'] = atomical_id_basic_info.get('$request_realm')
+                if atomical_id_basic_info.get('$subrealm'):
+                    return_struct['balances'][atomical_id_compact]['subrealm'] = atomical_id_basic_info.get('$subrealm')
+                if atomical_id_basic_info.get('$request_subrealm'):
+                    return_struct['balances'][atomical_id_compact]['request_subrealm'] = atomical_id_basic_info.get('$request_subrealm')
+                if atomical_id_basic_info.get('$full_realm_name'):
+                    return_struct['balances'][atomical_id_compact]['full_realm_name'] = atomical_id_basic_info.get('$full_realm_name')
+                if atomical_id_basic_info.get('$parent_container'):
+                    return_struct['balances'][atomical_id_compact]['parent_container'] = atomical_id_basic_info.get('$parent_container')
+                if atomical_id_basic_info.get('$parent_realm'):
+                    return_struct['balances'][atomical_id_compact]['parent_realm'] = atomical_id_basic_info.get('$parent_realm')
+                if atomical_id_basic_info.get('$parent_container_name'):
+                    return_struct['balances'][atomical_id_compact]['parent_container_name'] = atomical_id_basic_info.get('$parent_container_name')
+                if atomical_id_basic_info.get('$bitwork'):
+                    return_struct['balances'][atomical_id_compact]['bitwork'] = atomical_id_basic_info.get('$bitwork')
+                if atomical_id_basic_info.get('$parents'):
+                    return_struct['balances'][atomical_id_compact]['parents'] = atomical_id_basic_info.get('$parents')
+                return_struct['balances'][atomical_id_compact]['confirmed'] += value
         return return_struct
     
     def atomical_resolve_id(self, compact_atomical_id_or_atomical_number):
@@ -754,19 +722,19 @@ class HttpHandler(object):
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)
         return atomical
     
-    async def atomical_id_get_state_history(self, compact_atomical_id):
+    async def atomical_id_get_state_history(self, compact_atomical_id, limit=None, offset=0):
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
         height = self.session_mgr.bp.height
-        self.db.populate_extended_mod_state_history_atomical_info(atomical_id, atomical, height)
+        self.db.populate_extended_mod_state_history_atomical_info(atomical_id, atomical, height, limit, offset)
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)
         return atomical
     
-    async def atomical_id_get_events(self, compact_atomical_id):
+    async def atomical_id_get_events(self, compact_atomical_id, limit=None, offset=0):
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
         height = self.session_mgr.bp.height
-        self.db.populate_extended_events_atomical_info(atomical_id, atomical, height)
+        self.db.populate_extended_events_atomical_info(atomical_id, atomical, height, limit, offset)
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)
         return atomical
     
@@ -1527,16 +1495,24 @@ class HttpHandler(object):
     async def atomical_get_state_history(self, request):
         params = await self.format_params(request)
         compact_atomical_id_or_atomical_number = params.get(0, "")
+        limit = params.get(1, None)
+        if limit is not None:
+            limit = non_negative_integer(limit)
+        offset = non_negative_integer(params.get(2, 0))
 
         compact_atomical_id = self.atomical_resolve_id(compact_atomical_id_or_atomical_number)
-        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_state_history(compact_atomical_id)}
+        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_state_history(compact_atomical_id, limit, offset)}
     
     async def atomical_get_events(self, request):
         params = await self.format_params(request)
         compact_atomical_id_or_atomical_number = params.get(0, "")
+        limit = params.get(1, None)
+        if limit is not None:
+            limit = non_negative_integer(limit)
+        offset = non_negative_integer(params.get(2, 0))
 
         compact_atomical_id = self.atomical_resolve_id(compact_atomical_id_or_atomical_number)
-        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_events(compact_atomical_id)}    
+        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_events(compact_atomical_id, limit, offset)}    
 
     async def atomicals_get_tx_history(self, request):
         '''Return the history of an Atomical```
@@ -1615,9 +1591,7 @@ class HttpHandler(object):
         that = self
         def populate_rules_response_struct(parent_atomical_id, struct_to_populate, Verbose):
             current_height = that.session_mgr.bp.height
-            subrealm_mint_mod_history = that.session_mgr.bp.get_mod_history(parent_atomical_id, current_height)
-            current_height_latest_state = calculate_latest_state_from_mod_history(subrealm_mint_mod_history)
-            current_height_rules_list = validate_rules_data(current_height_latest_state.get(SUBREALM_MINT_PATH, None))
+            current_height_rules_list = that.session_mgr.bp.get_rules_by_height(parent_atomical_id, current_height, SUBREALM_MINT_PATH)
             nearest_parent_realm_subrealm_mint_allowed = False
             struct_to_populate['nearest_parent_realm_subrealm_mint_rules'] = {
                 'nearest_parent_realm_atomical_id': location_id_bytes_to_compact(parent_atomical_id),
@@ -1949,6 +1923,9 @@ class HttpHandler(object):
         container = params.get(0, "")
         limit = params.get(1, 10)
         offset = params.get(2, 0)
+        cursor = params.get(3, None)
+        if cursor is not None and not isinstance(cursor, str):
+            raise RPCError(BAD_REQUEST, f'invalid cursor')
 
         status, candidate_atomical_id, all_entries = self.session_mgr.bp.get_effective_container(container, self.session_mgr.bp.height)
         found_atomical_id = None
@@ -1968,21 +1945,21 @@ class HttpHandler(object):
             if offset < 0:
                 offset = 0
             height = self.session_mgr.bp.height
-            items = await self.session_mgr.bp.get_effective_dmitems_paginated(found_atomical_id, limit, offset, height)
+            items, next_cursor = await self.session_mgr.bp.get_effective_dmitems_paginated(found_atomical_id, limit, offset, height, cursor)
             res = {
                 'result': {
                     'container': container_info,
                     'item_data': {
                         'limit': limit,
                         'offset': offset,
+                        'cursor': next_cursor,
                         'type': 'dmint',
                         'items': self.auto_populate_container_dmint_items_fields(items)
                     }
                 }
             }
         else:
-            container_mod_history = self.session_mgr.bp.get_mod_history(found_atomical_id, self.session_mgr.bp.height)
-            current_height_latest_state = calculate_latest_state_from_mod_history(container_mod_history)
+            current_height_latest_state = self.session_mgr.bp.get_mod_state(found_atomical_id, self.session_mgr.bp.height)
             items = current_height_latest_state.get('items', [])
             res = {
                 'result': {
@@ -2019,7 +1996,8 @@ class HttpHandler(object):
         Limit = params.get(2, 100)
         Offset = params.get(3, 0)
         is_verified_only = params.get(4, True)
-        return self.atomicals_search_name_template(b'tick', 'ticker', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        Cursor = params.get(5, None)
+        return self.atomicals_search_name_template(b'tick', 'ticker', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
     
     async def atomicals_search_realms(self, request):
         params = await self.format_params(request)
@@ -2028,7 +2006,8 @@ class HttpHandler(object):
         Limit = params.get(2, 100)
         Offset = params.get(3, 0)
         is_verified_only = params.get(4, True)
-        return self.atomicals_search_name_template(b'rlm', 'realm', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        Cursor = params.get(5, None)
+        return self.atomicals_search_name_template(b'rlm', 'realm', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
 
     async def atomicals_search_subrealms(self, request):
         params = await self.format_params(request)
@@ -2038,8 +2017,9 @@ class HttpHandler(object):
         Limit = params.get(3, 100)
         Offset = params.get(4, 0)
         is_verified_only = params.get(5, True)
+        Cursor = params.get(6, None)
         parent_realm_id_long_form = compact_to_location_id_bytes(parent_realm_id_compact)
-        return self.atomicals_search_name_template(b'srlm', 'subrealm', parent_realm_id_long_form, prefix, Reverse, Limit, Offset, is_verified_only)
+        return self.atomicals_search_name_template(b'srlm', 'subrealm', parent_realm_id_long_form, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
 
     async def atomicals_search_containers(self, request):
         params = await self.format_params(request)
@@ -2048,20 +2028,21 @@ class HttpHandler(object):
         Limit = params.get(2, 100)
         Offset = params.get(3, 0)
         is_verified_only = params.get(4, True)
-        return self.atomicals_search_name_template(b'co', 'collection', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        Cursor = params.get(5, None)
+        return self.atomicals_search_name_template(b'co', 'collection', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
     
     async def atomicals_get_holders(self, request):
         '''Return the holder by a specific location id```
         '''
         params = await self.format_params(request)
         compact_atomical_id = params.get(0, "")
-        limit = params.get(1, 50)
-        offset = params.get(2, 0)
+        limit = non_negative_integer(params.get(1, 50))
+        offset = non_negative_integer(params.get(2, 0))
 
         formatted_results = []
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
-        atomical = await self.db.populate_extended_atomical_holder_info(atomical_id, atomical)
+        atomical = await self.db.populate_extended_atomical_holder_info(atomical_id, atomical, limit, offset)
         if atomical["type"] == "FT":
             if atomical["$mint_mode"] == "fixed":
                 max_supply = atomical.get('$max_supply', 0)
@@ -2070,7 +2051,7 @@ class HttpHandler(object):
                 if max_supply < 0:
                     mint_amount = atomical.get("mint_info", {}).get("args", {}).get("mint_amount")
                     max_supply = DFT_MINT_MAX_MAX_COUNT_DENSITY * mint_amount 
-            for holder in atomical.get("holders", [])[offset:offset+limit]:
+            for holder in atomical.get("holders", []):
                 percent = holder['holding'] / max_supply
                 formatted_results.append({
                     "percent": percent,
@@ -2078,7 +2059,7 @@ class HttpHandler(object):
                     "holding": holder["holding"]
                 })
         elif atomical["type"] == "NFT":
-            for holder in atomical.get("holders", [])[offset:offset+limit]:
+            for holder in atomical.get("holders", []):
                 formatted_results.append({
                     "address": get_address_from_output_script(bytes.fromhex(holder['script'])),
                     "holding": holder["holding"]
@@ -2342,8 +2323,8 @@ class HttpHandler(object):
             history_data, total = await self.session_mgr.get_history_op(hashX, limit, offset, op, reverse)
         else:
             history_data, total = await self.session_mgr.get_history_op(hashX, limit, offset, None, reverse)
-        for history in history_data:
-            tx_hash, tx_height = self.db.fs_tx_hash(history["tx_num"])
+        tx_hashes = self.db.fs_tx_hashes(history["tx_num"] for history in history_data)
+        for history, (tx_hash, tx_height) in zip(history_data, tx_hashes):
             data = await self.get_transaction_detail(hash_to_hex_str(tx_hash), tx_height, history["tx_num"])
             if data:
                 if (op_type and data["op"] == op_type) or not op_type:
@@ -2378,34 +2359,35 @@ class HttpHandler(object):
         return {"result": res[offset:limit+offset], "total": total, "limit": limit, "offset": offset}
     
     # searh for global
+    # Pages are seeked in the global activity index by offset, or by the cursor returned with the previous page
     async def transaction_global(self, request):
         params = await self.format_params(request)
-        limit = params.get(0, 10)
-        offset = params.get(1, 0)
+        limit = non_negative_integer(params.get(0, 10))
+        offset = non_negative_integer(params.get(1, 0))
         op_type = params.get(2, None)
         reverse = params.get(3, True)
-        height = self.session_mgr.bp.height
-        
+        cursor = params.get(4, None)
+
+        op = None
+        if op_type:
+            op = self.op_list.get(op_type, None)
+            if op is None:
+                return {"result": [], "total": 0, "limit": limit, "offset": offset, "cursor": None}
+        if cursor is not None:
+            try:
+                cursor = bytes.fromhex(cursor)
+            except (TypeError, ValueError):
+                cursor = b''
+            if len(cursor) != TXNUM_LEN:
+                raise RPCError(BAD_REQUEST, f'invalid cursor')
+
+        history_data, next_cursor, total = await aiorpcx.run_in_thread(
+            self.db.get_atomicals_activity, limit, op, cursor, offset, reverse)
         res = []
-        count = 0
-        history_list = []
-        for current_height in range(height, self.coin.ATOMICALS_ACTIVATION_HEIGHT, -1):
-            txs = self.db.get_atomicals_block_txs(current_height)
-            for tx in txs:
-                tx_num, _ = self.db.get_tx_num_height_from_tx_hash(hex_str_to_hash(tx))
-                history_list.append({
-                    "tx_num": tx_num, 
-                    "tx_hash": tx,
-                    "height": current_height
-                })
-                count += 1
-            if count >= offset + limit:
-                break
-        history_list.sort(key=lambda x: x['tx_num'], reverse=reverse)
-        
-        for history in history_list:
-            data = await self.get_transaction_detail(history["tx_hash"], history["height"], history["tx_num"])
-            if (op_type and op_type == data["op"]) or (not op_type and data["op"]):
+        tx_hashes = self.db.fs_tx_hashes(history["tx_num"] for history in history_data)
+        for history, (tx_hash, tx_height) in zip(history_data, tx_hashes):
+            data = await self.get_transaction_detail(hash_to_hex_str(tx_hash), tx_height, history["tx_num"])
+            if data:
                 res.append(data)
-        total = len(res)
-        return {"result": res[offset:offset+limit], "total": total, "limit": limit, "offset": offset}
\ No newline at end of file
+        next_cursor = next_cursor.hex() if next_cursor else None
+        return {"result": res, "total": total, "limit": limit, "offset": offset, "cursor": next_cursor}
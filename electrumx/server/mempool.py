@@ -11,7 +11,7 @@ import itertools
 import time
 from abc import ABC, abstractmethod
 from asyncio import Lock
-from collections import defaultdict
+from collections import defaultdict, deque
 from typing import Sequence, Tuple, TYPE_CHECKING, Type, Dict
 import math
 
@@ -20,8 +20,10 @@ from aiorpcx import run_in_thread, sleep
 
 from electrumx.lib.hash import hash_to_hex_str, hex_str_to_hash
 from electrumx.lib.tx import SkipTxDeserialize
-from electrumx.lib.util import class_logger, chunks, OldTaskGroup, pack_le_uint32, unpack_le_uint32
+from electrumx.lib.util import (class_logger, chunks, OldTaskGroup, pack_le_uint16,
+                                pack_le_uint32, pack_le_uint64, unpack_le_uint32)
 from electrumx.server.db import UTXO
+from electrumx.lib.atomicals_blueprint_builder import AtomicalsTransferBlueprintBuilder
 from electrumx.lib.util_atomicals import get_mint_info_op_factory, parse_protocols_operations_from_witness_array, location_id_bytes_to_compact
 
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN, double_sha256
@@ -38,6 +40,8 @@ class MemPoolTx:
     out_pairs = attr.ib()
     fee = attr.ib()
     size = attr.ib()
+    # A (tx, operations_found_at_inputs) pair until Atomicals are colored
+    atomicals_tx = attr.ib(default=None)
 
 
 @attr.s(slots=True)
@@ -89,6 +93,22 @@ class MemPoolAPI(ABC):
         prevouts - an iterable of (hash, index) pairs
         '''
 
+    @abstractmethod
+    def atomicals_at_location(self, tx_hash, tx_idx):
+        '''Return the Atomicals at a confirmed output as a list of dicts with
+        'atomical_id', 'location_id', 'data' and 'data_ex' keys, as
+        BlockProcessor.spend_atomicals_utxo does, without spending them.'''
+
+    @abstractmethod
+    def atomical_mint_info(self, atomical_id):
+        '''Return the mint info of a confirmed Atomical, or None.'''
+
+    @abstractmethod
+    async def run_with_atomicals_state(self, func):
+        '''Run func in a thread and return its result.  Block processing
+        does not change the state read by atomicals_at_location and
+        atomical_mint_info meanwhile.'''
+
     @abstractmethod
     async def on_mempool(self, touched, height):
         '''Called each time the mempool is synchronized.  touched is a set of
@@ -108,6 +128,13 @@ class MemPool:
 
        tx:     tx_hash -> MemPoolTx
        hashXs: hashX   -> set of all hashes of txs touching the hashX
+
+    and an overlay of the Atomicals transferred by mempool txs, colored
+    speculatively against the confirmed state and earlier mempool txs:
+
+       atomicals_outputs: location_id -> Atomicals at the mempool output
+       atomicals_txs:     tx_hash -> (location_ids, balance changes)
+       atomicals_deltas:  hashX -> {atomical_id: unconfirmed value change}
     '''
 
     def __init__(
@@ -125,6 +152,11 @@ class MemPool:
         self.txs = {}
         self.atomicals_mints = {}
         self.hashXs = defaultdict(set)  # None can be a key
+        self.atomicals_outputs = {}
+        self.atomicals_txs = {}
+        self.atomicals_deltas = {}
+        # Hashes of accepted txs whose Atomicals are not yet colored
+        self.uncolored_txs = set()
         self.cached_compact_histogram = []
         self.refresh_secs = refresh_secs
         self.log_status_secs = log_status_secs
@@ -211,18 +243,39 @@ class MemPool:
 
     def _accept_transactions(self, tx_map, utxo_map, touched):
         '''Accept transactions in tx_map to the mempool if all their inputs
-        can be found in the existing mempool or a utxo_map from the
-        DB.
+        can be found in the existing mempool, a utxo_map from the DB or
+        other transactions in tx_map.
+
+        A transaction spending outputs of others in tx_map is accepted
+        once the last of those parents is, so each transaction is tried
+        once however long the unconfirmed chain.
 
         Returns an (unprocessed tx_map, unspent utxo_map) pair.
         '''
         hashXs = self.hashXs
         txs = self.txs
 
+        # Parent tx hash -> hashes of txs in tx_map waiting on it
+        children = defaultdict(list)
+        # Waiting tx hash -> count of its parents not yet accepted
+        missing_parents = {}
+        ready = deque()
+        for hash, tx in tx_map.items():
+            parents = {prev_hash for prev_hash, _ in tx.prevouts
+                       if prev_hash in tx_map}
+            if parents:
+                missing_parents[hash] = len(parents)
+                for prev_hash in parents:
+                    children[prev_hash].append(hash)
+            else:
+                ready.append(hash)
+
         deferred = {}
         unspent = set(utxo_map)
         # Try to find all prevouts so we can accept the TX
-        for hash, tx in tx_map.items():
+        while ready:
+            hash = ready.popleft()
+            tx = tx_map[hash]
             in_pairs = []
             try:
                 for prevout in tx.prevouts:
@@ -246,13 +299,149 @@ class MemPool:
             tx.fee = max(0, (sum(v for _, v in tx.in_pairs) -
                              sum(v for _, v in tx.out_pairs)))
             txs[hash] = tx
+            if tx.atomicals_tx:
+                self.uncolored_txs.add(hash)
 
             for hashX, _value in itertools.chain(tx.in_pairs, tx.out_pairs):
                 touched.add(hashX)
                 hashXs[hashX].add(hash)
 
+            for child in children.pop(hash, ()):
+                missing_parents[child] -= 1
+                if not missing_parents[child]:
+                    ready.append(child)
+
+        # Txs with a parent that was deferred, or in a cycle
+        for hash, count in missing_parents.items():
+            if count:
+                deferred[hash] = tx_map[hash]
+
         return deferred, {prevout: utxo_map[prevout] for prevout in unspent}
 
+    def _color_atomicals_txs(self):
+        '''Color the outputs of newly accepted txs with the Atomicals their
+        inputs carry, parents before children.
+
+        Run in a thread while the Atomicals state is not changed.  Returns
+        a list of (tx_hash, outputs, changes) triples for
+        _accept_atomicals_tx, as the overlay is read on the event loop.'''
+        txs = self.txs
+        uncolored_txs = self.uncolored_txs
+        colored_outputs = {}
+        colored = []
+        stack = list(uncolored_txs)
+        while stack:
+            hash = stack[-1]
+            if hash not in uncolored_txs:
+                stack.pop()
+                continue
+            tx = txs[hash]
+            parents = [prev_hash for prev_hash, _ in tx.prevouts
+                       if prev_hash in uncolored_txs]
+            if parents:
+                stack.extend(parents)
+                continue
+            stack.pop()
+            uncolored_txs.remove(hash)
+            atomicals_tx, tx.atomicals_tx = tx.atomicals_tx, None
+            try:
+                result = self._color_atomicals_tx(hash, *atomicals_tx, colored_outputs)
+            except Exception as ex:
+                self.logger.error(f'skipping atomicals coloring due to error in mempool {hash_to_hex_str(hash)}: {ex}')
+                continue
+            if result:
+                outputs, changes = result
+                colored_outputs.update(outputs)
+                colored.append((hash, outputs, changes))
+        return colored
+
+    def _color_atomicals_tx(self, tx_hash, tx, operations_found_at_inputs, colored_outputs):
+        '''Return the Atomicals at the outputs of a mempool tx, by location,
+        and its balance changes, or None if its inputs carry none.'''
+        atomicals_spent_at_inputs = {}
+        txin_index = 0
+        for txin in tx.inputs:
+            if txin.is_generation():
+                continue
+            if txin.prev_hash in self.txs:
+                location_id = txin.prev_hash + pack_le_uint32(txin.prev_idx)
+                atomicals = (colored_outputs.get(location_id)
+                             or self.atomicals_outputs.get(location_id))
+            else:
+                atomicals = self.api.atomicals_at_location(txin.prev_hash, txin.prev_idx)
+            if atomicals:
+                atomicals_spent_at_inputs[txin_index] = atomicals
+            txin_index += 1
+        if not atomicals_spent_at_inputs:
+            return None
+
+        sort_fifo = self.api.db_height() + 1 >= self.coin.ATOMICALS_ACTIVATION_HEIGHT_DMINT
+        blueprint_builder = AtomicalsTransferBlueprintBuilder(
+            self.logger, atomicals_spent_at_inputs, operations_found_at_inputs, tx_hash,
+            tx, self._get_atomicals_id_mint_info, sort_fifo)
+
+        # (hashX, atomical_id) -> change in the value carrying the Atomical
+        changes = defaultdict(int)
+        for atomicals in atomicals_spent_at_inputs.values():
+            for atomical in atomicals:
+                hashX = atomical['data'][:HASHX_LEN]
+                changes[(hashX, atomical['atomical_id'])] -= atomical['data_ex']['value']
+
+        outputs = defaultdict(list)
+        output_atomicals = [(output_idx, atomical_id, 0)
+                            for output_idx, value_info in blueprint_builder.get_nft_output_blueprint().outputs.items()
+                            for atomical_id in value_info['atomicals']]
+        output_atomicals.extend((output_idx, atomical_id, atomical_info.exponent)
+                                for output_idx, value_info in blueprint_builder.get_ft_output_blueprint().outputs.items()
+                                for atomical_id, atomical_info in value_info['atomicals'].items())
+        for output_idx, atomical_id, exponent in output_atomicals:
+            location_id = tx_hash + pack_le_uint32(output_idx)
+            txout = tx.outputs[output_idx]
+            hashX = self.coin.hashX_from_script(txout.pk_script)
+            data = (hashX + double_sha256(txout.pk_script) + pack_le_uint64(txout.value)
+                    + pack_le_uint16(exponent))
+            outputs[location_id].append({
+                'atomical_id': atomical_id,
+                'location_id': location_id,
+                'data': data,
+                'data_ex': {'value': txout.value, 'exponent': exponent},
+            })
+            changes[(hashX, atomical_id)] += txout.value
+
+        changes = [(key, change) for key, change in changes.items() if change]
+        return dict(outputs), changes
+
+    def _accept_atomicals_tx(self, tx_hash, outputs, changes):
+        '''Add the Atomicals coloring of a mempool tx to the overlay.'''
+        self.atomicals_outputs.update(outputs)
+        self.atomicals_txs[tx_hash] = (list(outputs), changes)
+        self._apply_atomicals_changes(changes, 1)
+
+    def _remove_atomicals_tx(self, tx_hash):
+        '''Undo the Atomicals coloring of a tx leaving the mempool.'''
+        self.uncolored_txs.discard(tx_hash)
+        colored = self.atomicals_txs.pop(tx_hash, None)
+        if colored:
+            location_ids, changes = colored
+            for location_id in location_ids:
+                self.atomicals_outputs.pop(location_id, None)
+            self._apply_atomicals_changes(changes, -1)
+
+    def _apply_atomicals_changes(self, changes, sign):
+        atomicals_deltas = self.atomicals_deltas
+        for (hashX, atomical_id), change in changes:
+            deltas = atomicals_deltas.setdefault(hashX, {})
+            delta = deltas.get(atomical_id, 0) + sign * change
+            if delta:
+                deltas[atomical_id] = delta
+            else:
+                deltas.pop(atomical_id, None)
+                if not deltas:
+                    del atomicals_deltas[hashX]
+
+    def _get_atomicals_id_mint_info(self, atomical_id, _with_cache):
+        return self.api.atomical_mint_info(atomical_id)
+
     def _accept_atomicals_updates(self, atomicals_map):
         '''Process any atomicals updates in the mempool
         '''
@@ -300,6 +489,7 @@ class MemPool:
             tx = txs.pop(tx_hash)
             if self.atomicals_mints.get(tx_hash) != None:
                 self.atomicals_mints.pop(tx_hash)
+            self._remove_atomicals_tx(tx_hash)
             tx_hashXs = {hashX for hashX, value in tx.in_pairs}
             tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
             for hashX in tx_hashXs:
@@ -325,15 +515,18 @@ class MemPool:
                 tx_map.update(deferred)
                 utxo_map.update(unspent)
 
-            prior_count = 0
-            # FIXME: this is not particularly efficient
-            while tx_map and len(tx_map) != prior_count:
-                prior_count = len(tx_map)
-                tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map,
-                                                             touched)
+            # Txs deferred by one task may spend outputs of another's
+            tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map,
+                                                         touched)
             if tx_map:
                 self.logger.error(f'{len(tx_map)} txs dropped')
 
+        if self.uncolored_txs:
+            # Coloring reads the block processor's Atomicals state, so is
+            # batched into one thread that holds it still
+            colored = await self.api.run_with_atomicals_state(self._color_atomicals_txs)
+            for tx_hash, outputs, changes in colored:
+                self._accept_atomicals_tx(tx_hash, outputs, changes)
         return touched
 
     async def _fetch_and_accept(self, hashes, all_hashes, touched):
@@ -369,6 +562,7 @@ class MemPool:
                     continue
                 try:
                     tx, tx_size = deserializer(raw_tx).read_tx_and_vsize()
+                    operations_found_at_inputs = None
                     try:
                         operations_found_at_inputs = parse_protocols_operations_from_witness_array(tx, hash, True)
                         create_or_delete_atomical_from_definition(operations_found_at_inputs, tx, hash, atomicals_updates_map)
@@ -386,7 +580,7 @@ class MemPool:
                 txout_pairs = tuple((to_hashX(txout.pk_script), txout.value)
                                     for txout in tx.outputs)
                 txs[hash] = MemPoolTx(txin_pairs, None, txout_pairs,
-                                      0, tx_size)
+                                      0, tx_size, (tx, operations_found_at_inputs))
             return txs, atomicals_updates_map
 
         # Thread this potentially slow operation so as not to block
@@ -452,6 +646,15 @@ class MemPool:
         '''
         return []
 
+    async def atomicals_balance_delta(self, hashX):
+        '''Return a map from atomical_id to the unconfirmed change in the
+        value of the outputs of hashX carrying it, from the Atomicals
+        transfers in the mempool.
+
+        Can be positive or negative.
+        '''
+        return dict(self.atomicals_deltas.get(hashX, {}))
+
     async def get_atomical_mint(self, atomical_id):
         '''Check if there was an atomical minted in the mempool
         '''
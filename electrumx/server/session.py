@@ -44,8 +44,6 @@ from electrumx.lib.util_atomicals import (
     location_id_bytes_to_compact, 
     is_compact_atomical_id,
     format_name_type_candidates_to_rpc_for_subname,
-    calculate_latest_state_from_mod_history,
-    validate_rules_data,
     AtomicalsValidationError,
     auto_encode_bytes_elements, 
     validate_merkle_proof_dmint
@@ -206,8 +204,8 @@ class SessionManager:
         self.session_event = Event()
 
         # Set up the RPC request handlers
-        cmds = ('add_peer daemon_url disconnect getinfo groups log peers '
-                'query reorg sessions stop debug_memusage_list_all_objects '
+        cmds = ('add_peer compact_history daemon_url disconnect getinfo groups '
+                'log peers query reorg sessions stop debug_memusage_list_all_objects '
                 'debug_memusage_get_random_backref_chain'.split())
         LocalRPC.request_handlers = {cmd: getattr(self, 'rpc_' + cmd)
                                      for cmd in cmds}
@@ -505,6 +503,8 @@ class SessionManager:
             'daemon height': self.daemon.cached_height(),
             'db height': self.db.db_height,
             'db_flush_count': self.db.history.flush_count,
+            'history compaction': self._compaction_info(),
+            'cache memory': self.bp.cache_info(),
             'groups': len(self.session_groups),
             'history cache': cache_fmt.format(
                 self._history_lookups, self._history_hits, len(self._history_cache)),
@@ -529,6 +529,12 @@ class SessionManager:
             'version': electrumx.version,
         }
 
+    def _compaction_info(self):
+        progress = self.db.history.compaction_progress()
+        if progress is None:
+            return 'none in progress'
+        return f'{100 * progress:.1f}% complete'
+
     def _session_data(self, for_log):
         '''Returned to the RPC 'sessions' call.'''
         now = time.time()
@@ -680,6 +686,13 @@ class SessionManager:
         result.extend(f'unknown: {item}' for item in refs.unknown)
         return result
 
+    async def rpc_compact_history(self):
+        '''Start compacting the history DB in the background, if not already,
+        and return its progress.'''
+        # Waits for a compaction step or flush holding the history lock
+        await run_in_thread(self.db.history.start_compaction)
+        return f'history compaction {self._compaction_info()}'
+
     async def rpc_daemon_url(self, daemon_url):
         '''Replace the daemon URL.'''
         daemon_url = daemon_url or self.env.daemon_url
@@ -1005,6 +1018,9 @@ class SessionManager:
         return result, cost
     
     async def get_history_op(self, hashX, limit=10, offset=0, op=None, reverse=True):
+        if op:
+            # Seek the page in the op history index
+            return await run_in_thread(self.db.get_op_history, hashX, op, limit, offset, reverse)
         history_data = self._history_op_cache.get(hashX, [])
         if not history_data:
             history_data = []
@@ -1023,8 +1039,6 @@ class SessionManager:
             self._history_op_cache[hashX] = history_data
         if reverse:
             history_data.sort(key=lambda x: x['tx_num'], reverse=reverse)
-        if op:
-            history_data = list(filter(lambda x: x["op"] == op, history_data))
         return history_data[offset:limit+offset], len(history_data)
 
     async def _notify_sessions(self, height, touched):
@@ -1454,19 +1468,19 @@ class ElectrumX(SessionBase):
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)  
         return atomical
 
-    async def atomical_id_get_state_history(self, compact_atomical_id):
+    async def atomical_id_get_state_history(self, compact_atomical_id, limit=None, offset=0):
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
         height = self.session_mgr.bp.height
-        self.db.populate_extended_mod_state_history_atomical_info(atomical_id, atomical, height)
+        self.db.populate_extended_mod_state_history_atomical_info(atomical_id, atomical, height, limit, offset)
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)  
         return atomical
  
-    async def atomical_id_get_events(self, compact_atomical_id):
+    async def atomical_id_get_events(self, compact_atomical_id, limit=None, offset=0):
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
         height = self.session_mgr.bp.height
-        self.db.populate_extended_events_atomical_info(atomical_id, atomical, height)
+        self.db.populate_extended_events_atomical_info(atomical_id, atomical, height, limit, offset)
         await self.db.populate_extended_location_atomical_info(atomical_id, atomical)  
         return atomical
  
@@ -1615,13 +1629,19 @@ class ElectrumX(SessionBase):
         compact_atomical_id = self.atomical_resolve_id(compact_atomical_id_or_atomical_number)
         return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_state(compact_atomical_id, Verbose)} 
     
-    async def atomical_get_state_history(self, compact_atomical_id_or_atomical_number):
+    async def atomical_get_state_history(self, compact_atomical_id_or_atomical_number, limit=None, offset=0):
+        if limit is not None:
+            limit = non_negative_integer(limit)
+        offset = non_negative_integer(offset)
         compact_atomical_id = self.atomical_resolve_id(compact_atomical_id_or_atomical_number)
-        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_state_history(compact_atomical_id)} 
+        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_state_history(compact_atomical_id, limit, offset)} 
 
-    async def atomical_get_events(self, compact_atomical_id_or_atomical_number):
+    async def atomical_get_events(self, compact_atomical_id_or_atomical_number, limit=None, offset=0):
+        if limit is not None:
+            limit = non_negative_integer(limit)
+        offset = non_negative_integer(offset)
         compact_atomical_id = self.atomical_resolve_id(compact_atomical_id_or_atomical_number)
-        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_events(compact_atomical_id)} 
+        return {'global': await self.get_summary_info(), 'result': await self.atomical_id_get_events(compact_atomical_id, limit, offset)} 
 
     def atomical_resolve_id(self, compact_atomical_id_or_atomical_number):
         compact_atomical_id = compact_atomical_id_or_atomical_number
@@ -1712,9 +1732,11 @@ class ElectrumX(SessionBase):
                 value['$id'] = location_id_bytes_to_compact(provided_id)
         return auto_encode_bytes_elements(items)
 
-    async def atomicals_get_container_items(self, container, limit, offset):
+    async def atomicals_get_container_items(self, container, limit, offset, cursor=None):
         if not isinstance(container, str):
             raise RPCError(BAD_REQUEST, f'empty container')
+        if cursor is not None and not isinstance(cursor, str):
+            raise RPCError(BAD_REQUEST, f'invalid cursor')
         status, candidate_atomical_id, all_entries = self.session_mgr.bp.get_effective_container(container, self.session_mgr.bp.height)
         found_atomical_id = None
         if status == 'verified':
@@ -1733,21 +1755,21 @@ class ElectrumX(SessionBase):
             if offset < 0:
                 offset = 0
             height = self.session_mgr.bp.height
-            items = await self.session_mgr.bp.get_effective_dmitems_paginated(found_atomical_id, limit, offset, height)
+            items, next_cursor = await self.session_mgr.bp.get_effective_dmitems_paginated(found_atomical_id, limit, offset, height, cursor)
             return {
                 'result': {
                     'container': container_info,
                     'item_data': {
                         'limit': limit,
                         'offset': offset,
+                        'cursor': next_cursor,
                         'type': 'dmint',
                         'items': self.auto_populate_container_dmint_items_fields(items)
                     }
                 }
             }
         else: 
-            container_mod_history = self.session_mgr.bp.get_mod_history(found_atomical_id, self.session_mgr.bp.height)
-            current_height_latest_state = calculate_latest_state_from_mod_history(container_mod_history)
+            current_height_latest_state = self.session_mgr.bp.get_mod_state(found_atomical_id, self.session_mgr.bp.height)
             items = current_height_latest_state.get('items', [])
             return {
                 'result': {
@@ -1981,9 +2003,7 @@ class ElectrumX(SessionBase):
         that = self 
         def populate_rules_response_struct(parent_atomical_id, struct_to_populate, Verbose):
             current_height = that.session_mgr.bp.height
-            subrealm_mint_mod_history = that.session_mgr.bp.get_mod_history(parent_atomical_id, current_height)
-            current_height_latest_state = calculate_latest_state_from_mod_history(subrealm_mint_mod_history)
-            current_height_rules_list = validate_rules_data(current_height_latest_state.get(SUBREALM_MINT_PATH, None))
+            current_height_rules_list = that.session_mgr.bp.get_rules_by_height(parent_atomical_id, current_height, SUBREALM_MINT_PATH)
             nearest_parent_realm_subrealm_mint_allowed = False
             struct_to_populate['nearest_parent_realm_subrealm_mint_rules'] = {
                 'nearest_parent_realm_atomical_id': location_id_bytes_to_compact(parent_atomical_id),
@@ -2062,8 +2082,14 @@ class ElectrumX(SessionBase):
         return {'result': return_struct}
 
     # Perform a search for tickers, containers, and realms  
-    def atomicals_search_name_template(self, db_prefix, name_type_str, parent_prefix=None, prefix=None, Reverse=False, Limit=1000, Offset=0, is_verified_only=False):
-        db_entries = self.db.get_name_entries_template_limited(db_prefix, parent_prefix, prefix, Reverse, Limit, Offset)
+    # Pages are seeked by offset, or by the cursor returned with the previous page
+    def atomicals_search_name_template(self, db_prefix, name_type_str, parent_prefix=None, prefix=None, Reverse=False, Limit=1000, Offset=0, is_verified_only=False, Cursor=None):
+        if Cursor is not None:
+            try:
+                Cursor = bytes.fromhex(Cursor)
+            except (TypeError, ValueError):
+                raise RPCError(BAD_REQUEST, f'invalid cursor')
+        db_entries, next_cursor = self.db.get_name_entries_template_limited(db_prefix, parent_prefix, prefix, Reverse, Limit, Offset, Cursor)
         formatted_results = []
         for item in db_entries:
             if name_type_str == "ticker":
@@ -2085,28 +2111,28 @@ class ElectrumX(SessionBase):
                 formatted_results.append(obj)
             elif not is_verified_only:
                 formatted_results.append(obj)
-        return {'result': formatted_results}
+        return {'result': formatted_results, 'cursor': next_cursor.hex() if next_cursor else None}
 
-    async def atomicals_search_tickers(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False):
+    async def atomicals_search_tickers(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False, Cursor=None):
         if isinstance(prefix, str):
             prefix = prefix.encode()
-        return self.atomicals_search_name_template(b'tick', 'ticker', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        return self.atomicals_search_name_template(b'tick', 'ticker', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
 
-    async def atomicals_search_realms(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False):
+    async def atomicals_search_realms(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False, Cursor=None):
         if isinstance(prefix, str):
             prefix = prefix.encode()
-        return self.atomicals_search_name_template(b'rlm', 'realm', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        return self.atomicals_search_name_template(b'rlm', 'realm', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
 
-    async def atomicals_search_subrealms(self, parent_realm_id_compact, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False):
+    async def atomicals_search_subrealms(self, parent_realm_id_compact, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False, Cursor=None):
         parent_realm_id_long_form = compact_to_location_id_bytes(parent_realm_id_compact)
         if isinstance(prefix, str):
             prefix = prefix.encode()
-        return self.atomicals_search_name_template(b'srlm', 'subrealm', parent_realm_id_long_form, prefix, Reverse, Limit, Offset, is_verified_only)
+        return self.atomicals_search_name_template(b'srlm', 'subrealm', parent_realm_id_long_form, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
     
-    async def atomicals_search_containers(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False):
+    async def atomicals_search_containers(self, prefix=None, Reverse=False, Limit=100, Offset=0, is_verified_only=False, Cursor=None):
         if isinstance(prefix, str):
             prefix = prefix.encode()
-        return self.atomicals_search_name_template(b'co', 'collection', None, prefix, Reverse, Limit, Offset, is_verified_only)
+        return self.atomicals_search_name_template(b'co', 'collection', None, prefix, Reverse, Limit, Offset, is_verified_only, Cursor)
  
     async def atomicals_at_location(self, compact_location_id):
         '''Return the Atomicals at a specific location id```
@@ -2134,10 +2160,12 @@ class ElectrumX(SessionBase):
     async def atomicals_get_holders(self, compact_atomical_id, limit=50, offset=0):
         '''Return the holder by a specific location id```
         '''
+        limit = non_negative_integer(limit)
+        offset = non_negative_integer(offset)
         formatted_results = []
         atomical_id = compact_to_location_id_bytes(compact_atomical_id)
         atomical = await self.atomical_id_get(compact_atomical_id)
-        atomical = await self.db.populate_extended_atomical_holder_info(atomical_id, atomical)
+        atomical = await self.db.populate_extended_atomical_holder_info(atomical_id, atomical, limit, offset)
         if atomical["type"] == "FT":
             if atomical["$mint_mode"] == "fixed":
                 max_supply = atomical.get('$max_supply', 0)
@@ -2146,7 +2174,7 @@ class ElectrumX(SessionBase):
                 if max_supply < 0:
                     mint_amount = atomical.get("mint_info", {}).get("args", {}).get("mint_amount")
                     max_supply = DFT_MINT_MAX_MAX_COUNT_DENSITY * mint_amount
-            for holder in atomical.get("holders", [])[offset:offset+limit]:
+            for holder in atomical.get("holders", []):
                 percent = holder['holding'] / max_supply
                 formatted_results.append({
                     "percent": percent,
@@ -2154,7 +2182,7 @@ class ElectrumX(SessionBase):
                     "holding": holder["holding"]
                 })
         elif atomical["type"] == "NFT":
-            for holder in atomical.get("holders", [])[offset:offset+limit]:
+            for holder in atomical.get("holders", []):
                 formatted_results.append({
                     "address": get_address_from_output_script(bytes.fromhex(holder['script'])),
                     "holding": holder["holding"]
@@ -2162,127 +2190,88 @@ class ElectrumX(SessionBase):
         return formatted_results
 
     async def hashX_ft_balances_atomicals(self, hashX):
-        utxos = await self.db.all_utxos(hashX)
-        utxos = sorted(utxos)
-        # Comment out the utxos for now and add it in later
-        # utxos.extend(await self.mempool.unordered_UTXOs(hashX))
-        self.bump_cost(1.0 + len(utxos) / 50)
-        spends = [] # await self.mempool.potential_spends(hashX)
-        returned_utxos = []
-        atomicals_id_map = {}
-        for utxo in utxos:
-            if (utxo.tx_hash, utxo.tx_pos) in spends:
-                continue
-            atomicals = self.db.get_atomicals_by_utxo(utxo, True)
-            atomicals_basic_infos = []
-            for atomical_id in atomicals: 
-                # This call is efficient in that it's cached underneath
-                # For now we only show the atomical id because it can always be fetched separately and it will be more efficient
-                atomical_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id) 
-                atomical_id_compact = location_id_bytes_to_compact(atomical_id)
-                atomicals_id_map[atomical_id_compact] = atomical_basic_info
-                atomicals_basic_infos.append(atomical_id_compact)
-            if len(atomicals) > 0:
-                returned_utxos.append({'txid': hash_to_hex_str(utxo.tx_hash),
-                'index': utxo.tx_pos,
-                'vout': utxo.tx_pos,
-                'height': utxo.height,
-                'value': utxo.value,
-                'atomicals': atomicals_basic_infos})
+        # One entry for each atomical held, read from the balances index
+        balances = await run_in_thread(self.db.get_atomicals_balances, hashX)
+        self.bump_cost(1.0 + len(balances) / 50)
         # Aggregate balances
         return_struct = {
             'balances': {}
         }
-        for returned_utxo in returned_utxos: 
-            for atomical_id_entry_compact in returned_utxo['atomicals']:
-                atomical_id_basic_info = atomicals_id_map[atomical_id_entry_compact]
-                atomical_id_compact = atomical_id_basic_info['atomical_id']
-                assert(atomical_id_compact == atomical_id_entry_compact)
-                if atomical_id_basic_info.get('type') == 'FT':
-                    if return_struct['balances'].get(atomical_id_compact) == None:
-                        return_struct['balances'][atomical_id_compact] = {}
-                        return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
-                        return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
-                        return_struct['balances'][atomical_id_compact]['confirmed'] = 0
-                    if returned_utxo['height'] > 0:
-                        return_struct['balances'][atomical_id_compact]['confirmed'] += returned_utxo['value']
+        for atomical_id, value in balances:
+            # This call is efficient in that it's cached underneath
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if atomical_id_basic_info.get('type') == 'FT':
+                if return_struct['balances'].get(atomical_id_compact) == None:
+                    return_struct['balances'][atomical_id_compact] = {}
+                    return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                    return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
+                    return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+                    return_struct['balances'][atomical_id_compact]['unconfirmed'] = 0
+                return_struct['balances'][atomical_id_compact]['confirmed'] += value
+        # Add the transfers pending in the mempool
+        for atomical_id, delta in (await self.mempool.atomicals_balance_delta(hashX)).items():
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            if not atomical_id_basic_info or atomical_id_basic_info.get('type') != 'FT':
+                continue
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if return_struct['balances'].get(atomical_id_compact) == None:
+                return_struct['balances'][atomical_id_compact] = {}
+                return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                return_struct['balances'][atomical_id_compact]['ticker'] = atomical_id_basic_info.get('$ticker')
+                return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+            return_struct['balances'][atomical_id_compact]['unconfirmed'] = delta
         return return_struct
 
     async def hashX_nft_balances_atomicals(self, hashX):
         Verbose = False
-        utxos = await self.db.all_utxos(hashX)
-        utxos = sorted(utxos)
-        # Comment out the utxos for now and add it in later
-        # utxos.extend(await self.mempool.unordered_UTXOs(hashX))
-        self.bump_cost(1.0 + len(utxos) / 50)
-        spends = [] # await self.mempool.potential_spends(hashX)
-        returned_utxos = []
-        atomicals_id_map = {}
-        for utxo in utxos:
-            if (utxo.tx_hash, utxo.tx_pos) in spends:
-                continue
-            atomicals = self.db.get_atomicals_by_utxo(utxo, True)
-            atomicals_basic_infos = []
-            for atomical_id in atomicals: 
-                # This call is efficient in that it's cached underneath
-                # For now we only show the atomical id because it can always be fetched separately and it will be more efficient
-                atomical_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id) 
-                atomical_id_compact = location_id_bytes_to_compact(atomical_id)
-                atomicals_id_map[atomical_id_compact] = atomical_basic_info
-                atomicals_basic_infos.append(atomical_id_compact)
-            if len(atomicals) > 0:
-                returned_utxos.append({'txid': hash_to_hex_str(utxo.tx_hash),
-                'index': utxo.tx_pos,
-                'vout': utxo.tx_pos,
-                'height': utxo.height,
-                'value': utxo.value,
-                'atomicals': atomicals_basic_infos})
+        # One entry for each atomical held, read from the balances index
+        balances = await run_in_thread(self.db.get_atomicals_balances, hashX)
+        self.bump_cost(1.0 + len(balances) / 50)
         # Aggregate balances
         return_struct = {
             'balances': {}
         }
-        for returned_utxo in returned_utxos: 
-            for atomical_id_entry_compact in returned_utxo['atomicals']:
-                atomical_id_basic_info = atomicals_id_map[atomical_id_entry_compact]
-                atomical_id_compact = atomical_id_basic_info['atomical_id']
-                assert(atomical_id_compact == atomical_id_entry_compact)
-                if atomical_id_basic_info.get('type') == 'NFT':
-                    if return_struct['balances'].get(atomical_id_compact) == None:
-                        return_struct['balances'][atomical_id_compact] = {}
-                        return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
-                        return_struct['balances'][atomical_id_compact]['confirmed'] = 0
-                    if atomical_id_basic_info.get('subtype'):
-                        return_struct['balances'][atomical_id_compact]['subtype'] = atomical_id_basic_info.get('subtype')
-                    if atomical_id_basic_info.get('$request_container'):
-                        return_struct['balances'][atomical_id_compact]['request_container'] = atomical_id_basic_info.get('$request_container')
-                    if atomical_id_basic_info.get('$container'):
-                        return_struct['balances'][atomical_id_compact]['container'] = atomical_id_basic_info.get('$container')
-                    if atomical_id_basic_info.get('$dmitem'):
-                        return_struct['balances'][atomical_id_compact]['dmitem'] = atomical_id_basic_info.get('$dmitem')
-                    if atomical_id_basic_info.get('$request_dmitem'):
-                        return_struct['balances'][atomical_id_compact]['request_dmitem'] = atomical_id_basic_info.get('$request_dmitem')
-                    if atomical_id_basic_info.get('$realm'):
-                        return_struct['balances'][atomical_id_compact]['realm'] = atomical_id_basic_info.get('$realm')
-                    if atomical_id_basic_info.get('$request_realm'):
-                        return_struct['balances'][atomical_id_compact]['request_realm'] = atomical_id_basic_info.get('$request_realm')
-                    if atomical_id_basic_info.get('$subrealm'):
-                        return_struct['balances'][atomical_id_compact]['subrealm'] = atomical_id_basic_info.get('$subrealm')
-                    if atomical_id_basic_info.get('$request_subrealm'):
-                        return_struct['balances'][atomical_id_compact]['request_subrealm'] = atomical_id_basic_info.get('$request_subrealm')
-                    if atomical_id_basic_info.get('$full_realm_name'):
-                        return_struct['balances'][atomical_id_compact]['full_realm_name'] = atomical_id_basic_info.get('$full_realm_name')
-                    if atomical_id_basic_info.get('$parent_container'):
-                        return_struct['balances'][atomical_id_compact]['parent_container'] = atomical_id_basic_info.get('$parent_container')
-                    if atomical_id_basic_info.get('$parent_realm'):
-                        return_struct['balances'][atomical_id_compact]['parent_realm'] = atomical_id_basic_info.get('$parent_realm')
-                    if atomical_id_basic_info.get('$parent_container_name'):
-                        return_struct['balances'][atomical_id_compact]['parent_container_name'] = atomical_id_basic_info.get('$parent_container_name')
-                    if atomical_id_basic_info.get('$bitwork'):
-                        return_struct['balances'][atomical_id_compact]['bitwork'] = atomical_id_basic_info.get('$bitwork')
-                    if atomical_id_basic_info.get('$parents'):
-                        return_struct['balances'][atomical_id_compact]['parents'] = atomical_id_basic_info.get('$parents')
-                    if returned_utxo['height'] > 0:
-                        return_struct['balances'][atomical_id_compact]['confirmed'] += returned_utxo['value']
+        for atomical_id, value in balances:
+            # This call is efficient in that it's cached underneath
+            atomical_id_basic_info = await self.session_mgr.bp.get_base_mint_info_rpc_format_by_atomical_id(atomical_id)
+            atomical_id_compact = atomical_id_basic_info['atomical_id']
+            if atomical_id_basic_info.get('type') == 'NFT':
+                if return_struct['balances'].get(atomical_id_compact) == None:
+                    return_struct['balances'][atomical_id_compact] = {}
+                    return_struct['balances'][atomical_id_compact]['id'] = atomical_id_compact
+                    return_struct['balances'][atomical_id_compact]['confirmed'] = 0
+                if atomical_id_basic_info.get('subtype'):
+                    return_struct['balances'][atomical_id_compact]['subtype'] = atomical_id_basic_info.get('subtype')
+                if atomical_id_basic_info.get('$request_container'):
+                    return_struct['balances'][atomical_id_compact]['request_container'] = atomical_id_basic_info.get('$request_container')
+                if atomical_id_basic_info.get('$container'):
+                    return_struct['balances'][atomical_id_compact]['container'] = atomical_id_basic_info.get('$container')
+                if atomical_id_basic_info.get('$dmitem'):
+                    return_struct['balances'][atomical_id_compact]['dmitem'] = atomical_id_basic_info.get('$dmitem')
+                if atomical_id_basic_info.get('$request_dmitem'):
+                    return_struct['balances'][atomical_id_compact]['request_dmitem'] = atomical_id_basic_info.get('$request_dmitem')
+                if atomical_id_basic_info.get('$realm'):
+                    return_struct['balances'][atomical_id_compact]['realm'] = atomical_id_basic_info.get('$realm')
+                if atomical_id_basic_info.get('$request_realm'):
+                    return_struct['balances'][atomical_id_compact]['request_realm'] = atomical_id_basic_info.get('$request_realm')
+                if atomical_id_basic_info.get('$subrealm'):
+                    return_struct['balances'][atomical_id_compact]['subrealm'] = atomical_id_basic_info.get('$subrealm')
+                if atomical_id_basic_info.get('$request_subrealm'):
+                    return_struct['balances'][atomical_id_compact]['request_subrealm'] = atomical_id_basic_info.get('$request_subrealm')
+                if atomical_id_basic_info.get('$full_realm_name'):
+                    return_struct['balances'][atomical_id_compact]['full_realm_name'] = atomical_id_basic_info.get('$full_realm_name')
+                if atomical_id_basic_info.get('$parent_container'):
+                    return_struct['balances'][atomical_id_compact]['parent_container'] = atomical_id_basic_info.get('$parent_container')
+                if atomical_id_basic_info.get('$parent_realm'):
+                    return_struct['balances'][atomical_id_compact]['parent_realm'] = atomical_id_basic_info.get('$parent_realm')
+                if atomical_id_basic_info.get('$parent_container_name'):
+                    return_struct['balances'][atomical_id_compact]['parent_container_name'] = atomical_id_basic_info.get('$parent_container_name')
+                if atomical_id_basic_info.get('$bitwork'):
+                    return_struct['balances'][atomical_id_compact]['bitwork'] = atomical_id_basic_info.get('$bitwork')
+                if atomical_id_basic_info.get('$parents'):
+                    return_struct['balances'][atomical_id_compact]['parents'] = atomical_id_basic_info.get('$parents')
+                return_struct['balances'][atomical_id_compact]['confirmed'] += value
         return return_struct
 
     async def hashX_listscripthash_atomicals(self, hashX, Verbose=False):
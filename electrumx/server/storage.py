@@ -9,6 +9,7 @@
 
 import os
 from functools import partial
+from operator import itemgetter
 from typing import Type
 
 import electrumx.lib.util as util
@@ -50,6 +51,39 @@ class Storage:
     def put(self, key, value):
         raise NotImplementedError
 
+    def multi_get(self, keys):
+        '''Return a list of the values of keys, in the same order, with None
+        for a key not in the database.
+
+        The keys are read in key order.'''
+        get = self.get
+        values = {key: get(key) for key in sorted(set(keys))}
+        return [values[key] for key in keys]
+
+    def multi_prefix_items(self, prefixes):
+        '''Return a list of the (key, value) pairs of each prefix, in the
+        same order.  No prefix may start with another.
+
+        The prefixes are read in key order by a single iterator that only
+        seeks forward, and not at all to a prefix it has reached already.'''
+        items = {}
+        iterator = self.seekable_iterator()
+        pending = None
+        for prefix in sorted(set(prefixes)):
+            if pending is None or pending[0] < prefix:
+                iterator.seek(prefix)
+                pending = next(iterator, None)
+            prefix_items = items[prefix] = []
+            while pending is not None and pending[0].startswith(prefix):
+                prefix_items.append(pending)
+                pending = next(iterator, None)
+        return [items[prefix] for prefix in prefixes]
+
+    def seekable_iterator(self):
+        '''Return an iterator over the (key, value) pairs of the database
+        with a `seek(key)` method moving it to the first key from key on.'''
+        raise NotImplementedError
+
     def write_batch(self):
         '''Return a context manager that provides `put` and `delete`.
 
@@ -68,6 +102,14 @@ class Storage:
         '''
         raise NotImplementedError
 
+    def iterator_from(self, prefix, start, reverse=False):
+        '''Return an iterator like iterator() that starts at the key `start`.
+
+        `start` begins with `prefix`.  Keys from `start` on are included,
+        after it in key order or before it if `reverse` is True.
+        '''
+        raise NotImplementedError
+
 
 class LevelDB(Storage):
     '''LevelDB database engine.'''
@@ -89,6 +131,23 @@ class LevelDB(Storage):
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
+    def multi_get(self, keys):
+        # Read from a snapshot so the values are consistent with each other
+        with self.db.snapshot() as snapshot:
+            get = snapshot.get
+            values = {key: get(key) for key in sorted(set(keys))}
+        return [values[key] for key in keys]
+
+    def seekable_iterator(self):
+        return self.db.iterator()
+
+    def iterator_from(self, prefix, start, reverse=False):
+        if reverse:
+            return self.db.iterator(start=prefix, stop=start, include_stop=True,
+                                    reverse=True)
+        return self.db.iterator(start=start,
+                                stop=util.increment_byte_string(prefix))
+
 
 class RocksDB(Storage):
     '''RocksDB database engine.'''
@@ -118,9 +177,19 @@ class RocksDB(Storage):
     def write_batch(self):
         return RocksDBWriteBatch(self.db)
 
+    def multi_get(self, keys):
+        values = self.db.multi_get(sorted(set(keys)))
+        return [values[key] for key in keys]
+
     def iterator(self, prefix=b'', reverse=False):
         return RocksDBIterator(self.db, prefix, reverse)
 
+    def iterator_from(self, prefix, start, reverse=False):
+        return RocksDBIterator(self.db, prefix, reverse, start)
+
+    def seekable_iterator(self):
+        return self.db.iteritems()
+
 
 class RocksDBWriteBatch:
     '''A write batch for RocksDB.'''
@@ -140,11 +209,15 @@ class RocksDBWriteBatch:
 class RocksDBIterator:
     '''An iterator for RocksDB.'''
 
-    def __init__(self, db, prefix, reverse):
+    def __init__(self, db, prefix, reverse, start=None):
         self.prefix = prefix
         if reverse:
             self.iterator = reversed(db.iteritems())
-            nxt_prefix = util.increment_byte_string(prefix)
+            if start is None:
+                nxt_prefix = util.increment_byte_string(prefix)
+            else:
+                # The first key after start
+                nxt_prefix = start + b'\0'
             if nxt_prefix:
                 self.iterator.seek(nxt_prefix)
                 try:
@@ -155,7 +228,7 @@ class RocksDBIterator:
                 self.iterator.seek_to_last()
         else:
             self.iterator = db.iteritems()
-            self.iterator.seek(prefix)
+            self.iterator.seek(prefix if start is None else start)
 
     def __iter__(self):
         return self
@@ -164,4 +237,109 @@ class RocksDBIterator:
         k, v = next(self.iterator)
         if not k.startswith(self.prefix):
             raise StopIteration
-        return k, v
\ No newline at end of file
+        return k, v
+
+
+class ChunkedWriteBatch:
+    '''A write batch that commits its writes in sub-batches of bounded size.
+
+    Writes are buffered until they reach batch_size bytes and then written
+    in key order in a batch of their own.  Memory use is bounded, but the
+    writes as a whole are not atomic.'''
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.writes = []
+        self.size = 0
+        self.batch_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_val:
+            self.commit()
+
+    def put(self, key, value):
+        self.writes.append((key, value))
+        self.size += len(key) + len(value)
+        if self.size >= self.batch_size:
+            self.commit()
+
+    def delete(self, key):
+        self.writes.append((key, None))
+        self.size += len(key)
+        if self.size >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        '''Write the buffered writes in a sub-batch.'''
+        if not self.writes:
+            return
+        # The sort is stable so writes to the same key keep their order
+        self.writes.sort(key=itemgetter(0))
+        with self.db.write_batch() as batch:
+            for key, value in self.writes:
+                if value is None:
+                    batch.delete(key)
+                else:
+                    batch.put(key, value)
+        self.writes = []
+        self.size = 0
+        self.batch_count += 1
+
+
+class FlushJournal:
+    '''Stages the writes of a flush so they can be committed in batches of
+    bounded size and still take effect all or nothing.
+
+    The writes are first committed under the journal prefix, where nothing
+    reads them.  Once the caller has atomically recorded that the journal is
+    complete, apply() moves them to their keys in key order, deleting each
+    journal entry in the batch that applies it.  A journal interrupted while
+    staged is discarded; one interrupted while applied is applied again.'''
+
+    PREFIX = b'fj'
+    PUT, DELETE = b'\x01', b'\x00'
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+
+    def writer(self):
+        '''Return a chunked batch staging its writes in the journal.'''
+        return JournalWriteBatch(self.db, self.batch_size)
+
+    def apply(self):
+        '''Apply the staged writes and return their count.'''
+        count = 0
+        with ChunkedWriteBatch(self.db, self.batch_size) as batch:
+            for key, value in self.db.iterator(prefix=self.PREFIX):
+                if value[:1] == self.PUT:
+                    batch.put(key[len(self.PREFIX):], value[1:])
+                else:
+                    batch.delete(key[len(self.PREFIX):])
+                batch.delete(key)
+                count += 1
+        return count
+
+    def discard(self):
+        '''Delete the staged writes and return their count.'''
+        count = 0
+        with ChunkedWriteBatch(self.db, self.batch_size) as batch:
+            for key, _value in self.db.iterator(prefix=self.PREFIX):
+                batch.delete(key)
+                count += 1
+        return count
+
+
+class JournalWriteBatch(ChunkedWriteBatch):
+    '''A chunked write batch staging its writes in the flush journal.  A later
+    write to a key replaces an earlier one, as in a single batch.'''
+
+    def put(self, key, value):
+        super().put(FlushJournal.PREFIX + key, FlushJournal.PUT + value)
+
+    def delete(self, key):
+        super().put(FlushJournal.PREFIX + key, FlushJournal.DELETE)
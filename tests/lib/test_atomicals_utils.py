@@ -9,8 +9,11 @@ from electrumx.lib.util_atomicals import (
     calculate_expected_bitwork,
     is_txid_valid_for_perpetual_bitwork,
     get_next_bitwork_full_str,
+    has_atomicals_envelope,
+    parse_protocols_operations_from_witness_for_input,
     MINT_REALM_CONTAINER_TICKER_COMMIT_REVEAL_DELAY_BLOCKS
 )
+from cbor2 import dumps
 
 coin = Bitcoin
 
@@ -1012,4 +1015,27 @@ def test_get_next_bitwork_full_str():
     assert(get_next_bitwork_full_str('88888', 2) == '888')
     assert(get_next_bitwork_full_str('88888', 3) == '8888')
     assert(get_next_bitwork_full_str('88888', 4) == '88888')
- 
\ No newline at end of file
+ 
+
+def reveal_script(envelope):
+    return bytes([0x20]) + bytes(32) + bytes.fromhex('ac') + envelope + bytes.fromhex('68')
+
+def test_parse_protocols_operations_from_witness_for_input():
+    payload = dumps({'args': {'time': 1}})
+    envelope = bytes.fromhex('00630461746f6d03646674') + bytes([len(payload)]) + payload
+    op, op_payload, decoded = parse_protocols_operations_from_witness_for_input([b'sig', reveal_script(envelope)])
+    assert (op, op_payload, decoded) == ('dft', payload, {'args': {'time': 1}})
+    # The nft payload is left for the caller to decode
+    nft_envelope = envelope.replace(bytes.fromhex('03646674'), bytes.fromhex('036e6674'))
+    op, op_payload, decoded = parse_protocols_operations_from_witness_for_input([reveal_script(nft_envelope)])
+    assert (op, op_payload, decoded) == ('nft', payload, None)
+    # An OP_IF without the marker before the envelope is skipped
+    op, _, _ = parse_protocols_operations_from_witness_for_input([reveal_script(bytes.fromhex('63') + envelope)])
+    assert op == 'dft'
+    # The envelope must follow the pubkey push
+    assert parse_protocols_operations_from_witness_for_input([envelope + bytes(40)]) == (None, None, None)
+    assert parse_protocols_operations_from_witness_for_input([reveal_script(b'')]) == (None, None, None)
+
+def test_has_atomicals_envelope():
+    assert has_atomicals_envelope(bytes(10) + bytes.fromhex('630461746f6d') + bytes(10))
+    assert not has_atomicals_envelope(bytes(10) + bytes.fromhex('0461746f6d') + bytes(10))
@@ -72,6 +72,28 @@ def test_increment_byte_string():
     assert util.increment_byte_string(b'\xff\xff') is None
 
 
+def test_bloom_filter():
+    bloom = util.BloomFilter(1000)
+    items = [os.urandom(36) for _ in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(os.urandom(36) in bloom for _ in range(10000))
+    assert false_positives < 300
+
+
+def test_scalable_bloom_filter():
+    bloom = util.ScalableBloomFilter(1000)
+    items = [os.urandom(36) for _ in range(5000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    assert bloom.count == 5000
+    assert len(bloom.filters) == 3
+    false_positives = sum(os.urandom(36) in bloom for _ in range(10000))
+    assert false_positives < 300
+
+
 def test_bytes_to_int():
     assert util.bytes_to_int(b'\x07[\xcd\x15') == 123456789
 
@@ -107,6 +129,32 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+def test_MappedLogicalFile(tmpdir):
+    prefix = os.path.join(tmpdir, 'log')
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    assert L.read(0, 4) == b''
+    assert L.view(0, 4) == b''
+
+    # Reads see appends, overwrites and later files
+    L.write(0, b'987')
+    assert L.read(0, 4) == b'987'
+    view = L.view(1, 2)
+    assert isinstance(view, memoryview) and view == b'87'
+    L.write(3, b'654')
+    assert L.read(0, 6) == b'987654'
+    L.write(0, b'0')
+    assert L.read(0, 2) == b'08'
+    assert view == b'87'
+    L.write(6, b'3210')
+    assert L.read(0, -1) == b'0876543210'
+
+    # Test file boundary
+    assert L.read(4, 4) == b'5432'
+    assert L.view(4, 4) == b'5432'
+    assert L.read(8, 10) == b'10'
+    assert L.read(12, 1) == b''
+    assert L.read(4, 4) == util.LogicalFile(prefix, 2, 6).read(4, 4)
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -107,9 +107,10 @@ def compact_history(history):
     limit = 5 * 1000
 
     write_size = 0
-    while history.comp_cursor != -1:
+    while history.comp_cursor != 65536:
         write_size += history._compact_history(limit)
     assert write_size != 0
+    assert history.finish_compaction()
 
 
 @pytest.mark.asyncio
@@ -131,3 +132,99 @@ async def test_compaction(tmpdir):
     check_written(history, histories)
     compact_history(history)
     check_written(history, histories)
+    # LevelDB locks by relative path, so close before the next test
+    db.utxo_db.close()
+    history.close_db()
+
+
+def add_history(history, histories, tx_num):
+    '''Add a tx to the unflushed history of half the hashXs.'''
+    tx_numb = pack_le_uint64(tx_num)[:5]
+    for hashX in random.sample(list(histories), len(histories) // 2):
+        histories[hashX].append(tx_num)
+        history.unflushed[hashX].extend(tx_numb)
+
+
+@pytest.mark.asyncio
+async def test_online_compaction(tmpdir):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(tmpdir)
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    db = DB(Env())
+    await db.open_for_serving()
+    history = db.history
+    try:
+        histories = create_histories(history)
+        tx_num = max(max(hist) for hist in histories.values() if hist) + 1
+        flush_count = history.flush_count
+
+        # Flushes between compaction steps write around its cursor
+        history.start_compaction()
+        assert history.compaction_progress() == 0
+        steps = 0
+        while history.comp_cursor != 65536:
+            history.compaction_step(5 * 1000)
+            add_history(history, histories, tx_num)
+            history.flush()
+            tx_num += 1
+            steps += 1
+        assert steps > 1
+        # Flushes still write around a compaction complete in-memory
+        add_history(history, histories, tx_num)
+        history.flush()
+        tx_num += 1
+        check_written(history, histories)
+
+        # An unclean shutdown before the UTXO DB records the reset flush
+        # count leaves it below the UTXO flush count
+        assert history.finish_compaction()
+        assert history.compaction_progress() is None
+        assert history.flush_count < flush_count
+        add_history(history, histories, tx_num)
+        history.flush()
+        for hist in histories.values():
+            if hist and hist[-1] == tx_num:
+                hist.pop()
+        history.clear_excess(flush_count, tx_num)
+        check_written(history, histories)
+
+        # Later flushes follow the compacted rows
+        for _ in range(3):
+            add_history(history, histories, tx_num)
+            history.flush()
+            tx_num += 1
+        check_written(history, histories)
+
+        # The excess of an unclean shutdown mid-compaction is found by tx number
+        history.start_compaction()
+        history.compaction_step(5 * 1000)
+        utxo_flush_count = history.flush_count
+        add_history(history, histories, tx_num)
+        history.flush()
+        history.compaction_step(5 * 1000)
+        for hist in histories.values():
+            if hist and hist[-1] == tx_num:
+                hist.pop()
+        history.clear_excess(utxo_flush_count, tx_num)
+        check_written(history, histories)
+
+        # Rows of the longer Atomicals hashXs are trimmed too
+        atomicals_hashX = urandom(32)
+        histories[atomicals_hashX] = array.array('I', [tx_num])
+        history.unflushed[atomicals_hashX].extend(pack_le_uint64(tx_num)[:5])
+        history.flush()
+        tx_num += 1
+        utxo_flush_count = history.flush_count
+        for excess_tx_num in (tx_num, tx_num + 1):
+            history.unflushed[atomicals_hashX].extend(pack_le_uint64(excess_tx_num)[:5])
+            add_history(history, histories, excess_tx_num)
+            history.flush()
+        for hist in histories.values():
+            while hist and hist[-1] >= tx_num:
+                hist.pop()
+        history.clear_excess(utxo_flush_count, tx_num)
+        check_written(history, histories)
+    finally:
+        db.utxo_db.close()
+        history.close_db()
@@ -0,0 +1,708 @@
+'''Tests of the UTXO reads and derived Atomicals indexes of server/db.py'''
+from array import array
+from contextlib import asynccontextmanager
+from os import environ, urandom
+
+import pytest
+
+from cbor2 import dumps, loads
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_be_uint16, pack_be_uint64, pack_le_uint32, pack_le_uint64
+from electrumx.lib.util_atomicals import SUBREALM_MINT_PATH, calculate_latest_state_from_mod_history
+from electrumx.server.block_processor import BlockProcessor
+from electrumx.server.env import Env
+from electrumx.server.storage import FlushJournal
+from electrumx.server.db import (
+    DB, FlushData, AtomicalsUtxoCache, DataCache, NestedDataCache, RawBlockStore
+)
+
+
+def flush_data(db, **kwargs):
+    '''A FlushData at the DB height with nothing to flush but kwargs.'''
+    fields = dict(
+        height=db.db_height, tx_count=db.db_tx_count, headers=[],
+        block_tx_hashes=[], undo_infos=[], adds={}, deletes=[],
+        tip=db.db_tip, atomical_count=db.db_atomical_count,
+        atomicals_undo_infos=[], atomicals_adds=AtomicalsUtxoCache(), general_adds={},
+        realm_adds={}, container_adds={}, ticker_adds={}, subrealm_adds={},
+        subrealmpay_adds={}, dmitem_adds={}, dmpay_adds={}, distmint_adds={},
+        state_adds={}, op_adds={}, op_history_adds={},
+    )
+    fields.update(kwargs)
+    return FlushData(**fields)
+
+
+def flush(db, **kwargs):
+    with db.utxo_db.write_batch() as batch:
+        db.flush_utxo_db(batch, flush_data(db, **kwargs))
+
+
+@asynccontextmanager
+async def open_db(tmpdir):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(tmpdir)
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    db = DB(Env())
+    try:
+        await db.open_for_serving()
+        yield db
+    finally:
+        # LevelDB locks by relative path, so close before the next test
+        if db.utxo_db:
+            db.utxo_db.close()
+        if db.history.db:
+            db.history.close_db()
+
+
+@pytest.mark.asyncio
+async def test_new_db_has_all_indexes(tmpdir):
+    async with open_db(tmpdir) as db:
+        assert db.built_indexes == set(db.derived_index_builders())
+
+
+@pytest.mark.asyncio
+async def test_distmint_count(tmpdir):
+    async with open_db(tmpdir) as db:
+        atomical_id = urandom(36)
+        locations = [urandom(36) for _ in range(5)]
+        flush(db, distmint_adds={atomical_id: {loc: b'v' for loc in locations}})
+        assert db.get_distmint_count(atomical_id) == 5
+        assert db.count_distmints_by_scan(atomical_id) == 5
+
+        # Backing up deletes b'gi' entries; a repeated delete counts once
+        key = b'gi' + atomical_id + locations[0]
+        flush(db, deletes=[key, key, b'gi' + atomical_id + locations[1]])
+        assert db.get_distmint_count(atomical_id) == 3
+        assert db.count_distmints_by_scan(atomical_id) == 3
+        assert db.get_distmint_count(urandom(36)) == 0
+
+
+@pytest.mark.asyncio
+async def test_distmint_count_built_for_existing_db(tmpdir):
+    async with open_db(tmpdir) as db:
+        atomical_id = urandom(36)
+        for _ in range(3):
+            db.utxo_db.put(b'gi' + atomical_id + urandom(36), b'v')
+        db.built_indexes.discard('distmint_count')
+        db.build_missing_indexes()
+        assert 'distmint_count' in db.built_indexes
+        assert db.get_distmint_count(atomical_id) == 3
+
+
+def op_history_adds(hashX, op, tx_nums):
+    return {b'x' + hashX + bytes([op]): {pack_be_uint64(tx_num)[-5:]: b'' for tx_num in tx_nums}}
+
+
+@pytest.mark.asyncio
+async def test_op_history(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashX = urandom(HASHX_LEN)
+        flush(db, op_history_adds={**op_history_adds(hashX, 30, [2, 256]),
+                                   **op_history_adds(hashX, 1, [3])})
+        flush(db, op_history_adds=op_history_adds(hashX, 30, [1]))
+
+        def page(*args):
+            history, total = db.get_op_history(hashX, 30, *args)
+            return [item['tx_num'] for item in history], total
+
+        assert page(10) == ([256, 2, 1], 3)
+        assert page(1, 1) == ([2], 3)
+        assert page(10, 0, False) == ([1, 2, 256], 3)
+        assert db.get_op_history(hashX, 20, 10) == ([], 0)
+
+        with db.utxo_db.write_batch() as batch:
+            db.backup_op_history(batch, {hashX, urandom(32)}, 4)
+        assert page(10) == ([2, 1], 2)
+        assert db.get_op_history(hashX, 1, 10)[1] == 1
+        with db.utxo_db.write_batch() as batch:
+            db.backup_op_history(batch, {hashX}, 0)
+        assert page(10) == ([], 0)
+        assert db.utxo_db.get(b'wx' + hashX + bytes([1])) is None
+
+
+@pytest.mark.asyncio
+async def test_atomicals_activity(tmpdir):
+    async with open_db(tmpdir) as db:
+        activity = {b'v' + bytes([1]): {pack_be_uint64(tx_num)[-5:]: b'' for tx_num in (1, 256, 300)},
+                    b'v' + bytes([30]): {pack_be_uint64(tx_num)[-5:]: b'' for tx_num in (2, 257)}}
+        flush(db, op_history_adds=activity)
+
+        def pages(*args, **kwargs):
+            result = []
+            cursor = None
+            while True:
+                history, cursor, total = db.get_atomicals_activity(2, *args, cursor=cursor, **kwargs)
+                result.append([(item['tx_num'], item['op']) for item in history])
+                if cursor is None:
+                    return result, total
+
+        assert pages() == ([[(300, 1), (257, 30)], [(256, 1), (2, 30)], [(1, 1)]], 5)
+        assert pages(reverse=False) == ([[(1, 1), (2, 30)], [(256, 1), (257, 30)], [(300, 1)]], 5)
+        assert pages(1) == ([[(300, 1), (256, 1)], [(1, 1)]], 3)
+        assert pages(30, offset=1) == ([[(2, 30)]], 2)
+        assert db.get_atomicals_activity(2, 20) == ([], None, 0)
+
+        with db.utxo_db.write_batch() as batch:
+            db.backup_op_history(batch, set(), 257)
+        assert pages() == ([[(256, 1), (2, 30)], [(1, 1)]], 3)
+
+
+@pytest.mark.asyncio
+async def test_atomicals_activity_built_for_existing_db(tmpdir):
+    async with open_db(tmpdir) as db:
+        for tx_num, op in ((5, 1), (6, 30), (7, 1)):
+            db.utxo_db.put(b'op' + pack_le_uint64(tx_num), pack_le_uint32(op))
+        db.built_indexes.discard('atomicals_activity')
+        db.build_missing_indexes()
+        assert 'atomicals_activity' in db.built_indexes
+        history, cursor, total = db.get_atomicals_activity(10)
+        assert [(item['tx_num'], item['op']) for item in history] == [(7, 1), (6, 30), (5, 1)]
+        assert (cursor, total) == (None, 3)
+
+
+@pytest.mark.asyncio
+async def test_op_history_built_for_existing_db(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashX, atomical_hashX = urandom(HASHX_LEN), urandom(32)
+        for tx_num, op in ((5, 1), (6, 30), (7, 1)):
+            db.utxo_db.put(b'op' + pack_le_uint64(tx_num), pack_le_uint32(op))
+        tx_numbs = [pack_le_uint64(tx_num)[:5] for tx_num in range(4, 8)]
+        db.history.db.put(hashX + pack_be_uint16(0), b''.join(tx_numbs[:3]))
+        db.history.db.put(hashX + pack_be_uint16(1), tx_numbs[3])
+        db.history.db.put(atomical_hashX + pack_be_uint16(1), tx_numbs[1])
+        db.built_indexes.discard('op_history')
+        db.build_missing_indexes()
+        assert 'op_history' in db.built_indexes
+        assert db.get_op_history(hashX, 1, 10) == (
+            [{'tx_num': 7, 'op': 1}, {'tx_num': 5, 'op': 1}], 2)
+        assert db.get_op_history(hashX, 30, 10) == ([{'tx_num': 6, 'op': 30}], 1)
+        assert db.get_op_history(atomical_hashX, 1, 10) == ([{'tx_num': 5, 'op': 1}], 1)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_chunked_flush(tmpdir):
+    async with open_db(tmpdir) as db:
+        with FlushJournal(db.utxo_db, 1).writer() as batch:
+            batch.put(b'tx1', b'1')
+        # Interrupted before its state was committed
+    async with open_db(tmpdir) as db:
+        assert db.utxo_db.get(b'tx1') is None
+        assert not list(db.utxo_db.iterator(prefix=FlushJournal.PREFIX))
+        with FlushJournal(db.utxo_db, 1).writer() as batch:
+            batch.put(b'tx2', b'2')
+        # Interrupted after its state was committed
+        db.partial_flush = True
+        db.set_flush_count(db.utxo_flush_count)
+    async with open_db(tmpdir) as db:
+        assert db.utxo_db.get(b'tx2') == b'2'
+        assert not db.partial_flush
+        assert not list(db.utxo_db.iterator(prefix=FlushJournal.PREFIX))
+
+@pytest.mark.asyncio
+async def test_read_utxo_entries(tmpdir):
+    async with open_db(tmpdir) as db:
+        adds = {}
+        for tx_num in range(3):
+            prevout = urandom(32) + pack_le_uint32(tx_num)
+            hashX = urandom(HASHX_LEN)
+            adds[prevout] = hashX + pack_le_uint64(tx_num)[:5] + pack_le_uint64(1000 + tx_num)
+        expected = dict(adds)
+        flush(db, adds=adds)
+
+        missing = urandom(32) + pack_le_uint32(0)
+        entries = db.read_utxo_entries(list(expected) + [missing])
+        assert set(entries) == set(expected)
+        for prevout, (hdb_key, udb_key, value) in entries.items():
+            assert udb_key[1:1 + HASHX_LEN] + hdb_key[-5:] + value == expected[prevout]
+
+
+@pytest.mark.asyncio
+async def test_fs_tx_hashes(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashes = [urandom(32) for _ in range(5)]
+        db.hashes_file.write(0, b''.join(hashes))
+        db.tx_counts = [1, 3]
+        db.db_height = 1
+        tx_nums = [4, 0, 2, 1, 3]
+        assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+        assert db.fs_tx_hashes(tx_nums) == [(None, 2), (hashes[0], 0), (hashes[2], 1),
+                                            (hashes[1], 1), (None, 2)]
+        assert db.fs_tx_hashes_at_blockheight(1) == hashes[1:3]
+
+
+@pytest.mark.asyncio
+async def test_lookup_utxos(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashes = [urandom(32) for _ in range(3)]
+        db.hashes_file.write(0, b''.join(hashes))
+        db.tx_counts = [3]
+        db.db_height = 0
+        adds = {}
+        for tx_num, tx_hash in enumerate(hashes):
+            hashX = urandom(HASHX_LEN)
+            adds[tx_hash + pack_le_uint32(0)] = (hashX + pack_le_uint64(tx_num)[:5]
+                                                 + pack_le_uint64(1000 + tx_num))
+        expected = dict(adds)
+        flush(db, adds=adds)
+
+        # A tx hash whose compressed form collides with a UTXO's is not found
+        collision = hashes[1][:-1] + bytes([hashes[1][-1] ^ 1])
+        prevouts = [(hashes[2], 0), (collision, 0), (hashes[0], 1), (hashes[0], 0)]
+        assert await db.lookup_utxos(prevouts) == [
+            (expected[hashes[2] + pack_le_uint32(0)][:HASHX_LEN], 1002), None, None,
+            (expected[hashes[0] + pack_le_uint32(0)][:HASHX_LEN], 1000),
+        ]
+
+
+def test_atomicals_utxo_cache():
+    cache = AtomicalsUtxoCache()
+    location, atomical_id = urandom(36), urandom(36)
+    cache.put(location, atomical_id, b'1')
+    cache.put(location, urandom(36), b'2')
+    assert cache.utxo_count == 2
+    cache[location][0].deleted = True
+    # Putting the same Atomical again replaces it and revives the tombstone
+    cache.put(location, atomical_id, b'3')
+    assert cache.utxo_count == 2
+    assert (cache[location][0].value, cache[location][0].deleted) == (b'3', False)
+    assert cache.memsize() == cache.LOCATION_SIZE + 2 * cache.UTXO_SIZE
+    cache.clear()
+    assert not cache and cache.memsize() == 0
+
+
+
+def test_data_cache():
+    cache = DataCache()
+    put = cache.__setitem__
+    put(b'k1', b'v' * 10)
+    put(b'k2', b'v' * 20)
+    assert cache.memsize() == 2 * cache.ENTRY_SIZE + 4 + 30
+    put(b'k1', b'v')
+    assert cache.memsize() == 2 * cache.ENTRY_SIZE + 4 + 21
+    assert cache.pop(b'k2') == b'v' * 20
+    assert cache.pop(b'k2', None) is None
+    assert cache.memsize() == cache.ENTRY_SIZE + 2 + 1
+    del cache[b'k1']
+    assert cache.memsize() == 0
+    put(b'k3', b'v')
+    cache.clear()
+    assert not cache and cache.memsize() == 0
+
+
+def test_nested_data_cache():
+    cache = NestedDataCache()
+    cache.put(b'key', 1, b'v' * 10)
+    cache.put(b'key', 2, b'v' * 10)
+    cache.put(b'key', 2, b'v' * 5)
+    entries_size = 2 * cache.ENTRY_SIZE + 15
+    assert cache.memsize() == cache.KEY_SIZE + 3 + entries_size
+    assert cache.pop_entry(b'key', 1) == b'v' * 10
+    assert cache.pop_entry(b'key', 1) is None
+    assert cache.pop_entry(b'other', 1) is None
+    assert cache == {b'key': {2: b'v' * 5}}
+    assert cache.memsize() == cache.KEY_SIZE + 3 + cache.ENTRY_SIZE + 5
+    cache.clear()
+    assert not cache and cache.memsize() == 0
+
+
+def test_caches_read_through_frozen():
+    frozen, cache = DataCache(), DataCache()
+    frozen[b'a'] = b'1'
+    frozen[b'b'] = b'1'
+    cache[b'b'] = b'2'
+    cache.frozen = frozen
+    assert (cache.get(b'a'), cache.get(b'b'), cache.get(b'c', b'3')) == (b'1', b'2', b'3')
+    assert len(cache) == 1
+
+    frozen, cache = NestedDataCache(), NestedDataCache()
+    frozen.put(b'key', 1, b'1')
+    frozen.put(b'key', 2, b'1')
+    cache.put(b'key', 2, b'2')
+    cache.put(b'other', 3, b'3')
+    cache.frozen = frozen
+    assert cache.get(b'key') == {1: b'1', 2: b'2'}
+    assert cache.get(b'other') == {3: b'3'}
+    assert cache.get(b'none') is None
+    # The frozen entries are not changed
+    assert frozen == {b'key': {1: b'1', 2: b'1'}}
+
+    # Entries are added to the live layer when only the frozen has the key
+    cache = NestedDataCache()
+    cache.frozen = frozen
+    cache.put(b'key', 3, b'3')
+    assert cache.get(b'key') == {1: b'1', 2: b'1', 3: b'3'}
+    assert dict(cache) == {b'key': {3: b'3'}}
+    assert frozen == {b'key': {1: b'1', 2: b'1'}}
+
+
+@pytest.mark.asyncio
+async def test_flush_keeping_caches(tmpdir):
+    async with open_db(tmpdir) as db:
+        prevout = urandom(32) + pack_le_uint32(0)
+        hashX = urandom(HASHX_LEN)
+        adds = {prevout: hashX + pack_le_uint64(1)[:5] + pack_le_uint64(1000)}
+        general_adds = {b'md' + urandom(36): b'data'}
+        with db.utxo_db.write_batch() as batch:
+            db.flush_utxo_db(batch, flush_data(db, adds=adds, general_adds=general_adds),
+                             keep_caches=True)
+        assert adds and general_adds
+        key, value = general_adds.popitem()
+        assert db.utxo_db.get(key) == value
+        assert prevout in db.read_utxo_entries([prevout])
+
+
+@pytest.mark.asyncio
+async def test_background_flush_state(tmpdir):
+    async with open_db(tmpdir) as db:
+        tip = db.db_tip
+        commit = db.prepare_flush(flush_data(db, tip=urandom(32)), True, lambda: 0,
+                                  background=True)
+        # The DB state only advances as the batch commits
+        assert db.db_tip == tip
+        commit()
+        assert db.db_tip != tip
+
+
+@pytest.mark.asyncio
+async def test_flush_atomicals_utxos(tmpdir):
+    async with open_db(tmpdir) as db:
+        cache = AtomicalsUtxoCache()
+        location, spent_location = urandom(36), urandom(36)
+        atomical_id = urandom(36)
+        value = urandom(58)
+        cache.put(location, atomical_id, value)
+        cache.put(spent_location, atomical_id, value)
+        cache[spent_location][0].deleted = True
+        flush(db, atomicals_adds=cache)
+        assert not cache
+
+        get = db.utxo_db.get
+        assert get(b'i' + location + atomical_id) == value
+        assert get(b'i' + spent_location + atomical_id) == value
+        assert get(b'a' + atomical_id + location) == value
+        assert get(b'a' + atomical_id + spent_location) is None
+        assert db.may_have_active_atomicals(location)
+
+
+def active_value(hashX, value_sats):
+    return hashX + urandom(32) + pack_le_uint64(value_sats) + bytes(2) + urandom(5)
+
+
+@pytest.mark.asyncio
+async def test_atomicals_balances(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashX, other_hashX = urandom(HASHX_LEN), urandom(HASHX_LEN)
+        ft_id, nft_id = urandom(36), urandom(36)
+        locations = [urandom(36) for _ in range(3)]
+        cache = AtomicalsUtxoCache()
+        cache.put(locations[0], ft_id, active_value(hashX, 1000))
+        cache.put(locations[1], ft_id, active_value(hashX, 500))
+        cache.put(locations[1], nft_id, active_value(hashX, 500))
+        cache.put(locations[2], ft_id, active_value(other_hashX, 7))
+        # Spent before the flush, so never active
+        spent_location = urandom(36)
+        cache.put(spent_location, ft_id, active_value(hashX, 99))
+        cache[spent_location][0].deleted = True
+        flush(db, atomicals_adds=cache)
+        assert sorted(db.get_atomicals_balances(hashX)) == sorted([(ft_id, 1500), (nft_id, 500)])
+        assert db.get_atomicals_balances(other_hashX) == [(ft_id, 7)]
+
+        # Spending or backing up removes the b'a' entries
+        flush(db, deletes=[b'a' + ft_id + locations[0], b'a' + nft_id + locations[1],
+                           b'a' + ft_id + locations[2], b'a' + ft_id + urandom(36)])
+        assert db.get_atomicals_balances(hashX) == [(ft_id, 500)]
+        assert db.get_atomicals_balances(other_hashX) == []
+
+
+@pytest.mark.asyncio
+async def test_atomicals_balances_built_for_existing_db(tmpdir):
+    async with open_db(tmpdir) as db:
+        hashX, atomical_id = urandom(HASHX_LEN), urandom(36)
+        for value_sats in (3, 4):
+            db.utxo_db.put(b'a' + atomical_id + urandom(36), active_value(hashX, value_sats))
+        db.built_indexes.discard('atomicals_balances')
+        db.build_missing_indexes()
+        assert 'atomicals_balances' in db.built_indexes
+        assert db.get_atomicals_balances(hashX) == [(atomical_id, 7)]
+
+
+@pytest.mark.asyncio
+async def test_atomical_holders(tmpdir):
+    async with open_db(tmpdir) as db:
+        atomical_id = urandom(36)
+        scripts = [urandom(25) for _ in range(3)]
+        # hashX + scripthash of each script
+        script_keys = [urandom(HASHX_LEN + 32) for _ in range(3)]
+        locations = [urandom(36) for _ in range(5)]
+
+        def holder_value(n, value_sats):
+            return script_keys[n] + pack_le_uint64(value_sats) + bytes(7)
+
+        cache = AtomicalsUtxoCache()
+        general_adds = {}
+        for location, n, value_sats in zip(locations, (0, 0, 1, 2, 2), (10, 20, 50, 5, 1)):
+            cache.put(location, atomical_id, holder_value(n, value_sats))
+            general_adds[b'po' + location] = scripts[n]
+        flush(db, atomicals_adds=cache, general_adds=general_adds)
+
+        def holders(*args):
+            return [(holder['script'], holder['holding'])
+                    for holder in db.get_atomical_holders(atomical_id, *args)]
+
+        assert holders() == [(scripts[1].hex(), 50), (scripts[0].hex(), 30),
+                             (scripts[2].hex(), 6)]
+        assert holders(1, 1) == [(scripts[0].hex(), 30)]
+        assert holders(5, 2) == [(scripts[2].hex(), 6)]
+
+        # Spends move holders down the ranking, and drop them at zero
+        flush(db, deletes=[b'a' + atomical_id + locations[n] for n in (1, 2)])
+        assert holders() == [(scripts[0].hex(), 10), (scripts[2].hex(), 6)]
+        assert holders(10, 5) == []
+        atomical = await db.populate_extended_atomical_holder_info(atomical_id, {}, 1)
+        assert atomical['holders'] == [{'holding': 10, 'script': scripts[0].hex()}]
+
+        # An existing DB builds the same index
+        with db.utxo_db.write_batch() as batch:
+            for prefix in (b'j', b'q'):
+                for db_key, _ in db.utxo_db.iterator(prefix=prefix):
+                    batch.delete(db_key)
+        db.built_indexes.discard('atomicals_holders')
+        db.build_missing_indexes()
+        assert 'atomicals_holders' in db.built_indexes
+        assert holders() == [(scripts[0].hex(), 10), (scripts[2].hex(), 6)]
+
+
+@pytest.mark.asyncio
+async def test_location_summary(tmpdir):
+    async with open_db(tmpdir) as db:
+        atomical_id = urandom(36)
+        script_keys = [urandom(HASHX_LEN + 32) for _ in range(2)]
+        locations = [urandom(36) for _ in range(3)]
+        cache = AtomicalsUtxoCache()
+        for location, n, value_sats in zip(locations, (0, 0, 1), (10, 20, 5)):
+            cache.put(location, atomical_id, script_keys[n] + pack_le_uint64(value_sats) + bytes(7))
+        flush(db, atomicals_adds=cache)
+        assert db.get_location_summary(atomical_id) == (35, 2)
+        assert db.scan_location_summary(atomical_id) == (35, 2)
+        assert db.get_active_supply(atomical_id) == 35
+
+        flush(db, deletes=[b'a' + atomical_id + locations[n] for n in (0, 2)])
+        assert db.get_location_summary(atomical_id) == (20, 1)
+        assert db.scan_location_summary(atomical_id) == (20, 1)
+
+        with db.utxo_db.write_batch() as batch:
+            batch.delete(b'y' + atomical_id)
+        db.built_indexes.discard('atomicals_supply')
+        db.build_missing_indexes()
+        assert db.get_location_summary(atomical_id) == (20, 1)
+
+        flush(db, deletes=[b'a' + atomical_id + locations[1]])
+        assert db.get_location_summary(atomical_id) == (0, 0)
+        assert db.utxo_db.get(b'y' + atomical_id) is None
+
+
+def mod_entries(tx_nums):
+    '''Return the (suffix, data) of a b'mod' entry for each tx_num.'''
+    entries = []
+    for tx_num in tx_nums:
+        data = {'n': tx_num, 'args': tx_num, f'k{tx_num % 3}': {'v': tx_num}}
+        if tx_num % 7 == 0:
+            data = {'$a': 1, 'k1': True}
+        suffix = pack_le_uint64(tx_num)[:5] + urandom(32) + pack_le_uint32(0)
+        entries.append((suffix, dumps(data)))
+    return entries
+
+
+def expected_mod_state(entries):
+    history = [{'tx_num': tx_num, 'data': loads(data)} for tx_num, data in entries]
+    return calculate_latest_state_from_mod_history(history)
+
+
+@pytest.mark.asyncio
+async def test_mod_state(tmpdir):
+    async with open_db(tmpdir) as db:
+        db.MOD_STATE_CHECKPOINT = 4
+        atomical_id = urandom(36)
+        prefix = b'mod' + atomical_id
+        entries = mod_entries(range(250, 280))
+        for start in range(0, 30, 10):
+            flush(db, state_adds={prefix: dict(entries[start:start + 10])})
+        history = [(250 + n, data) for n, (_, data) in enumerate(entries)]
+        assert db.get_mod_state(atomical_id) == expected_mod_state(history)
+        assert db.get_mod_state(urandom(36)) == {}
+        assert db.get_mod_state_version(atomical_id) == 279
+        assert db.get_mod_state_version(urandom(36)) is None
+
+        # Ten txs per block.  Mods after max_height are left out as the mod
+        # history leaves them out
+        tx_counts = db.tx_counts
+        db.tx_counts = array('Q', range(10, 1000, 10))
+        for max_height in (0, 25, 26, 27, 30):
+            assert db.has_mods_after(atomical_id, max_height) == (max_height < 27)
+            assert db.get_mod_state(atomical_id, max_height) == calculate_latest_state_from_mod_history(
+                db.get_mod_history(atomical_id, max_height))
+        assert db.get_mod_state(atomical_id, 27) == expected_mod_state(history)
+        assert db.get_mod_state(atomical_id, 1000) == expected_mod_state(history)
+        db.tx_counts = tx_counts
+
+        # A backup removes the newest mods and the next mods fold on the rest
+        flush(db, deletes=[prefix + suffix for suffix, _ in entries[25:]])
+        assert db.get_mod_state(atomical_id) == expected_mod_state(history[:25])
+        more = mod_entries(range(290, 296))
+        flush(db, state_adds={prefix: dict(more)})
+        history = history[:25] + [(290 + n, data) for n, (_, data) in enumerate(more)]
+        assert db.get_mod_state(atomical_id) == expected_mod_state(history)
+
+        with db.utxo_db.write_batch() as batch:
+            for key, _ in db.utxo_db.iterator(prefix=b'z'):
+                batch.delete(key)
+        db.built_indexes.discard('mod_state')
+        db.build_missing_indexes()
+        assert db.get_mod_state(atomical_id) == expected_mod_state(history)
+
+
+def rules_mod(tx_num, pattern):
+    '''Return the (suffix, data) of a b'mod' entry setting the subrealm rules.'''
+    suffix = pack_le_uint64(tx_num)[:5] + urandom(32) + pack_le_uint32(0)
+    return suffix, dumps({SUBREALM_MINT_PATH: {'rules': [{'p': pattern, 'bitworkc': 'ab'}]}})
+
+
+@pytest.mark.asyncio
+async def test_rules_cache(tmpdir):
+    async with open_db(tmpdir) as db:
+        bp = BlockProcessor(db.env, db, None, None)
+        atomical_id = urandom(36)
+        prefix = b'mod' + atomical_id
+        flush(db, state_adds={prefix: dict([rules_mod(10, 'a.*')])})
+
+        def patterns():
+            return [rule['p'] for rule in bp.get_rules_by_height(atomical_id, 100, SUBREALM_MINT_PATH)]
+
+        assert patterns() == ['a.*']
+        compiled_rules = bp.get_compiled_rules_by_height(atomical_id, 100, SUBREALM_MINT_PATH)
+        assert bp.get_compiled_rules_by_height(atomical_id, 100, SUBREALM_MINT_PATH) is compiled_rules
+
+        # A new mod invalidates the cached rules
+        suffix, data = rules_mod(20, 'b.*')
+        bp.put_state_data(prefix, suffix, data)
+        assert atomical_id not in bp.atomicals_rules_cache
+        assert patterns() == ['b.*']
+        assert atomical_id in bp.atomicals_rules_cache
+
+        # Backing up clears them
+        bp.delete_state_data(prefix, suffix, data)
+        bp.clear_atomicals_caches()
+        assert len(bp.atomicals_rules_cache) == 0
+        assert patterns() == ['a.*']
+
+
+@pytest.mark.asyncio
+async def test_mod_and_event_history(tmpdir):
+    async with open_db(tmpdir) as db:
+        # Ten txs per block
+        db.tx_counts = array('Q', range(10, 1000, 10))
+        atomical_id = urandom(36)
+        # Little endian tx numbers do not sort in tx order
+        entries = mod_entries([5, 255, 256, 300, 511, 512])
+        for prefix_key in (b'mod', b'evt'):
+            flush(db, state_adds={prefix_key + atomical_id: dict(entries)})
+
+        for get_history in (db.get_mod_history, db.get_evt_history):
+            history = get_history(atomical_id, 1000)
+            assert [(entry['tx_num'], entry['height']) for entry in history] == [
+                (512, 51), (511, 51), (300, 30), (256, 25), (255, 25), (5, 0)]
+            assert history[-1]['data'] == loads(entries[0][1])
+            assert [entry['tx_num'] for entry in get_history(atomical_id, 51)] == [
+                512, 511, 300, 256, 255, 5]
+            # The history stops at the first later entry in key order
+            assert get_history(atomical_id, 30) == []
+            assert [entry['tx_num'] for entry in get_history(atomical_id, 1000, 2, 1)] == [511, 300]
+            assert get_history(atomical_id, 30, 2, 3) == []
+            assert get_history(urandom(36), 1000) == []
+
+
+def name_key(prefix, name):
+    return prefix + name + pack_le_uint32(len(name))
+
+
+@pytest.mark.asyncio
+async def test_name_entries_pages(tmpdir):
+    async with open_db(tmpdir) as db:
+        names = [b'a', b'ab', b'abc', b'b', b'bc', b'c-1']
+        flush(db, realm_adds={name_key(b'rlm', name): {300 + n: urandom(36)} for n, name in enumerate(names)})
+
+        def search(subject, Reverse=False, Limit=100, Offset=0, Cursor=None):
+            entries, cursor = db.get_name_entries_template_limited(b'rlm', None, subject, Reverse, Limit, Offset, Cursor)
+            return [entry['name'].encode() for entry in entries], cursor
+
+        assert search(b'') == (names, None)
+        assert search(b'a', Reverse=True) == ([b'abc', b'ab', b'a'], None)
+        for Reverse in (False, True):
+            expected = names[::-1] if Reverse else names
+            pages = []
+            cursor = None
+            while True:
+                page, cursor = search(b'', Reverse, 2, 0, cursor)
+                pages.extend(page)
+                if cursor is None:
+                    break
+            assert pages == expected
+            page, cursor = search(b'', Reverse, 2, 1)
+            assert page == expected[1:3]
+            assert search(b'', Reverse, 2, 1, cursor)[0] == expected[4:6]
+        # A page of a search only follows a cursor of the same search
+        _, cursor = search(b'a', Limit=1)
+        assert search(b'a', Limit=5, Cursor=cursor)[0] == [b'ab', b'abc']
+        assert search(b'b', Cursor=cursor) == ([], None)
+
+
+@pytest.mark.asyncio
+async def test_dmitem_entries_pages(tmpdir):
+    async with open_db(tmpdir) as db:
+        container_id = urandom(36)
+        prefix = b'codmt' + container_id
+        names = [b'item-1', b'item-10', b'item-2', b'item-3']
+        # The first names have several candidates
+        flush(db, dmitem_adds={name_key(prefix, name): {tx_num: urandom(36) for tx_num in range(4 - n)}
+                               for n, name in enumerate(names)})
+        expected = [name.decode() for name in names]
+
+        assert await db.get_dmitem_entries_paginated(container_id, 10, 0) == (expected, None)
+        assert await db.get_dmitem_entries_paginated(container_id, 2, 1) == (expected[1:3], expected[2])
+        page, cursor = await db.get_dmitem_entries_paginated(container_id, 1, 0)
+        assert page == expected[:1]
+        assert await db.get_dmitem_entries_paginated(container_id, 2, 0, cursor) == (expected[1:3], expected[2])
+        assert await db.get_dmitem_entries_paginated(container_id, 2, 1, cursor) == (expected[2:], None)
+        assert await db.get_dmitem_entries_paginated(container_id, 2, 0, expected[-1]) == ([], None)
+        # A limit below one returns pages of one entry
+        assert await db.get_dmitem_entries_paginated(container_id, 0, 0) == (expected[:1], expected[0])
+        assert await db.get_dmitem_entries_paginated(container_id, -1, 3) == (expected[3:], None)
+
+
+def test_raw_block_store(tmpdir):
+    path = str(tmpdir.join('blocks'))
+    store = RawBlockStore(path, 4)
+    blocks = {height: urandom(100 + (height * 37) % 90) for height in range(1, 41)}
+    for height, block in blocks.items():
+        store.write(height, block)
+        assert store.read(height) == block
+        # The whole window is readable, and it wraps within a bounded file
+        for window_height in range(max(height - 3, 1), height + 1):
+            assert store.read(window_height) == blocks[window_height]
+        assert store.data_size <= 2 * 4 * 190
+    with pytest.raises(FileNotFoundError):
+        store.read(36)
+    with pytest.raises(FileNotFoundError):
+        store.read(41)
+    store.close()
+
+    # The index persists; a different window size starts empty
+    store = RawBlockStore(path, 4)
+    assert store.read(40) == blocks[40]
+    store.close()
+    store = RawBlockStore(path, 5)
+    with pytest.raises(FileNotFoundError):
+        store.read(40)
+    store.close()
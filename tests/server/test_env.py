@@ -276,6 +276,35 @@ def test_REORG_LIMIT():
                    lib_coins.BitcoinSV.REORG_LIMIT)
 
 
+def test_BLOCK_PARSE_WORKERS():
+    assert_integer('BLOCK_PARSE_WORKERS', 'block_parse_workers', 0)
+
+
+def test_ATOMICALS_LOCATION_FILTER():
+    assert_boolean('ATOMICALS_LOCATION_FILTER', 'atomicals_location_filter', True)
+
+
+def test_DFT_MINT_COUNT_AUDIT():
+    assert_boolean('DFT_MINT_COUNT_AUDIT', 'dft_mint_count_audit', False)
+    assert_boolean('ACTIVE_SUPPLY_AUDIT', 'active_supply_audit', False)
+
+
+def test_BATCH_UTXO_LOOKUPS():
+    assert_boolean('BATCH_UTXO_LOOKUPS', 'batch_utxo_lookups', True)
+
+
+def test_FLUSH_BATCH_MB():
+    assert_integer('FLUSH_BATCH_MB', 'flush_batch_MB', 0)
+
+
+def test_BACKGROUND_FLUSH():
+    assert_boolean('BACKGROUND_FLUSH', 'background_flush', False)
+
+
+def test_HISTORY_COMPACTION_FLUSHES():
+    assert_integer('HISTORY_COMPACTION_FLUSHES', 'history_compaction_flushes', 0)
+
+
 def test_COST_HARD_LIMIT():
     assert_integer(
         'COST_HARD_LIMIT',
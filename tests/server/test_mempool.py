@@ -7,10 +7,10 @@ from functools import partial
 from random import randrange, choice, seed
 
 import pytest
-from aiorpcx import Event, sleep, ignore_after
+from aiorpcx import Event, sleep, ignore_after, run_in_thread
 
-from electrumx.server.mempool import MemPool, MemPoolAPI
-from electrumx.lib.coins import BitcoinCash
+from electrumx.server.mempool import MemPool, MemPoolAPI, MemPoolTx
+from electrumx.lib.coins import Bitcoin, BitcoinCash
 from electrumx.lib.hash import HASHX_LEN, hex_str_to_hash, hash_to_hex_str
 from electrumx.lib.tx import Tx, TxInput, TxOutput
 from electrumx.lib.util import OldTaskGroup
@@ -77,6 +77,9 @@ class API(MemPoolAPI):
         self.raw_txs = {}
         self.txs = {}
         self.ordered_adds = []
+        # Atomicals at DB UTXOs and their mint infos
+        self.db_atomicals = {}
+        self.mint_infos = {}
 
     def initialize(self, addr_count=100, db_utxo_count=100, mempool_size=50):
         hash160s = [os.urandom(20) for n in range(addr_count)]
@@ -234,6 +237,15 @@ class API(MemPoolAPI):
         await sleep(0)
         return [self.db_utxos.get(prevout) for prevout in prevouts]
 
+    def atomicals_at_location(self, tx_hash, tx_idx):
+        return self.db_atomicals.get((tx_hash, tx_idx), [])
+
+    def atomical_mint_info(self, atomical_id):
+        return self.mint_infos.get(atomical_id)
+
+    async def run_with_atomicals_state(self, func):
+        return await run_in_thread(func)
+
     async def on_mempool(self, touched, height):
         '''Called each time the mempool is synchronized.  touched is a set of
         hashXs touched since the previous call.  height is the
@@ -358,6 +370,31 @@ def test_compress_histogram():
     assert compact == [(10.1, 51000), (10, 500000), (1.1, 70000), (1.0, 10000000)]
 
 
+def test_accept_transactions_chain():
+    mempool = MemPool(coin, API())
+    hashX = os.urandom(HASHX_LEN)
+    db_prevout = (os.urandom(32), 0)
+    utxo_map = {db_prevout: (hashX, 100_000)}
+
+    # A long unconfirmed chain, children first, plus an orphan and its child
+    hashes = [os.urandom(32) for n in range(1000)]
+    prevouts = [db_prevout] + [(tx_hash, 0) for tx_hash in hashes[:-1]]
+    orphan_hash, orphan_child_hash = os.urandom(32), os.urandom(32)
+    chain = [(orphan_child_hash, (orphan_hash, 0)), (orphan_hash, (os.urandom(32), 0))]
+    chain += reversed(list(zip(hashes, prevouts)))
+    tx_map = {tx_hash: MemPoolTx((prevout, ), None, ((hashX, 99_000), ), 0, 200)
+              for tx_hash, prevout in chain}
+
+    touched = set()
+    deferred, unspent = mempool._accept_transactions(tx_map, utxo_map, touched)
+    assert set(deferred) == {orphan_hash, orphan_child_hash}
+    assert not unspent
+    assert touched == {hashX}
+    assert set(mempool.txs) == set(hashes)
+    assert mempool.txs[hashes[0]].fee == 1_000
+    assert all(mempool.txs[tx_hash].fee == 0 for tx_hash in hashes[1:])
+
+
 @pytest.mark.asyncio
 async def test_potential_spends():
     api = API()
@@ -570,3 +607,54 @@ async def test_dropped_txs(caplog):
             await group.cancel_remaining()
 
     assert in_caplog(caplog, 'txs dropped')
+
+
+@pytest.mark.asyncio
+async def test_atomicals_transfers():
+    api = API()
+    # Atomicals are only on Bitcoin
+    mempool = MemPool(Bitcoin, api, refresh_secs=0.01)
+    hash160s = [os.urandom(20) for n in range(3)]
+    hashX_a, hashX_b, hashX_c = (coin.hash160_to_P2PKH_hashX(hash160)
+                                 for hash160 in hash160s)
+
+    # An FT at a DB UTXO of hashX_a
+    prevout = (os.urandom(32), 0)
+    atomical_id = os.urandom(32) + bytes(4)
+    api.db_utxos[prevout] = (hashX_a, 1000)
+    api.mint_infos[atomical_id] = {'id': atomical_id, 'type': 'FT'}
+    data = hashX_a + bytes(32) + (1000).to_bytes(8, 'little') + bytes(2)
+    api.db_atomicals[prevout] = [{
+        'atomical_id': atomical_id,
+        'location_id': prevout[0] + bytes(4),
+        'data': data,
+        'data_ex': {'value': 1000, 'exponent': 0},
+    }]
+
+    # It is sent to hashX_b, and from there on to hashX_c
+    for hash160 in hash160s[1:]:
+        tx = Tx(2, [TxInput(prevout[0], prevout[1], b'', 4294967295)],
+                [TxOutput(1000, coin.hash160_to_P2PKH_script(hash160))], 0)
+        raw_tx = tx.serialize()
+        tx_hash = tx_hash_fn(raw_tx)
+        api.raw_txs[tx_hash] = raw_tx
+        api.txs[tx_hash] = tx
+        prevout = (tx_hash, 0)
+    first_hash = list(api.txs)[0]
+
+    event = Event()
+    async with OldTaskGroup() as group:
+        await group.spawn(mempool.keep_synchronized, event)
+        await event.wait()
+        assert await mempool.atomicals_balance_delta(hashX_a) == {atomical_id: -1000}
+        assert await mempool.atomicals_balance_delta(hashX_b) == {}
+        assert await mempool.atomicals_balance_delta(hashX_c) == {atomical_id: 1000}
+        assert mempool.atomicals_outputs[prevout[0] + bytes(4)][0]['atomical_id'] == atomical_id
+
+        # The first transfer confirms
+        del api.txs[first_hash]
+        await event.wait()
+        assert await mempool.atomicals_balance_delta(hashX_a) == {}
+        assert await mempool.atomicals_balance_delta(hashX_b) == {atomical_id: -1000}
+        assert await mempool.atomicals_balance_delta(hashX_c) == {atomical_id: 1000}
+        await group.cancel_remaining()
@@ -1,7 +1,7 @@
 import pytest
 import os
 
-from electrumx.server.storage import Storage, db_class
+from electrumx.server.storage import Storage, ChunkedWriteBatch, FlushJournal, db_class
 from electrumx.lib.util import subclasses
 
 # Find out which db engines to test
@@ -66,8 +66,75 @@ def test_iterator_reverse(db):
         ]
 
 
+def test_multi_get(db):
+    db.put(b"b", b"2")
+    db.put(b"a", b"1")
+    assert db.multi_get([b"b", b"c", b"a", b"b"]) == [b"2", None, b"1", b"2"]
+    assert db.multi_get([]) == []
+
+
+def test_iterator_from(db):
+    for i in range(5):
+        db.put(b"abc" + str.encode(str(i)), str.encode(str(i)))
+    db.put(b"a", b"xyz")
+    db.put(b"abd", b"x")
+    assert [key for key, _ in db.iterator_from(b"abc", b"abc2")] == [
+        b"abc2", b"abc3", b"abc4"]
+    assert [key for key, _ in db.iterator_from(b"abc", b"abc2", reverse=True)] == [
+        b"abc2", b"abc1", b"abc0"]
+    assert [key for key, _ in db.iterator_from(b"abc", b"abc25", reverse=True)] == [
+        b"abc2", b"abc1", b"abc0"]
+    assert list(db.iterator_from(b"abc", b"abc5")) == []
+
+
+def test_multi_prefix_items(db):
+    for key in (b"a1", b"b1", b"b2", b"c1", b"d1", b"e1"):
+        db.put(key, key + b"v")
+    assert db.multi_prefix_items([b"d", b"b", b"x", b"c", b"b", b"0"]) == [
+        [(b"d1", b"d1v")], [(b"b1", b"b1v"), (b"b2", b"b2v")], [],
+        [(b"c1", b"c1v")], [(b"b1", b"b1v"), (b"b2", b"b2v")], []]
+    assert db.multi_prefix_items([]) == []
+
+
 def test_close(db):
     db.put(b"a", b"b")
     db.close()
     db = db_class(db.__class__.__name__)("db", False)
     assert db.get(b"a") == b"b"
+
+
+def test_chunked_batch(db):
+    db.put(b"d", b"1")
+    with ChunkedWriteBatch(db, 8) as b:
+        b.put(b"c", b"1")
+        b.put(b"b", b"1")
+        assert db.get(b"b") is None
+        b.put(b"a", b"222")
+        # Reaching the batch size commits the buffered writes
+        assert db.get(b"b") == b"1"
+        b.delete(b"d")
+        b.put(b"d", b"2")
+        assert db.get(b"d") == b"1"
+    assert b.batch_count == 2
+    assert list(db.iterator()) == [(b"a", b"222"), (b"b", b"1"), (b"c", b"1"), (b"d", b"2")]
+
+
+def test_flush_journal(db):
+    db.put(b"a", b"1")
+    db.put(b"b", b"1")
+    journal = FlushJournal(db, 8)
+    with journal.writer() as b:
+        b.put(b"a", b"2")
+        b.delete(b"b")
+        b.put(b"c", b"1")
+        b.put(b"c", b"2")
+    # Staged writes are not visible under their keys
+    assert list(db.iterator(prefix=b"a")) == [(b"a", b"1")]
+    assert db.get(b"c") is None
+    assert journal.apply() == 3
+    assert list(db.iterator()) == [(b"a", b"2"), (b"c", b"2")]
+
+    with journal.writer() as b:
+        b.put(b"a", b"3")
+    assert journal.discard() == 1
+    assert list(db.iterator()) == [(b"a", b"2"), (b"c", b"2")]